@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+from cubes.backends.sql import functions
+from cubes.errors import ModelError
+import sqlalchemy
+
+from quantile_sketch import QUANTILES, quantile_expression
+
+class RollupMomentFunction(functions.AggregateFunction):
+    """
+    Mean value ("avg") or sample standard deviation ("stddev") over the cells
+    of a rollup table.
+
+    The measure of the aggregate is a stored sum (like euro_sum), the count
+    and the sum of squares are read from the measures with the suffixes
+    "_count" and "_sum_squares" instead of "_sum" (see
+    assets_generator.create_rollup_tables()). The results are the same as
+    those of avg() and stddev() over the values of the source table.
+    """
+    def __init__(self, name, moment):
+        super(RollupMomentFunction, self).__init__(name)
+        self.moment = moment
+
+    def required_measures(self, aggregate):
+        if not aggregate.measure or not aggregate.measure.endswith("_sum"):
+            raise ModelError("Aggregate function {} requires a measure ending in '_sum' (aggregate {})"
+                             .format(self.name, aggregate.name))
+        base = aggregate.measure[:-len("_sum")]
+        return [aggregate.measure, base + "_count", base + "_sum_squares"]
+
+    def apply(self, aggregate, context=None, coalesce=False):
+        func = sqlalchemy.func
+        sums, counts, squares = [func.sum(context.column(context.cube.measure(name)))
+                                 for name in self.required_measures(aggregate)]
+        if self.moment == "avg":
+            return sums / func.nullif(counts, 0)
+        # rounding may make the numerator slightly negative if all values are equal
+        variance = (squares - sums * sums / func.nullif(counts, 0)) / func.nullif(counts - 1, 0)
+        return func.sqrt(func.greatest(variance, 0))
+
+def register_aggregate_functions():
+    """
+    Add the aggregate functions used by the model to the SQL backend of cubes.
+
+    "rollup_avg" and "rollup_stddev" compute mean values and standard
+    deviations from the sums stored in rollup tables (see
+    RollupMomentFunction). For every entry of quantile_sketch.QUANTILES,
+    "sketch_<name>" computes the quantile of the merged sketches stored in a
+    measure (like the euro_sketch column of the rollup tables).
+    """
+    # creates the dict of the built-in functions if it does not exist yet
+    functions.available_aggregate_functions()
+    registered = [RollupMomentFunction("rollup_avg", "avg"), RollupMomentFunction("rollup_stddev", "stddev")]
+    for name, fraction in QUANTILES:
+        registered.append(functions.AggregateFunction("sketch_" + name, quantile_expression, fraction))
+    for function in registered:
+        functions._function_dict[function.name] = function
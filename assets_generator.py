@@ -1,38 +1,214 @@
 #!/usr/bin/env python
 
 import argparse
+from collections import OrderedDict
+from cStringIO import StringIO
 import csv
 import ConfigParser
+import hashlib
 import json
 import os
+import re
 import sys
 import time
+import urllib
 import urllib2
 
-from util import UnicodeReader, colorise
+from profiling import PROFILER
+from quantile_sketch import create_sketch_functions
+from snapshot import Snapshot, read_snapshot_generation, write_snapshot
+from util import (CSVBatchReader, UnicodeReader, colorise, compile_model_index, escape_cut_value,
+                  new_generation_id, write_generation_stamp)
+import http_fetcher
 import offsetting_coverage as oc
 
 import sqlalchemy
-        
+from sqlalchemy.dialects import postgresql
+
+DEFAULT_BATCH_SIZE = 10000
+
 ARG_HELP_STRINGS = {
     
-    "dir": "A path to a directory where the generated output files should be stored. " +
-           "If omitted, output will be written to the current directory.",
+    "dir": "A path to a directory where the generated output files (including the " +
+           "static aggregate responses and the data generation stamp written by the " +
+           "tables and rollback jobs) should be stored. If omitted, output will be " +
+           "written to the current directory.",
     "num_api_lookups": "stop execution after n journal lookups to " +
                         "when performing the coverage_stats job. Useful for " +
-                        "reducing API loads and saving results from time to time."
+                        "reducing API loads and saving results from time to time.",
+    "workers": "number of concurrent SpringerLink requests when performing the " +
+               "coverage_stats job (default: 1). With more than one worker, all missing " +
+               "data is deduplicated and prefetched in parallel.",
+    "request_delay": "minimum delay in seconds between the start of two SpringerLink " +
+                     "requests when performing the coverage_stats job (default: {}).".format(oc.DEFAULT_REQUEST_DELAY),
+    "fetch_mode": "HTTP mode of the coverage_stats job. 'live' (default) always uses the network, " +
+                  "'record' additionally records all responses in the {} directory, 'replay' ".format(oc.HTTP_CACHE_DIR) +
+                  "serves recorded responses and records missing ones, 'offline' only serves recorded " +
+                  "responses and never accesses the network.",
+    "batch_size": "number of rows which are buffered per table before they are " +
+                  "streamed to the database in a single COPY statement when " +
+                  "performing the tables job (default: {}).".format(DEFAULT_BATCH_SIZE),
+    "load_mode": "How the tables job distributes rows. 'client' (default) sends every " +
+                 "row to all tables it belongs to, 'server' writes the raw rows only once " +
+                 "into the openapc and offsetting tables and lets the database derive " +
+                 "the combined and institution tables using INSERT ... SELECT.",
+    "incremental": "Only apply the differences between the data files and the already " +
+                   "loaded tables (identified by DOI and a content hash) instead of " +
+                   "recreating all tables when performing the tables job.",
+    "shadow_build": "Build all tables in a staging schema, validate them and swap " +
+                    "it with the live schema in a single transaction when performing " +
+                    "the tables job. The replaced schema is kept for the rollback job.",
+    "layout": "Table layout used by the tables and model jobs. 'flat' (default) stores " +
+              "all dimensions as strings in every fact table, 'star' moves publishers, " +
+              "journals, institutions and countries to dimension tables referenced by " +
+              "integer keys. All other columns keep their types. Both jobs have to " +
+              "use the same layout.",
+    "analyze": "Run ANALYZE on every cube table after the indexes have been " +
+               "created when performing the tables job.",
+    "single_cube": "Do not create a cube and a table for every institution. " +
+                   "The model only contains the openapc cube (besides " +
+                   "offsetting, combined and rollup cubes) and the server " +
+                   "answers requests to institution cubes with cuts on it " +
+                   "(see the [institutions] section of the slicer " +
+                   "configuration). The model, tables and static_aggregates " +
+                   "jobs have to use the same setting.",
+    "profile": "Measure the duration, throughput and memory usage of every " +
+               "stage of the job (like loading files and caches, database " +
+               "inserts per table and network requests by type) and print " +
+               "a summary table at the end.",
+    "profile_output": "Additionally profile the job with cProfile and write the " +
+                      "profile data to this file (implies --profile)."
 }
 
 APC_DE_FILE = "apc_de.csv"
 OFFSETTING_FILE = "offsetting.csv"
 
+APC_FIELDS = [
+    ("institution", "string"),
+    ("period", "string"),
+    ("euro", "float"),
+    ("doi", "string"),
+    ("is_hybrid", "string"),
+    ("publisher", "string"),
+    ("journal_full_title", "string"),
+    ("issn", "string"),
+    ("issn_print", "string"),
+    ("issn_electronic", "string"),
+    ("issn_l", "string"),
+    ("license_ref", "string"),
+    ("indexed_in_crossref", "string"),
+    ("pmid", "string"),
+    ("pmcid", "string"),
+    ("ut", "string"),
+    ("url", "string"),
+    ("doaj", "string"),
+    ("country", "string")
+]
+
+OFFSETTING_FIELDS = [
+    ("institution", "string"),
+    ("period", "string"),
+    ("euro", "float"),
+    ("doi", "string"),
+    ("is_hybrid", "string"),
+    ("publisher", "string"),
+    ("journal_full_title", "string"),
+    ("issn", "string"),
+    ("issn_print", "string"),
+    ("issn_electronic", "string"),
+    ("issn_l", "string"),
+    ("license_ref", "string"),
+    ("indexed_in_crossref", "string"),
+    ("pmid", "string"),
+    ("pmcid", "string"),
+    ("ut", "string"),
+    ("url", "string"),
+    ("doaj", "string"),
+    ("country", "string"),
+]
+
+OFFSETTING_COVERAGE_FIELDS = [
+    ("period", "string"),
+    ("publisher", "string"),
+    ("journal_full_title", "string"),
+    ("is_hybrid", "string"),
+    ("num_offsetting_articles", "float"),
+    ("num_journal_total_articles", "float"),
+    ("num_journal_oa_articles", "float")
+]
+
+# Natural key and content hash of every row in the openapc, offsetting and
+# combined tables, required for incremental updates
+KEY_FIELDS = [
+    ("row_key", "string"),
+    ("row_hash", "string")
+]
+
+# Name/value pairs describing the loaded data (the data generation and a
+# fingerprint of the coverage caches), required for incremental updates
+LOAD_STATE_TABLE = "load_state"
+LOAD_STATE_FIELDS = [
+    ("name", "string"),
+    ("value", "string")
+]
+
+# Positions of the fields in prepared rows (see _prepare_batch)
+APC_INDEXES = {field_name: index for index, (field_name, _) in enumerate(APC_FIELDS + KEY_FIELDS)}
+OFFSETTING_INDEXES = {field_name: index for index, (field_name, _) in enumerate(OFFSETTING_FIELDS + KEY_FIELDS)}
+
+# Common drilldown grains which are pre-aggregated into rollup tables. Every
+# source table gets one rollup table per grain, named <source>_by_<grain>.
+ROLLUP_GRAINS = [
+    ("publisher", ["period", "is_hybrid", "publisher"]),
+    ("journal", ["period", "is_hybrid", "publisher", "journal_full_title"]),
+    ("institution", ["period", "is_hybrid", "institution"]),
+    # serves medians and percentiles of institution cubes (see olap_middleware.InstitutionRouter)
+    ("institution_publisher", ["period", "is_hybrid", "institution", "publisher"])
+]
+ROLLUP_SOURCES = ["openapc", "combined", "offsetting"]
+
+# Written after every change to the tables, used by the server to invalidate caches
+DATA_GENERATION_FILE = "data_generation.json"
+DATA_SNAPSHOT_FILE = "data_snapshot.bin"
+MODEL_INDEX_FILE = "model_index.json"
+
+# Dimension tables of the star layout as (table name, key column in the fact
+# tables, key type, natural key, additional attributes)
+STAR_DIMENSIONS = [
+    ("dim_publisher", "publisher_id", "SMALLINT", "publisher", []),
+    ("dim_journal", "journal_id", "INTEGER", "journal_full_title",
+     ["issn", "issn_print", "issn_electronic", "issn_l"]),
+    ("dim_institution", "institution_id", "SMALLINT", "institution", []),
+    ("dim_country", "country_id", "SMALLINT", "country", [])
+]
+
+LIVE_SCHEMA = "openapc_schema"
+STAGING_SCHEMA = LIVE_SCHEMA + "_staging"
+PREVIOUS_SCHEMA = LIVE_SCHEMA + "_previous"
+
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("job", choices=["tables", "model", "yamls", "db_settings", "coverage_stats"])
+    parser.add_argument("job", choices=["tables", "rollback", "model", "yamls", "static_aggregates",
+                                        "db_settings", "coverage_stats"])
     parser.add_argument("-d", "--dir", help=ARG_HELP_STRINGS["dir"])
     parser.add_argument("-n", "--num_api_lookups", type=int, help=ARG_HELP_STRINGS["num_api_lookups"])
+    parser.add_argument("-w", "--workers", type=int, default=1, help=ARG_HELP_STRINGS["workers"])
+    parser.add_argument("--request_delay", type=float, default=oc.DEFAULT_REQUEST_DELAY, help=ARG_HELP_STRINGS["request_delay"])
+    parser.add_argument("-f", "--fetch_mode", choices=http_fetcher.FETCH_MODES, default="live", help=ARG_HELP_STRINGS["fetch_mode"])
+    parser.add_argument("-b", "--batch_size", type=int, default=DEFAULT_BATCH_SIZE, help=ARG_HELP_STRINGS["batch_size"])
+    parser.add_argument("-m", "--load_mode", choices=["client", "server"], default="client", help=ARG_HELP_STRINGS["load_mode"])
+    parser.add_argument("-i", "--incremental", action="store_true", help=ARG_HELP_STRINGS["incremental"])
+    parser.add_argument("-s", "--shadow_build", action="store_true", help=ARG_HELP_STRINGS["shadow_build"])
+    parser.add_argument("-l", "--layout", choices=["flat", "star"], default="flat", help=ARG_HELP_STRINGS["layout"])
+    parser.add_argument("-a", "--analyze", action="store_true", help=ARG_HELP_STRINGS["analyze"])
+    parser.add_argument("-u", "--single_cube", action="store_true", help=ARG_HELP_STRINGS["single_cube"])
+    parser.add_argument("--profile", action="store_true", help=ARG_HELP_STRINGS["profile"])
+    parser.add_argument("--profile_output", help=ARG_HELP_STRINGS["profile_output"])
     args = parser.parse_args()
     
+    if args.profile or args.profile_output:
+        PROFILER.enable(args.profile_output)
+    
     path = "."
     if args.dir:
         if os.path.isdir(args.dir):
@@ -41,28 +217,97 @@ def main():
             print "ERROR: '" + args.dir + "' is no valid directory!"
     
     if args.job == "tables":
-        if not os.path.isfile("db_settings.ini"):
-            print "ERROR: Database Configuration file db_settings.ini not found!"
+        # check all arguments before anything is created in the database
+        if args.batch_size < 1:
+            print "ERROR: batch size must be a positive number"
             sys.exit()
-        scp = ConfigParser.SafeConfigParser()
-        scp.read("db_settings.ini")
-        try:
-            db_user = scp.get("postgres_credentials", "user")
-            db_pass = scp.get("postgres_credentials", "pass")
-        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError) as e:
-            print "ERROR: db_settings.ini is malformed ({})".format(e.message)
+        if args.shadow_build and args.incremental:
+            print "ERROR: Incremental updates are always applied to the live schema, they cannot be combined with a shadow build"
             sys.exit()
-        psql_uri = "postgresql://" + db_user + ":" + db_pass + "@localhost/openapc_db"
-        engine = sqlalchemy.create_engine(psql_uri)
-        create_cubes_tables(engine, APC_DE_FILE, OFFSETTING_FILE)
-        with engine.begin() as connection:
-            connection.execute("GRANT SELECT ON ALL TABLES IN SCHEMA openapc_schema TO cubes_user")
-        
-        
+        if args.incremental and args.layout == "star":
+            print "ERROR: Incremental updates are only possible with the flat table layout"
+            sys.exit()
+        engine = _create_db_engine()
+        schema = LIVE_SCHEMA
+        if args.shadow_build:
+            schema = STAGING_SCHEMA
+            create_staging_schema(engine)
+        generation = new_generation_id()
+        # The snapshot is taken from the flat tables and published together with the generation stamp
+        snapshot_path = os.path.join(path, DATA_SNAPSHOT_FILE)
+        try:
+            with PROFILER.stage("create cube tables"):
+                changes = create_cubes_tables(engine, APC_DE_FILE, OFFSETTING_FILE, schema=schema,
+                                              batch_size=args.batch_size, load_mode=args.load_mode,
+                                              incremental=args.incremental, single_cube=args.single_cube,
+                                              generation=generation)
+            previous = None
+            changed_tables = None
+            if changes is None:
+                with PROFILER.stage("create rollup tables"):
+                    create_rollup_tables(engine, schema=schema)
+            else:
+                changed_tables = changes["tables"]
+                with PROFILER.stage("update rollup tables"):
+                    update_rollup_tables(engine, changes["rows"], schema=schema)
+                # unchanged tables can be copied if the snapshot matches the tables before the update
+                if (changes["previous_generation"] is not None and
+                        read_snapshot_generation(snapshot_path) == changes["previous_generation"]):
+                    previous = (snapshot_path, changed_tables)
+            with PROFILER.stage("write snapshot"):
+                write_table_snapshot(engine, snapshot_path + ".new", generation, schema=schema,
+                                     single_cube=args.single_cube, previous=previous)
+            if args.layout == "star":
+                with PROFILER.stage("convert to star schema"):
+                    convert_to_star_schema(engine, schema=schema, single_cube=args.single_cube)
+            model = json.loads(build_model(layout=args.layout, single_cube=args.single_cube))
+            with PROFILER.stage("create indexes"):
+                create_cube_indexes(engine, model, schema=schema, analyze=args.analyze,
+                                    single_cube=args.single_cube, tables=changed_tables)
+            if args.shadow_build:
+                with PROFILER.stage("validate tables"):
+                    valid = validate_tables(engine, APC_DE_FILE, OFFSETTING_FILE, schema=schema,
+                                            single_cube=args.single_cube)
+                if not valid:
+                    print colorise("ERROR: Validation failed, the live schema was left untouched.", "red")
+                    sys.exit()
+            with engine.begin() as connection:
+                connection.execute("GRANT USAGE ON SCHEMA {} TO cubes_user".format(schema))
+                connection.execute("GRANT SELECT ON ALL TABLES IN SCHEMA {} TO cubes_user".format(schema))
+        except BaseException:
+            # failed builds (including sys.exit() above) never publish a snapshot
+            if os.path.isfile(snapshot_path + ".new"):
+                os.remove(snapshot_path + ".new")
+            raise
+        if args.shadow_build:
+            swap_schemas(engine)
+        os.rename(snapshot_path + ".new", snapshot_path)
+        write_generation_stamp(os.path.join(path, DATA_GENERATION_FILE), generation)
+        print "New data generation: " + generation
+    elif args.job == "rollback":
+        engine = _create_db_engine()
+        rollback_schemas(engine)
+        generation = new_generation_id()
+        snapshot_path = os.path.join(path, DATA_SNAPSHOT_FILE)
+        try:
+            written = write_table_snapshot(engine, snapshot_path + ".new", generation, single_cube=args.single_cube)
+        except BaseException:
+            if os.path.isfile(snapshot_path + ".new"):
+                os.remove(snapshot_path + ".new")
+            raise
+        if written:
+            os.rename(snapshot_path + ".new", snapshot_path)
+        elif os.path.isfile(snapshot_path):
+            # the restored schema has no flat tables, an old snapshot would not match it
+            os.remove(snapshot_path)
+        write_generation_stamp(os.path.join(path, DATA_GENERATION_FILE), generation)
+        print "New data generation: " + generation
     elif args.job == "model":
-        generate_model_file(path)
+        generate_model_file(path, layout=args.layout, single_cube=args.single_cube)
     elif args.job == "yamls":
         generate_yamls(path)
+    elif args.job == "static_aggregates":
+        export_static_aggregates(path, single_cube=args.single_cube)
     elif args.job == "db_settings":
         if os.path.isfile("db_settings.ini"):
             print "ERROR: db_settings.ini already exists"
@@ -74,10 +319,107 @@ def main():
         with open('db_settings.ini', 'w') as config_file:
             scp.write(config_file)
     elif args.job == "coverage_stats":
-        oc.update_coverage_stats(OFFSETTING_FILE, args.num_api_lookups)
+        oc.update_coverage_stats(OFFSETTING_FILE, args.num_api_lookups, args.workers, args.request_delay,
+                                 args.fetch_mode)
         
         
         
+def _create_db_engine():
+    if not os.path.isfile("db_settings.ini"):
+        print "ERROR: Database Configuration file db_settings.ini not found!"
+        sys.exit()
+    scp = ConfigParser.SafeConfigParser()
+    scp.read("db_settings.ini")
+    try:
+        db_user = scp.get("postgres_credentials", "user")
+        db_pass = scp.get("postgres_credentials", "pass")
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError) as e:
+        print "ERROR: db_settings.ini is malformed ({})".format(e.message)
+        sys.exit()
+    psql_uri = "postgresql://" + db_user + ":" + db_pass + "@localhost/openapc_db"
+    return sqlalchemy.create_engine(psql_uri)
+
+def create_staging_schema(connectable, schema=STAGING_SCHEMA):
+    """
+    (Re-)create an empty staging schema, removing leftovers of failed runs.
+    """
+    with connectable.begin() as connection:
+        connection.execute("DROP SCHEMA IF EXISTS {} CASCADE".format(schema))
+        connection.execute("CREATE SCHEMA {}".format(schema))
+
+def _count_csv_records(file_name):
+    with open(file_name, "rb") as csv_file:
+        return sum(1 for _ in csv.reader(csv_file)) - 1
+
+def validate_tables(connectable, apc_file_name, offsetting_file_name, schema=STAGING_SCHEMA, single_cube=False):
+    """
+    Check the row counts of freshly loaded tables.
+
+    The openapc and offsetting tables have to contain all records from the data
+    files, the combined table has to contain the openapc rows plus all
+    offsetting rows with cost data and the institution tables (if not loaded
+    with single_cube) together have to contain all openapc rows.
+
+    Returns:
+        True if all checks passed, False otherwise.
+    """
+    metadata = sqlalchemy.MetaData(bind=connectable)
+    def count(table_name, *criteria):
+        table = sqlalchemy.Table(table_name, metadata, autoload=True, schema=schema)
+        query = sqlalchemy.select([sqlalchemy.func.count()]).select_from(table)
+        for criterion in criteria:
+            query = query.where(criterion(table))
+        return connectable.execute(query).scalar()
+    num_openapc = count("openapc")
+    num_offsetting = count("offsetting")
+    num_offsetting_with_costs = count("offsetting", lambda table: table.c.euro != None)
+    checks = [
+        ("openapc rows match " + apc_file_name, num_openapc, _count_csv_records(apc_file_name)),
+        ("offsetting rows match " + offsetting_file_name, num_offsetting, _count_csv_records(offsetting_file_name)),
+        ("combined rows match openapc and offsetting", count("combined"), num_openapc + num_offsetting_with_costs)
+    ]
+    if not single_cube:
+        num_institutions = 0
+        for cubes_name in _institution_cubes_names():
+            num_institutions += count(cubes_name)
+        checks.append(("institution tables rows match openapc", num_institutions, num_openapc))
+    valid = num_openapc > 0
+    for (description, actual, expected) in checks:
+        if actual == expected:
+            print colorise(u"OK: {} ({})".format(description, actual), "green")
+        else:
+            print colorise(u"FAILED: {} ({} instead of {})".format(description, actual, expected), "red")
+            valid = False
+    return valid
+
+def swap_schemas(connectable):
+    """
+    Replace the live schema by the staging schema in a single transaction.
+
+    The replaced live schema is kept as previous generation, an older previous
+    generation is dropped.
+    """
+    with connectable.begin() as connection:
+        connection.execute("DROP SCHEMA IF EXISTS {} CASCADE".format(PREVIOUS_SCHEMA))
+        if connectable.dialect.has_schema(connection, LIVE_SCHEMA):
+            connection.execute("ALTER SCHEMA {} RENAME TO {}".format(LIVE_SCHEMA, PREVIOUS_SCHEMA))
+        connection.execute("ALTER SCHEMA {} RENAME TO {}".format(STAGING_SCHEMA, LIVE_SCHEMA))
+    print colorise("Staging schema is now live, the old tables were kept in " + PREVIOUS_SCHEMA, "green")
+
+def rollback_schemas(connectable):
+    """
+    Exchange the live schema and the previous generation in a single transaction.
+    """
+    with connectable.begin() as connection:
+        if not connectable.dialect.has_schema(connection, PREVIOUS_SCHEMA):
+            print "ERROR: No previous generation ({}) found, rollback is not possible".format(PREVIOUS_SCHEMA)
+            sys.exit()
+        connection.execute("DROP SCHEMA IF EXISTS {} CASCADE".format(STAGING_SCHEMA))
+        connection.execute("ALTER SCHEMA {} RENAME TO {}".format(LIVE_SCHEMA, STAGING_SCHEMA))
+        connection.execute("ALTER SCHEMA {} RENAME TO {}".format(PREVIOUS_SCHEMA, LIVE_SCHEMA))
+        connection.execute("ALTER SCHEMA {} RENAME TO {}".format(STAGING_SCHEMA, PREVIOUS_SCHEMA))
+    print colorise("Rollback done, the replaced tables are now kept in " + PREVIOUS_SCHEMA, "green")
+
 def init_table(table, fields, create_id=False):
     
     type_map = {"integer": sqlalchemy.Integer,
@@ -85,7 +427,8 @@ def init_table(table, fields, create_id=False):
                 "string": sqlalchemy.String(512),
                 "text": sqlalchemy.Text,
                 "date": sqlalchemy.Text,
-                "boolean": sqlalchemy.Integer}
+                "boolean": sqlalchemy.Integer,
+                "sketch": postgresql.ARRAY(sqlalchemy.Integer, dimensions=2)}
     
     if create_id:
         col = sqlalchemy.schema.Column('id', sqlalchemy.Integer, primary_key=True)
@@ -97,219 +440,1124 @@ def init_table(table, fields, create_id=False):
 
     table.create()
 
-def create_cubes_tables(connectable, apc_file_name, offsetting_file_name, schema="openapc_schema"):
-    
-    apc_fields = [
-        ("institution", "string"),
-        ("period", "string"),
-        ("euro", "float"),
-        ("doi", "string"),
-        ("is_hybrid", "string"),
-        ("publisher", "string"),
-        ("journal_full_title", "string"),
-        ("issn", "string"),
-        ("issn_print", "string"),
-        ("issn_electronic", "string"),
-        ("issn_l", "string"),
-        ("license_ref", "string"),
-        ("indexed_in_crossref", "string"),
-        ("pmid", "string"),
-        ("pmcid", "string"),
-        ("ut", "string"),
-        ("url", "string"),
-        ("doaj", "string"),
-        ("country", "string")
-    ]
-    
-    offsetting_fields = [
-        ("institution", "string"),
-        ("period", "string"),
-        ("doi", "string"),
-        ("is_hybrid", "string"),
-        ("publisher", "string"),
-        ("journal_full_title", "string"),
-        ("issn", "string"),
-        ("issn_print", "string"),
-        ("issn_electronic", "string"),
-        ("issn_l", "string"),
-        ("license_ref", "string"),
-        ("indexed_in_crossref", "string"),
-        ("pmid", "string"),
-        ("pmcid", "string"),
-        ("ut", "string"),
-        ("url", "string"),
-        ("doaj", "string"),
-        ("country", "string"),
-    ]
-    
-    offsetting_coverage_fields = [
-        ("period", "string"),
-        ("publisher", "string"),
-        ("journal_full_title", "string"),
-        ("is_hybrid", "string"),
-        ("num_offsetting_articles", "float"),
-        ("num_journal_total_articles", "float"),
-        ("num_journal_oa_articles", "float")
-    ]
+# Characters which have to be escaped in the PostgreSQL COPY text format
+COPY_SPECIAL_CHARACTERS = re.compile(u"[\\\\\t\n\r]")
+
+def _copy_value(value):
+    """
+    Render a single value in the PostgreSQL COPY text format.
+    """
+    if value is None:
+        return u"\\N"
+    if not isinstance(value, unicode):
+        value = unicode(value)
+    if COPY_SPECIAL_CHARACTERS.search(value) is None:
+        return value
+    value = value.replace(u"\\", u"\\\\")
+    value = value.replace(u"\t", u"\\t").replace(u"\n", u"\\n").replace(u"\r", u"\\r")
+    return value
+
+def _copy_line(values):
+    """
+    Render a row (a sequence of values) as an UTF-8 encoded COPY text line.
+    """
+    return u"\t".join([_copy_value(value) for value in values]).encode("utf-8") + "\n"
+
+class TableBulkWriter(object):
+    """
+    Buffer rows for a single table and stream them to PostgreSQL in batches.
+
+    Every batch is sent as one COPY FROM STDIN statement over a raw DBAPI
+    connection, which avoids a database round trip for every single row.
+    Rows are either dicts (write(), keys which do not correspond to a table
+    column are ignored) or tuples in the order of the table fields
+    (write_values(), additional trailing values are ignored). If commit is
+    False, the batches become part of the transaction the connection is
+    currently in.
+    """
+    def __init__(self, dbapi_connection, table, fields, batch_size=DEFAULT_BATCH_SIZE, commit=True):
+        self.connection = dbapi_connection
+        self.commit = commit
+        self.table_name = table.name
+        self.columns = [field_name for (field_name, _) in fields]
+        self.batch_size = batch_size
+        self.buffer = []
+        self.num_rows = 0
+        self.elapsed = 0.0
+        preparer = table.bind.dialect.identifier_preparer
+        column_list = ", ".join([preparer.quote(column) for column in self.columns])
+        self.copy_statement = "COPY {} ({}) FROM STDIN".format(preparer.format_table(table), column_list)
+
+    def write(self, row):
+        self.write_values(tuple([row.get(column) for column in self.columns]))
+
+    def write_values(self, values):
+        self.buffer.append(values)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        start = time.time()
+        with PROFILER.stage("COPY " + self.table_name, len(self.buffer)):
+            data = StringIO()
+            num_columns = len(self.columns)
+            for values in self.buffer:
+                data.write(_copy_line(values[:num_columns]))
+            data.seek(0)
+            cursor = self.connection.cursor()
+            cursor.copy_expert(self.copy_statement, data)
+            cursor.close()
+            if self.commit:
+                self.connection.commit()
+        self.num_rows += len(self.buffer)
+        self.buffer = []
+        self.elapsed += time.time() - start
+
+def _print_bulk_load_report(writers):
+    print "Bulk load summary:"
+    for writer in sorted(writers, key=lambda w: w.num_rows, reverse=True):
+        rate = writer.num_rows / writer.elapsed if writer.elapsed > 0 else 0.0
+        msg = u"{}: {} rows in {:.2f}s ({:.0f} rows/s)"
+        print msg.format(writer.table_name.ljust(40), writer.num_rows, writer.elapsed, rate)
+
+def _fan_out_tables(connectable, source_tables, combined_table, institution_tables):
+    """
+    Derive the combined and the institution tables from the raw tables.
+
+    Used in the 'server' load mode: The raw rows were written only once into
+    the openapc and offsetting tables, the database takes care of distributing
+    them further using set-based INSERT ... SELECT statements.
+
+    Args:
+        connectable: An SQLAlchemy engine or connection
+        source_tables: A dict containing the "openapc" and "offsetting" tables
+        combined_table: The (empty) combined table
+        institution_tables: A dict mapping institution names to their (empty) tables
+    """
+    openapc_table = source_tables["openapc"]
+    offsetting_table = source_tables["offsetting"]
+    with connectable.begin() as connection:
+        columns = [field_name for (field_name, _) in APC_FIELDS + KEY_FIELDS]
+        select = sqlalchemy.select([openapc_table.c[column] for column in columns])
+        connection.execute(combined_table.insert().from_select(columns, select))
+        # offsetting articles only enter the combined table if cost data is available
+        select = sqlalchemy.select([offsetting_table.c[column] for column in columns])
+        select = select.where(offsetting_table.c.euro != None)
+        connection.execute(combined_table.insert().from_select(columns, select))
+        for institution, table in institution_tables.iteritems():
+            _fill_institution_table(connection, openapc_table, table, institution)
+
+def _fill_institution_table(connection, openapc_table, institution_table, institution):
+    columns = [field_name for (field_name, _) in APC_FIELDS]
+    select = sqlalchemy.select([openapc_table.c[column] for column in columns])
+    select = select.where(openapc_table.c.institution == institution)
+    connection.execute(institution_table.insert().from_select(columns, select))
+
+def _read_institution_countries(file_name):
+    countries = {}
+    reader = UnicodeReader(open(file_name, "rb"))
+    for row in reader:
+        countries[row["institution"]] = row["country"]
+    return countries
+
+def _institution_cubes_names():
+    return [row["institution_cubes_name"] for row in UnicodeReader(open("static/institutions.csv", "rb"))]
+
+def _open_coverage_cache():
+    """
+    Open the persistent cache holding journal coverage stats and article publication years.
 
+    Returns:
+        A CoverageCache instance (see coverage_cache.py)
+    """
+    try:
+        return oc.open_cache()
+    except IOError as ioe:
+        msg = "Error while trying to cache file: {}"
+        print msg.format(ioe)
+        sys.exit()
+    except ValueError as ve:
+        msg = "Error while trying to decode cache structure in: {}"
+        print msg.format(ve.message)
+        sys.exit()
+
+def _row_key(values, doi, source, key_counts):
+    """
+    Create a natural key and a content hash for a row.
+
+    The key is derived from the DOI. Further rows with the DOI of an earlier
+    row and rows without a DOI are identified by their content hash, so keys
+    do not depend on the position of a row. Only rows with identical content
+    are numbered.
+
+    Args:
+        values: The row values in table field order, used for the content hash
+        doi: The DOI of the row
+        source: The name of the source table ("openapc" or "offsetting")
+        key_counts: A dict to keep track of already assigned keys
+
+    Returns:
+        A tuple (row_key, row_hash)
+    """
+    content = u"\x1f".join([u"" if value is None else unicode(value) for value in values])
+    row_hash = hashlib.md5(content.encode("utf-8")).hexdigest()
+    if doi and doi != "NA":
+        key = source + ":" + doi.lower()
+        if key in key_counts:
+            key += "#" + row_hash
+    else:
+        key = source + ":hash:" + row_hash
+    count = key_counts.get(key, 0) + 1
+    key_counts[key] = count
+    if count > 1:
+        key += "#" + str(count)
+    return (key, row_hash)
+
+def _strip_colons(values):
+    # colons cannot be escaped in URL queries to the cubes server, so we have
+    # to remove them here
+    stripped = {}
+    result = []
+    for value in values:
+        if value not in stripped:
+            stripped[value] = value.replace(":", "") if value is not None else None
+        result.append(stripped[value])
+    return result
+
+def _prepare_batch(batch, source, fields, institution_countries, institutions_file, key_counts):
+    """
+    Prepare a batch of CSV rows (see util.CSVBatchReader) for loading.
+
+    Journal titles are stripped of colons, the country is looked up from the
+    institution and, for offsetting rows, "NA" amounts become NULL. The row
+    key and hash (see KEY_FIELDS) are appended to every row.
+
+    Returns:
+        A list of tuples in the order fields + KEY_FIELDS
+    """
+    columns = dict(batch.columns)
+    columns["journal_full_title"] = _strip_colons(columns["journal_full_title"])
+    try:
+        columns["country"] = [institution_countries[institution] for institution in columns["institution"]]
+    except KeyError as ke:
+        msg = u"KeyError: The institution '{}' was not found in the {} file!"
+        print msg.format(ke.args[0], institutions_file)
+        sys.exit()
+    if source == "offsetting":
+        columns["euro"] = [None if euro == "NA" else euro for euro in columns["euro"]]
+    rows = zip(*[columns[field_name] for field_name, _ in fields])
+    dois = columns["doi"]
+    return [row + _row_key(row, doi, source, key_counts) for row, doi in zip(rows, dois)]
+
+def _read_csv_batches(file_name, fields):
+    """
+    Read a CSV file in batches, providing all given fields except "country".
+    """
+    csv_fields = [field_name for field_name, _ in fields if field_name != "country"]
+    return CSVBatchReader(open(file_name, "rb"), csv_fields)
+
+def _offsetting_pub_year(issn, doi, period, coverage_cache, warn=True):
+    pub_year = coverage_cache.get_pub_year(issn, doi)
+    if pub_year is None:
+        if warn:
+            msg = ("Publication year entry not found in article cache for {}. " +
+                   "You might have to update the article cache with 'python " +
+                   "assets_generator.py coverage_stats'. Using the 'period' " +
+                   "column for now.")
+            print colorise(msg.format(doi), "yellow")
+        return period
+    return pub_year
+
+def _summarise_offsetting_row(row, coverage_cache, summarised_offsetting):
+    """
+    Count a Springer Nature offsetting row by journal and publication year.
+
+    Args:
+        row: The row values in the order OFFSETTING_FIELDS + KEY_FIELDS
+    """
+    publisher = row[OFFSETTING_INDEXES["publisher"]]
+    if publisher != "Springer Nature":
+        return
+    issn = row[OFFSETTING_INDEXES["issn"]]
+    doi = row[OFFSETTING_INDEXES["doi"]]
+    period = row[OFFSETTING_INDEXES["period"]]
+    pub_year = _offsetting_pub_year(issn, doi, period, coverage_cache)
+    if publisher not in summarised_offsetting:
+        summarised_offsetting[publisher] = {}
+    if issn not in summarised_offsetting[publisher]:
+        summarised_offsetting[publisher][issn] = {}
+    if pub_year not in summarised_offsetting[publisher][issn]:
+        summarised_offsetting[publisher][issn][pub_year] = 1
+    else:
+        summarised_offsetting[publisher][issn][pub_year] += 1
+
+def _offsetting_coverage_row(publisher, issn, pub_year, count, title, coverage_cache):
+    row = {
+        "publisher": publisher,
+        "journal_full_title": title,
+        "period": pub_year,
+        "is_hybrid": "TRUE",
+        "num_offsetting_articles": count
+    }
+    try:
+        stats = coverage_cache.get_coverage(issn, pub_year)
+        row["num_journal_total_articles"] = stats["num_journal_total_articles"]
+        row["num_journal_oa_articles"] = stats["num_journal_oa_articles"]
+    except KeyError as ke:
+        msg = ("KeyError: No coverage stats found for journal '{}' " +
+               "({}) in the {} period. Update the crossref cache with " +
+               "'python assets_generator.py crossref_stats'.")
+        print colorise(msg.format(title, issn, pub_year), "red")
+        sys.exit()
+    return row
+
+def _create_row_key_indexes(connectable, tables):
+    for table in tables:
+        index = sqlalchemy.Index(_index_name(table.name, ["row_key"]), table.c.row_key)
+        index.create(bind=connectable)
+
+def _coverage_cache_fingerprint():
+    """
+    Hash the coverage cache files, the offsetting_coverage table is derived from them.
+    """
+    fingerprint = hashlib.sha1()
+    for file_name in [oc.COVERAGE_CACHE_FILE, oc.PUBDATES_CACHE_FILE]:
+        if os.path.isfile(file_name):
+            with open(file_name, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), ""):
+                    fingerprint.update(chunk)
+        fingerprint.update("\0")
+    return fingerprint.hexdigest()
+
+def _read_load_state(connectable, schema=LIVE_SCHEMA):
+    """
+    Read the load state table (see LOAD_STATE_FIELDS).
+
+    Returns:
+        A dict, empty if the tables were loaded without a load state.
+    """
+    if not connectable.has_table(LOAD_STATE_TABLE, schema=schema):
+        return {}
+    table = sqlalchemy.Table(LOAD_STATE_TABLE, sqlalchemy.MetaData(bind=connectable), autoload=True, schema=schema)
+    return {row["name"]: row["value"] for row in connectable.execute(sqlalchemy.select([table.c.name, table.c.value]))}
+
+def _write_load_state(connection, state, schema=LIVE_SCHEMA):
+    """
+    Replace the content of the load state table, creating it if necessary.
+    """
+    metadata = sqlalchemy.MetaData(bind=connection)
+    if connection.dialect.has_table(connection, LOAD_STATE_TABLE, schema=schema):
+        table = sqlalchemy.Table(LOAD_STATE_TABLE, metadata, autoload=True, schema=schema)
+    else:
+        table = sqlalchemy.Table(LOAD_STATE_TABLE, metadata, autoload=False, schema=schema)
+        init_table(table, LOAD_STATE_FIELDS)
+    connection.execute(table.delete())
+    connection.execute(table.insert(), [{"name": name, "value": value} for name, value in state.iteritems()])
+
+def create_cubes_tables(connectable, apc_file_name, offsetting_file_name, schema=LIVE_SCHEMA,
+                        batch_size=DEFAULT_BATCH_SIZE, load_mode="client", incremental=False, single_cube=False,
+                        generation=None):
+    """
+    Create and populate all cube tables.
+
+    With single_cube, no institution tables are created (existing ones are
+    dropped), the institution cubes are served from the openapc table. The
+    data generation the tables will be published with is recorded in the
+    load state table.
+
+    Returns:
+        None after a full load, the changes made by an incremental update
+        (see update_cubes_tables()) otherwise.
+    """
+    if incremental:
+        return update_cubes_tables(connectable, apc_file_name, offsetting_file_name, schema, batch_size, single_cube,
+                                   generation)
+    
     metadata = sqlalchemy.MetaData(bind=connectable)
     
+    dbapi_connection = connectable.raw_connection()
+
     openapc_table = sqlalchemy.Table("openapc", metadata, autoload=False, schema=schema)
     if openapc_table.exists():
         openapc_table.drop(checkfirst=False)
-    init_table(openapc_table, apc_fields)
-    openapc_insert_command = openapc_table.insert()
+    init_table(openapc_table, APC_FIELDS + KEY_FIELDS)
     
     offsetting_table = sqlalchemy.Table("offsetting", metadata, autoload=False, schema=schema)
     if offsetting_table.exists():
         offsetting_table.drop(checkfirst=False)
-    init_table(offsetting_table, offsetting_fields)
-    offsetting_insert_command = offsetting_table.insert()
+    init_table(offsetting_table, OFFSETTING_FIELDS + KEY_FIELDS)
     
     combined_table = sqlalchemy.Table("combined", metadata, autoload=False, schema=schema)
     if combined_table.exists():
         combined_table.drop(checkfirst=False)
-    init_table(combined_table, apc_fields)
-    combined_insert_command = combined_table.insert()
+    init_table(combined_table, APC_FIELDS + KEY_FIELDS)
     
     offsetting_coverage_table = sqlalchemy.Table("offsetting_coverage", metadata, autoload=False, schema=schema)
     if offsetting_coverage_table.exists():
         offsetting_coverage_table.drop(checkfirst=False)
-    init_table(offsetting_coverage_table, offsetting_coverage_fields)
-    offsetting_coverage_insert_command = offsetting_coverage_table.insert()
-    
-    # a dict to store individual insert commands for every table
-    tables_insert_commands = {
-        "openapc": openapc_insert_command,
-        "offsetting": offsetting_insert_command,
-        "combined": combined_insert_command,
-        "offsetting_coverage": offsetting_coverage_insert_command
-    }
+    init_table(offsetting_coverage_table, OFFSETTING_COVERAGE_FIELDS)
     
-    offsetting_institution_countries = {}
+    # a dict to store individual bulk writers for every table
+    table_writers = {
+        "openapc": TableBulkWriter(dbapi_connection, openapc_table, APC_FIELDS + KEY_FIELDS, batch_size),
+        "offsetting": TableBulkWriter(dbapi_connection, offsetting_table, OFFSETTING_FIELDS + KEY_FIELDS,
+                                      batch_size),
+        "combined": TableBulkWriter(dbapi_connection, combined_table, APC_FIELDS + KEY_FIELDS, batch_size),
+        "offsetting_coverage": TableBulkWriter(dbapi_connection, offsetting_coverage_table,
+                                               OFFSETTING_COVERAGE_FIELDS, batch_size)
+    }
     
-    reader = UnicodeReader(open("static/institutions_offsetting.csv", "rb"))
-    for row in reader:
-        institution_name = row["institution"]
-        country = row["country"]
-        offsetting_institution_countries[institution_name] = country
-        
-    journal_coverage = None
-    article_pubyears = None
-    try:
-        cache_file = open(oc.COVERAGE_CACHE_FILE, "r")
-        journal_coverage = json.loads(cache_file.read())
-        cache_file.close()
-        cache_file = open(oc.PUBDATES_CACHE_FILE, "r")
-        article_pubyears = json.loads(cache_file.read())
-        cache_file.close()
-    except IOError as ioe:
-        msg = "Error while trying to cache file: {}"
-        print msg.format(ioe)
-        sys.exit()
-    except ValueError as ve:
-        msg = "Error while trying to decode cache structure in: {}"
-        print msg.format(ve.message)
-        sys.exit()
+    institution_tables = {}
+    with PROFILER.stage("load institution files"):
+        offsetting_institution_countries = _read_institution_countries("static/institutions_offsetting.csv")
+    with PROFILER.stage("load coverage caches"):
+        coverage_cache = _open_coverage_cache()
+        coverage_fingerprint = _coverage_cache_fingerprint()
     
     summarised_offsetting = {}
     issn_title_map = {}
+    key_counts = {}
     
-    reader = UnicodeReader(open(offsetting_file_name, "rb"))
-    for row in reader:
-        institution = row["institution"]
-        publisher = row["publisher"]
-        is_hybrid = row["is_hybrid"]
-        issn = row["issn"]
-        doi = row["doi"]
-        # colons cannot be escaped in URL queries to the cubes server, so we have
-        # to remove them here
-        row["journal_full_title"] = row["journal_full_title"].replace(":", "")
-        title = row["journal_full_title"]
-        try:
-            row["country"] = offsetting_institution_countries[institution]
-        except KeyError as ke:
-            msg = (u"KeyError: The institution '{}' was not found in the institutions_offsetting file!")
-            print msg.format(institution)
-            sys.exit()
-        tables_insert_commands["offsetting"].execute(row)
-        if row["euro"] != "NA":
-            tables_insert_commands["combined"].execute(row)
-        
-        issn_title_map[issn] = title
-        
-        if publisher != "Springer Nature":
-            continue
-            
-        try:
-            pub_year = article_pubyears[issn][doi]
-        except KeyError:
-            msg = ("Publication year entry not found in article cache for {}. " +
-                   "You might have to update the article cache with 'python " +
-                   "assets_generator.py coverage_stats'. Using the 'period' " +
-                   "column for now.")
-            print colorise(msg.format(doi), "yellow")
-            pub_year = row["period"]
-        
-        if publisher not in summarised_offsetting:
-            summarised_offsetting[publisher] = {}
-        if issn not in summarised_offsetting[publisher]:
-            summarised_offsetting[publisher][issn] = {}
-        if pub_year not in summarised_offsetting[publisher][issn]:
-            summarised_offsetting[publisher][issn][pub_year] = 1
-        else:
-            summarised_offsetting[publisher][issn][pub_year] += 1
-    
-    for publisher, issns in summarised_offsetting.iteritems():
-        for issn, pub_years in issns.iteritems():
-            for pub_year, count in pub_years.iteritems():
-                    row = {
-                        "publisher": publisher,
-                        "journal_full_title": issn_title_map[issn],
-                        "period": pub_year,
-                        "is_hybrid": "TRUE",
-                        "num_offsetting_articles": count
-                    }
-                    try:
-                        stats = journal_coverage[issn][pub_year]
-                        row["num_journal_total_articles"] = stats["num_journal_total_articles"]
-                        row["num_journal_oa_articles"] = stats["num_journal_oa_articles"]
-                    except KeyError as ke:
-                        msg = ("KeyError: No coverage stats found for journal '{}' " +
-                               "({}) in the {} period. Update the crossref cache with " +
-                               "'python assets_generator.py crossref_stats'.")
-                        print colorise(msg.format(issn_title_map[issn], issn, pub_year), "red")
-                        sys.exit()
-                    tables_insert_commands["offsetting_coverage"].execute(row)
+    euro_index, issn_index, title_index = [OFFSETTING_INDEXES[name] for name in ["euro", "issn", "journal_full_title"]]
+    for batch in _read_csv_batches(offsetting_file_name, OFFSETTING_FIELDS):
+        with PROFILER.stage("offsetting inserts") as stage:
+            rows = _prepare_batch(batch, "offsetting", OFFSETTING_FIELDS, offsetting_institution_countries,
+                                  "institutions_offsetting", key_counts)
+            for row in rows:
+                table_writers["offsetting"].write_values(row)
+                # OFFSETTING_FIELDS and APC_FIELDS share the same field order
+                if row[euro_index] is not None and load_mode == "client":
+                    table_writers["combined"].write_values(row)
+                issn_title_map[row[issn_index]] = row[title_index]
+            stage.items += len(rows)
+        with PROFILER.stage("summarise offsetting", len(rows)):
+            for row in rows:
+                _summarise_offsetting_row(row, coverage_cache, summarised_offsetting)
+    
+    with PROFILER.stage("offsetting coverage inserts") as stage:
+        for publisher, issns in summarised_offsetting.iteritems():
+            for issn, pub_years in issns.iteritems():
+                for pub_year, count in pub_years.iteritems():
+                    row = _offsetting_coverage_row(publisher, issn, pub_year, count, issn_title_map[issn],
+                                                   coverage_cache)
+                    table_writers["offsetting_coverage"].write(row)
+                    stage.items += 1
     
     institution_countries = {}
     
+    with PROFILER.stage("load institution files"):
+        reader = UnicodeReader(open("static/institutions.csv", "rb"))
+        for row in reader:
+            cubes_name = row["institution_cubes_name"]
+            institution_name = row["institution"]
+            country = row["country"]
+            institution_countries[institution_name] = country
+            if institution_name not in table_writers:
+                table = sqlalchemy.Table(cubes_name, metadata, autoload=False, schema=schema)
+                if table.exists():
+                    table.drop(checkfirst=False)
+                if single_cube:
+                    continue
+                init_table(table, APC_FIELDS)
+                institution_tables[institution_name] = table
+                table_writers[institution_name] = TableBulkWriter(dbapi_connection, table, APC_FIELDS, batch_size)
+    
+    institution_index = APC_INDEXES["institution"]
+    for batch in _read_csv_batches(apc_file_name, APC_FIELDS):
+        with PROFILER.stage("APC inserts") as stage:
+            rows = _prepare_batch(batch, "openapc", APC_FIELDS, institution_countries, "institutions", key_counts)
+            for row in rows:
+                table_writers["openapc"].write_values(row)
+                if load_mode == "client":
+                    if not single_cube:
+                        table_writers[row[institution_index]].write_values(row)
+                    table_writers["combined"].write_values(row)
+            stage.items += len(rows)
+    
+    with PROFILER.stage("final flush"):
+        for writer in table_writers.values():
+            writer.flush()
+    dbapi_connection.close()
+    _print_bulk_load_report([w for w in table_writers.values() if w.num_rows > 0])
+    
+    if load_mode == "server":
+        print "Deriving combined and institution tables inside the database..."
+        start = time.time()
+        source_tables = {"openapc": openapc_table, "offsetting": offsetting_table}
+        _fan_out_tables(connectable, source_tables, combined_table, institution_tables)
+        print "Done ({:.2f}s).".format(time.time() - start)
+    _create_row_key_indexes(connectable, [openapc_table, offsetting_table, combined_table])
+    with connectable.begin() as connection:
+        _write_load_state(connection, {"generation": generation, "coverage_cache": coverage_fingerprint}, schema)
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def update_cubes_tables(connectable, apc_file_name, offsetting_file_name, schema=LIVE_SCHEMA,
+                        batch_size=DEFAULT_BATCH_SIZE, single_cube=False, generation=None):
+    """
+    Incrementally bring already loaded cube tables up to date.
+
+    The incoming rows are compared to the loaded ones using their natural key
+    (derived from the DOI) and a content hash. Only new, changed and deleted
+    rows are written to the openapc, offsetting and combined tables, only
+    the tables of affected institutions are rebuilt and only the affected
+    offsetting_coverage rows are recomputed - all of them if the coverage
+    cache files changed since the last load. All changes (and the new load
+    state) are applied in a single transaction.
+
+    The tables must have been created by a full load (create_cubes_tables())
+    before.
+
+    Returns:
+        A dict describing the changes: "rows" maps the openapc, offsetting
+        and combined tables to the deleted and inserted rows (as dicts, for
+        update_rollup_tables()), "tables" is the set of changed tables and
+        "previous_generation" the data generation of the tables before the
+        update (None if unknown).
+    """
+    metadata = sqlalchemy.MetaData(bind=connectable)
+    tables = {}
+    for name in ["openapc", "offsetting", "combined", "offsetting_coverage"]:
+        if not connectable.has_table(name, schema=schema):
+            msg = "ERROR: Table '{}' not found, a full load is required before incremental updates are possible."
+            print msg.format(name)
+            sys.exit()
+        tables[name] = sqlalchemy.Table(name, metadata, autoload=True, schema=schema)
+        if name != "offsetting_coverage" and "row_key" not in tables[name].c:
+            msg = "ERROR: Table '{}' has no row keys, a full load is required before incremental updates are possible."
+            print msg.format(name)
+            sys.exit()
+    
+    load_state = _read_load_state(connectable, schema)
+    
+    with PROFILER.stage("load institution files"):
+        offsetting_institution_countries = _read_institution_countries("static/institutions_offsetting.csv")
+    with PROFILER.stage("load coverage caches"):
+        coverage_cache = _open_coverage_cache()
+        coverage_fingerprint = _coverage_cache_fingerprint()
+    # publication years and journal statistics may have changed for any offsetting_coverage row
+    recompute_coverage = load_state.get("coverage_cache") != coverage_fingerprint
+    if recompute_coverage:
+        print "The coverage caches changed since the last load, all offsetting_coverage rows will be recomputed."
+    
+    incoming = {"openapc": OrderedDict(), "offsetting": OrderedDict()}
+    summarised_offsetting = {}
+    issn_title_map = {}
+    key_counts = {}
+    offsetting_names = [field_name for field_name, _ in OFFSETTING_FIELDS + KEY_FIELDS]
+    for batch in _read_csv_batches(offsetting_file_name, OFFSETTING_FIELDS):
+        rows = _prepare_batch(batch, "offsetting", OFFSETTING_FIELDS, offsetting_institution_countries,
+                              "institutions_offsetting", key_counts)
+        for values in rows:
+            row = dict(zip(offsetting_names, values))
+            incoming["offsetting"][row["row_key"]] = row
+            issn_title_map[row["issn"]] = row["journal_full_title"]
+            _summarise_offsetting_row(values, coverage_cache, summarised_offsetting)
+    
+    institution_countries = {}
+    institution_cubes_names = {}
     reader = UnicodeReader(open("static/institutions.csv", "rb"))
     for row in reader:
-        cubes_name = row["institution_cubes_name"]
-        institution_name = row["institution"]
-        country = row["country"]
-        institution_countries[institution_name] = country
-        if institution_name not in tables_insert_commands:
+        institution_countries[row["institution"]] = row["country"]
+        institution_cubes_names[row["institution"]] = row["institution_cubes_name"]
+    apc_names = [field_name for field_name, _ in APC_FIELDS + KEY_FIELDS]
+    for batch in _read_csv_batches(apc_file_name, APC_FIELDS):
+        rows = _prepare_batch(batch, "openapc", APC_FIELDS, institution_countries, "institutions", key_counts)
+        for values in rows:
+            row = dict(zip(apc_names, values))
+            incoming["openapc"][row["row_key"]] = row
+    
+    deltas = {}
+    for source in ["openapc", "offsetting"]:
+        table = tables[source]
+        columns = [table.c.row_key, table.c.row_hash, table.c.institution, table.c.publisher,
+                   table.c.issn, table.c.doi, table.c.period, table.c.journal_full_title, table.c.is_hybrid]
+        existing = {}
+        for row in connectable.execute(sqlalchemy.select(columns)):
+            existing[row["row_key"]] = row
+        new = incoming[source]
+        removed = [key for key, row in existing.iteritems()
+                   if key not in new or new[key]["row_hash"] != row["row_hash"]]
+        added = [key for key, row in new.iteritems()
+                 if key not in existing or existing[key]["row_hash"] != row["row_hash"]]
+        deltas[source] = (existing, removed, added)
+        num_updates = len(set(removed) & set(added))
+        msg = "{}: {} inserts, {} updates, {} deletes"
+        print msg.format(source, len(added) - num_updates, num_updates, len(removed) - num_updates)
+    
+    existing, removed, added = deltas["openapc"]
+    affected_institutions = set([existing[key]["institution"] for key in removed])
+    affected_institutions |= set([incoming["openapc"][key]["institution"] for key in added])
+    institution_tables = {}
+    for institution in affected_institutions:
+        if single_cube or institution not in institution_cubes_names:
+            continue
+        cubes_name = institution_cubes_names[institution]
+        if connectable.has_table(cubes_name, schema=schema):
+            table = sqlalchemy.Table(cubes_name, metadata, autoload=True, schema=schema)
+        else:
             table = sqlalchemy.Table(cubes_name, metadata, autoload=False, schema=schema)
+            init_table(table, APC_FIELDS)
+        institution_tables[institution] = table
+    
+    # offsetting_coverage rows are identified by publisher, journal title and period
+    existing, removed, added = deltas["offsetting"]
+    affected_coverage = set()
+    for key in removed:
+        row = existing[key]
+        if row["publisher"] == "Springer Nature":
+            pub_year = _offsetting_pub_year(row["issn"], row["doi"], row["period"], coverage_cache, warn=False)
+            affected_coverage.add((row["publisher"], row["journal_full_title"], pub_year))
+    for key in added:
+        row = incoming["offsetting"][key]
+        if row["publisher"] == "Springer Nature":
+            pub_year = _offsetting_pub_year(row["issn"], row["doi"], row["period"], coverage_cache, warn=False)
+            affected_coverage.add((row["publisher"], row["journal_full_title"], pub_year))
+    
+    grain_columns = set([column for _, grain in ROLLUP_GRAINS for column in grain])
+    changed_rows = {}
+    changed_tables = set([table.name for table in institution_tables.values()])
+    for source in ["openapc", "offsetting"]:
+        existing, removed, added = deltas[source]
+        rows = [existing[key] for key in removed] + [incoming[source][key] for key in added]
+        changed_rows[source] = [{column: row[column] for column in grain_columns} for row in rows]
+        if rows:
+            changed_tables.update([source, "combined"])
+    # a superset, offsetting rows without costs are not part of the combined table
+    changed_rows["combined"] = changed_rows["openapc"] + changed_rows["offsetting"]
+    if affected_coverage or recompute_coverage:
+        changed_tables.add("offsetting_coverage")
+    
+    start = time.time()
+    with connectable.begin() as connection:
+        dbapi_connection = connection.connection
+        combined_table = tables["combined"]
+        combined_writer = TableBulkWriter(dbapi_connection, combined_table, APC_FIELDS + KEY_FIELDS,
+                                          batch_size, commit=False)
+        for source, fields in [("openapc", APC_FIELDS), ("offsetting", OFFSETTING_FIELDS)]:
+            existing, removed, added = deltas[source]
+            table = tables[source]
+            for keys in _chunks(removed, 1000):
+                connection.execute(table.delete().where(table.c.row_key.in_(keys)))
+                connection.execute(combined_table.delete().where(combined_table.c.row_key.in_(keys)))
+            writer = TableBulkWriter(dbapi_connection, table, fields + KEY_FIELDS, batch_size, commit=False)
+            for key in added:
+                row = incoming[source][key]
+                writer.write(row)
+                if source == "openapc" or row["euro"] is not None:
+                    combined_writer.write(row)
+            writer.flush()
+        combined_writer.flush()
+        
+        for institution, table in institution_tables.iteritems():
+            connection.execute(table.delete())
+            _fill_institution_table(connection, tables["openapc"], table, institution)
+        
+        coverage_table = tables["offsetting_coverage"]
+        if recompute_coverage:
+            connection.execute(coverage_table.delete())
+        for (publisher, title, period) in affected_coverage:
+            connection.execute(coverage_table.delete().where(sqlalchemy.and_(
+                coverage_table.c.publisher == publisher,
+                coverage_table.c.journal_full_title == title,
+                coverage_table.c.period == period
+            )))
+        coverage_writer = TableBulkWriter(dbapi_connection, coverage_table, OFFSETTING_COVERAGE_FIELDS,
+                                          batch_size, commit=False)
+        for publisher, issns in summarised_offsetting.iteritems():
+            for issn, pub_years in issns.iteritems():
+                for pub_year, count in pub_years.iteritems():
+                    if not recompute_coverage and (publisher, issn_title_map[issn], pub_year) not in affected_coverage:
+                        continue
+                    row = _offsetting_coverage_row(publisher, issn, pub_year, count, issn_title_map[issn],
+                                                   coverage_cache)
+                    coverage_writer.write(row)
+        coverage_writer.flush()
+        _write_load_state(connection, {"generation": generation, "coverage_cache": coverage_fingerprint}, schema)
+    msg = "Changes applied in {:.2f}s ({} institution tables and {} coverage entries updated)."
+    num_coverage_entries = coverage_writer.num_rows if recompute_coverage else len(affected_coverage)
+    print msg.format(time.time() - start, len(institution_tables), num_coverage_entries)
+    return {
+        "rows": changed_rows,
+        "tables": changed_tables,
+        "previous_generation": load_state.get("generation")
+    }
+
+def convert_to_star_schema(connectable, schema=LIVE_SCHEMA, single_cube=False):
+    """
+    Convert the flat fact tables into a dictionary-encoded star schema.
+
+    The distinct publishers, journals (together with their ISSNs), institutions
+    and countries are moved to dimension tables (see STAR_DIMENSIONS) with
+    small integer surrogate keys. Every APC and offsetting fact table is then
+    rebuilt, referencing the dimension tables by key. All other columns,
+    including period and is_hybrid, keep their types, so the API returns the
+    same values as for the flat layout. The rollup tables and the
+    offsetting_coverage table keep their flat layout.
+    """
+    metadata = sqlalchemy.MetaData(bind=connectable)
+    preparer = connectable.dialect.identifier_preparer
+    def qualified(table_name):
+        return preparer.quote_schema(schema) + "." + preparer.quote(table_name)
+    fact_tables = ["openapc", "offsetting", "combined"]
+    if not single_cube:
+        fact_tables += _institution_cubes_names()
+    moved_columns = set()
+    for _, _, _, natural_key, attributes in STAR_DIMENSIONS:
+        moved_columns.add(natural_key)
+        moved_columns.update(attributes)
+    print "Converting fact tables to star layout..."
+    start = time.time()
+    with connectable.begin() as connection:
+        for table_name, key_column, key_type, natural_key, attributes in STAR_DIMENSIONS:
+            columns = [natural_key] + attributes
+            column_definitions = ", ".join(["{} VARCHAR(512)".format(column) for column in columns])
+            connection.execute("DROP TABLE IF EXISTS {}".format(qualified(table_name)))
+            connection.execute("CREATE TABLE {} (id {} PRIMARY KEY, {}, UNIQUE ({}))".format(
+                qualified(table_name), key_type, column_definitions, natural_key))
+            sources = " UNION ALL ".join(["SELECT {} FROM {}".format(", ".join(columns), qualified(source))
+                                          for source in ["openapc", "offsetting"]])
+            aggregated = ", ".join([natural_key] + ["max({})".format(column) for column in attributes])
+            statement = ("INSERT INTO {} (id, {}) SELECT row_number() OVER (ORDER BY {}), {} " +
+                         "FROM ({}) AS source WHERE {} IS NOT NULL GROUP BY {}")
+            connection.execute(statement.format(qualified(table_name), ", ".join(columns), natural_key,
+                                                aggregated, sources, natural_key, natural_key))
+        for table_name in fact_tables:
+            table = sqlalchemy.Table(table_name, metadata, autoload=True, schema=schema)
+            select_list = []
+            joins = []
+            for column in table.columns:
+                if column.name not in moved_columns:
+                    select_list.append("f." + preparer.quote(column.name))
+            for i, (dim_table, key_column, _, natural_key, _) in enumerate(STAR_DIMENSIONS):
+                select_list.append("d{}.id AS {}".format(i, key_column))
+                joins.append("LEFT OUTER JOIN {} d{} ON d{}.{} = f.{}".format(
+                    qualified(dim_table), i, i, natural_key, natural_key))
+            star_table_name = table_name + "__star"
+            connection.execute("CREATE TABLE {} AS SELECT {} FROM {} f {}".format(
+                qualified(star_table_name), ", ".join(select_list), qualified(table_name), " ".join(joins)))
+            connection.execute("DROP TABLE {}".format(qualified(table_name)))
+            connection.execute("ALTER TABLE {} RENAME TO {}".format(
+                qualified(star_table_name), preparer.quote(table_name)))
+    print "Done ({:.2f}s).".format(time.time() - start)
+
+def _index_name(table_name, columns):
+    """
+    Create a deterministic index name which respects PostgreSQL's identifier
+    length limit (63 bytes).
+    """
+    name = "ix_" + table_name + "_" + "_".join(columns)
+    if len(name) > 63:
+        digest = hashlib.md5(name).hexdigest()[:8]
+        name = name[:54] + "_" + digest
+    return name
+
+def _read_treemap_template():
+    """
+    Extract filter fields and drilldown hierarchies from the YAML template.
+
+    The template is not parsed with a full YAML implementation, only the
+    "filters" and "hierarchies" sections are evaluated.
+
+    Returns:
+        A tuple (filters, hierarchies). filters is a list of field names,
+        hierarchies a list of lists of drilldown levels.
+    """
+    filters = []
+    hierarchies = []
+    section = None
+    in_drilldowns = False
+    with open("static/templates/YAML_STATIC_PART", "r") as yaml:
+        for line in yaml:
+            stripped = line.strip()
+            if not stripped:
+                continue
+            if not line[0].isspace():
+                section = stripped.rstrip(":")
+                in_drilldowns = False
+                continue
+            if section == "filters" and stripped.startswith("- field:"):
+                filters.append(stripped.split(":", 1)[1].strip().strip("'\""))
+            elif section == "hierarchies":
+                if stripped == "drilldowns:":
+                    in_drilldowns = True
+                    hierarchies.append([])
+                elif in_drilldowns and stripped.startswith("- "):
+                    hierarchies[-1].append(stripped[2:].strip())
+                else:
+                    in_drilldowns = False
+    return (filters, hierarchies)
+
+def derive_index_definitions(model, filters, hierarchies):
+    """
+    Derive the indexes required by every cube in a model.
+
+    For every drilldown hierarchy, a composite index is created on the
+    treemap filter fields followed by the first hierarchy level (like
+    (period, is_hybrid, publisher)), followed by one composite index for every
+    deeper hierarchy prefix (like (publisher, journal_full_title)). All other
+    dimension attributes which are not the leading column of any of these
+    indexes get a single-column index. Attributes which are summed up as
+    aggregate measures are skipped.
+
+    Args:
+        model: The cubes model as dict (see build_model())
+        filters: A list of filter fields (see _read_treemap_template())
+        hierarchies: A list of drilldown hierarchies (see _read_treemap_template())
+
+    Returns:
+        A dict mapping table names to lists of column tuples.
+    """
+    dimension_attributes = {}
+    for dimension in model["dimensions"]:
+        dimension_attributes[dimension["name"]] = dimension.get("attributes", [dimension["name"]])
+    indexes = {}
+    for cube in model["cubes"]:
+        measures = [aggregate.get("measure") for aggregate in cube.get("aggregates", [])
+                    if aggregate.get("function") != "count"]
+        # attributes mapped to a joined table are indexed via the join key column
+        join_columns = {}
+        for join in cube.get("joins", []):
+            join_columns[join["detail"].split(".")[0]] = join["master"]
+        mappings = cube.get("mappings", {})
+        def column_of(attribute):
+            if attribute in mappings:
+                return join_columns.get(mappings[attribute].split(".")[0], attribute)
+            return attribute
+        columns = []
+        for dimension in cube["dimensions"]:
+            for attribute in dimension_attributes.get(dimension, [dimension]):
+                if attribute not in measures and column_of(attribute) not in columns:
+                    columns.append(column_of(attribute))
+        filter_columns = [column_of(field) for field in filters]
+        definitions = []
+        for hierarchy in hierarchies:
+            levels = [column_of(level) for level in hierarchy if column_of(level) in columns]
+            if not levels:
+                continue
+            if all([column in columns for column in filter_columns]):
+                definitions.append(tuple(filter_columns + [levels[0]]))
+            for i in range(2, len(levels) + 1):
+                definitions.append(tuple(levels[:i]))
+        leading_columns = [definition[0] for definition in definitions]
+        for column in columns:
+            if column not in leading_columns:
+                definitions.append((column,))
+        unique_definitions = []
+        for definition in definitions:
+            if definition not in unique_definitions:
+                unique_definitions.append(definition)
+        indexes[cube["name"]] = unique_definitions
+    return indexes
+
+def _format_size(num_bytes):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if num_bytes < 1024 or unit == "GB":
+            return "{:.1f} {}".format(num_bytes, unit)
+        num_bytes /= 1024.0
+
+def create_cube_indexes(connectable, model, schema=LIVE_SCHEMA, analyze=False, single_cube=False, tables=None):
+    """
+    Create B-tree indexes on the cube fact tables as derived from the model.
+
+    The model dimensions and the treemap YAML hierarchies and filters define
+    the indexes (see derive_index_definitions()). Already existing indexes are
+    kept. A report listing all created indexes and their sizes is printed
+    afterwards.
+
+    Args:
+        connectable: An SQLAlchemy engine or connection
+        model: The cubes model as dict (see build_model())
+        schema: The database schema containing the fact tables
+        analyze: Bool. If True, ANALYZE is run on every indexed table.
+        single_cube: Bool. If True, the openapc table additionally gets the
+                     treemap indexes led by the institution column, which
+                     serve the queries to all institution cubes.
+        tables: Only index (and analyze) these tables, like the tables changed
+                by an incremental update. None for all tables.
+    """
+    filters, hierarchies = _read_treemap_template()
+    index_definitions = derive_index_definitions(model, filters, hierarchies)
+    if single_cube and "openapc" in index_definitions:
+        institution_definitions = derive_index_definitions(model, ["institution"] + filters, hierarchies)["openapc"]
+        for definition in institution_definitions:
+            if definition not in index_definitions["openapc"]:
+                index_definitions["openapc"].append(definition)
+    metadata = sqlalchemy.MetaData(bind=connectable)
+    created = []
+    print "Creating indexes..."
+    start = time.time()
+    for table_name in sorted(index_definitions.keys()):
+        if tables is not None and table_name not in tables:
+            continue
+        table = sqlalchemy.Table(table_name, metadata, autoload=True, schema=schema)
+        existing_indexes = [index.name for index in table.indexes]
+        for columns in index_definitions[table_name]:
+            if not all([column in table.c for column in columns]):
+                continue
+            name = _index_name(table_name, columns)
+            if name in existing_indexes:
+                continue
+            index = sqlalchemy.Index(name, *[table.c[column] for column in columns])
+            index.create(bind=connectable)
+            created.append((table_name, name))
+        if analyze:
+            preparer = connectable.dialect.identifier_preparer
+            with connectable.begin() as connection:
+                connection.execute("ANALYZE " + preparer.format_table(table))
+    print "{} indexes created in {:.2f}s.".format(len(created), time.time() - start)
+    query = sqlalchemy.text("SELECT relname, indexrelname, pg_relation_size(indexrelid) " +
+                            "FROM pg_stat_user_indexes WHERE schemaname = :schema")
+    sizes = {}
+    for (table_name, index_name, size) in connectable.execute(query, schema=schema):
+        sizes[(table_name, index_name)] = size
+    total_size = 0
+    print "Index report:"
+    for (table_name, index_name) in created:
+        size = sizes.get((table_name, index_name), 0)
+        total_size += size
+        print u"{} {} {}".format(table_name.ljust(30), index_name.ljust(64), _format_size(size).rjust(10))
+    print "Total index size: " + _format_size(total_size)
+
+def _snapshot_tables(single_cube=False):
+    """
+    List the fact tables contained in a snapshot.
+
+    Returns:
+        A list of tuples (table_name, fields)
+    """
+    tables = [("openapc", APC_FIELDS), ("offsetting", OFFSETTING_FIELDS), ("combined", APC_FIELDS),
+              ("offsetting_coverage", OFFSETTING_COVERAGE_FIELDS)]
+    if not single_cube:
+        tables += [(cubes_name, APC_FIELDS) for cubes_name in _institution_cubes_names()]
+    return tables
+
+def write_table_snapshot(connectable, path, generation, schema=LIVE_SCHEMA, single_cube=False, previous=None):
+    """
+    Write a columnar snapshot of all flat fact tables (see snapshot.py).
+
+    Snapshots can only be taken from the flat layout, so the tables job calls
+    this before a conversion to the star layout.
+
+    Args:
+        connectable: An SQLAlchemy engine
+        path: The path of the snapshot file
+        generation: The data generation identifier to embed
+        schema: The schema containing the tables
+        single_cube: Bool. If True, institution tables are not included
+        previous: A tuple (snapshot path, changed tables) after an incremental
+                  update or None. Tables which did not change are copied
+                  from the previous snapshot instead of being read from the
+                  database.
+
+    Returns:
+        True if the snapshot was written, False if the tables are not in the
+        flat layout.
+    """
+    metadata = sqlalchemy.MetaData(bind=connectable)
+    tables = []
+    start = time.time()
+    previous_snapshot = None
+    if previous is not None:
+        previous_path, changed_tables = previous
+        previous_snapshot = Snapshot(previous_path)
+    num_copied = 0
+    for table_name, fields in _snapshot_tables(single_cube):
+        if (previous_snapshot is not None and table_name not in changed_tables and
+                table_name in previous_snapshot.table_names()):
+            columns = [(field_name, field_type, previous_snapshot.values(table_name, field_name))
+                       for field_name, field_type in fields]
+            tables.append((table_name, previous_snapshot.num_rows(table_name), columns))
+            num_copied += 1
+            continue
+        if not connectable.has_table(table_name, schema=schema):
+            continue
+        table = sqlalchemy.Table(table_name, metadata, autoload=True, schema=schema)
+        if not all([field_name in table.c for field_name, _ in fields]):
+            print colorise("Table '{}' is not in the flat layout, no snapshot written.".format(table_name), "yellow")
+            return False
+        rows = connectable.execute(sqlalchemy.select([table.c[field_name] for field_name, _ in fields])).fetchall()
+        columns = [(field_name, field_type, [row[i] for row in rows])
+                   for i, (field_name, field_type) in enumerate(fields)]
+        tables.append((table_name, len(rows), columns))
+    write_snapshot(path, tables, generation)
+    msg = "Snapshot of {} tables ({} copied from the previous snapshot) written to {} ({}, {:.2f}s)."
+    print msg.format(len(tables), num_copied, path, _format_size(os.path.getsize(path)), time.time() - start)
+    return True
+
+def _rollup_table_name(source, grain_name):
+    return source + "_by_" + grain_name
+
+def _rollup_query(source_table, source, grain):
+    """
+    Build the aggregation of a source table for a rollup grain.
+
+    Returns:
+        A tuple (fields, select), fields being the rollup table fields
+    """
+    fields = [(column, "string") for column in grain]
+    columns = [source_table.c[column] for column in grain]
+    if source == "offsetting":
+        fields.append(("num_items", "integer"))
+        aggregates = [sqlalchemy.func.count(source_table.c.journal_full_title)]
+    else:
+        fields += [("euro_sum", "float"), ("euro_count", "integer"), ("euro_sum_squares", "float"),
+                   ("euro_sketch", "sketch")]
+        euro = source_table.c.euro
+        aggregates = [sqlalchemy.func.sum(euro), sqlalchemy.func.count(euro),
+                      sqlalchemy.func.sum(euro * euro), sqlalchemy.func.public.apc_sketch(euro)]
+    return (fields, sqlalchemy.select(columns + aggregates).group_by(*columns))
+
+def create_rollup_tables(connectable, schema=LIVE_SCHEMA):
+    """
+    Pre-aggregate the fact tables for the most common drilldown grains.
+
+    For every combination of ROLLUP_SOURCES and ROLLUP_GRAINS a rollup table
+    is created using a set-based INSERT ... SELECT ... GROUP BY. APC rollups
+    store the sum, the count and the sum of squares of the euro column, so
+    that exact mean values and standard deviations can still be computed for
+    any combination of rollup cells, and a quantile sketch of the euro column
+    (see quantile_sketch.py) for medians and percentiles. The offsetting
+    rollups only store the number of articles.
+    """
+    metadata = sqlalchemy.MetaData(bind=connectable)
+    print "Creating rollup tables..."
+    start = time.time()
+    create_sketch_functions(connectable)
+    for source in ROLLUP_SOURCES:
+        source_table = sqlalchemy.Table(source, metadata, autoload=True, schema=schema)
+        for grain_name, grain in ROLLUP_GRAINS:
+            fields, select = _rollup_query(source_table, source, grain)
+            name = _rollup_table_name(source, grain_name)
+            table = sqlalchemy.Table(name, metadata, autoload=False, schema=schema)
             if table.exists():
                 table.drop(checkfirst=False)
-            init_table(table, apc_fields)
-            insert_command = table.insert()
-            tables_insert_commands[institution_name] = insert_command
-    
-    reader = UnicodeReader(open(apc_file_name, "rb"))
-    for row in reader:
-        institution = row["institution"]
-        # colons cannot be escaped in URL queries to the cubes server, so we have
-        # to remove them here
-        row["journal_full_title"] = row["journal_full_title"].replace(":", "")
-        row["country"] = institution_countries[institution]
-        tables_insert_commands[institution].execute(row)
-        tables_insert_commands["openapc"].execute(row)
-        tables_insert_commands["combined"].execute(row)
-
-def generate_model_file(path):
+            init_table(table, fields)
+            with connectable.begin() as connection:
+                connection.execute(table.insert().from_select([f[0] for f in fields], select))
+    print "Done ({:.2f}s).".format(time.time() - start)
+
+def _cells_filter(columns, cells):
+    # NULL values have to be compared with IS NULL, so no tuple IN (...) here
+    return sqlalchemy.or_(*[sqlalchemy.and_(*[column == value for column, value in zip(columns, cell)])
+                            for cell in cells])
+
+def update_rollup_tables(connectable, changed_rows, schema=LIVE_SCHEMA):
+    """
+    Refresh the rollup cells affected by an incremental update.
+
+    Only the cells of every rollup table whose grain values occur in the
+    deleted or inserted rows of its source are deleted and aggregated again.
+    Missing rollup tables are created from scratch (see create_rollup_tables()).
+
+    Args:
+        connectable: An SQLAlchemy engine
+        changed_rows: A dict mapping the ROLLUP_SOURCES to lists of changed
+                      rows (the "rows" of the update_cubes_tables() result)
+        schema: The schema containing the tables
+    """
+    metadata = sqlalchemy.MetaData(bind=connectable)
+    for source in ROLLUP_SOURCES:
+        for grain_name, _ in ROLLUP_GRAINS:
+            if not connectable.has_table(_rollup_table_name(source, grain_name), schema=schema):
+                create_rollup_tables(connectable, schema)
+                return
+    print "Updating rollup tables..."
+    start = time.time()
+    num_cells = 0
+    with connectable.begin() as connection:
+        for source in ROLLUP_SOURCES:
+            source_table = sqlalchemy.Table(source, metadata, autoload=True, schema=schema)
+            for grain_name, grain in ROLLUP_GRAINS:
+                cells = sorted(set([tuple([row[column] for column in grain]) for row in changed_rows[source]]))
+                num_cells += len(cells)
+                table = sqlalchemy.Table(_rollup_table_name(source, grain_name), metadata, autoload=True,
+                                         schema=schema)
+                fields, select = _rollup_query(source_table, source, grain)
+                for chunk in _chunks(cells, 500):
+                    connection.execute(table.delete().where(_cells_filter([table.c[c] for c in grain], chunk)))
+                    cell_select = select.where(_cells_filter([source_table.c[c] for c in grain], chunk))
+                    connection.execute(table.insert().from_select([f[0] for f in fields], cell_select))
+    print "{} rollup cells refreshed in {:.2f}s.".format(num_cells, time.time() - start)
+
+def _model_entry(**kwargs):
+    """
+    Create an OrderedDict for a model entry, keeping the key order used in
+    the model templates.
+    """
+    key_order = ["name", "label", "info", "measures", "measure", "function", "aggregates",
+                 "implicit_aggregates", "dimensions"]
+    entry = OrderedDict()
+    for key in key_order:
+        if key in kwargs:
+            entry[key] = kwargs[key]
+    return entry
+
+def _rollup_cubes():
+    """
+    Create the cube definitions for all rollup tables.
+
+    Every rollup cube offers the same aggregates as its source cube. Mean values
+    and standard deviations are derived from the stored sums, counts and sums
+    of squares (see aggregate_functions.RollupMomentFunction), medians and
+    percentiles are read from the merged quantile sketches. The rollup cubes
+    carry an "info" entry naming their source cube and grain, which is used
+    by the server to route matching queries (see olap_middleware.RollupRouter).
+    """
+    cubes = []
+    for source in ROLLUP_SOURCES:
+        for grain_name, grain in ROLLUP_GRAINS:
+            name = _rollup_table_name(source, grain_name)
+            label = "{} cube, pre-aggregated by {}".format(source, ", ".join(grain))
+            info = OrderedDict([("rollup_of", source), ("grain", grain)])
+            if source == "offsetting":
+                measures = [_model_entry(name="num_items", label="Number of Articles")]
+                aggregates = [
+                    _model_entry(name="num_items", label="Number of Articles",
+                                 measure="num_items", function="sum")
+                ]
+            else:
+                measures = [
+                    _model_entry(name="euro_sum", label="APC Amount Sum"),
+                    _model_entry(name="euro_count", label="APC Amount Count"),
+                    _model_entry(name="euro_sum_squares", label="APC Amount Sum of Squares"),
+                    _model_entry(name="euro_sketch", label="APC Amount Quantile Sketch")
+                ]
+                aggregates = [
+                    _model_entry(name="apc_amount_sum", label="Sum", measure="euro_sum", function="sum"),
+                    _model_entry(name="apc_num_items", label="Number of Articles",
+                                 measure="euro_count", function="sum"),
+                    _model_entry(name="apc_amount_sum_squares", label="Sum of Squares",
+                                 measure="euro_sum_squares", function="sum"),
+                    _model_entry(name="apc_amount_avg", label="Mean Value", measure="euro_sum",
+                                 function="rollup_avg"),
+                    _model_entry(name="apc_amount_stddev", label="Standard Deviation", measure="euro_sum",
+                                 function="rollup_stddev"),
+                    _model_entry(name="apc_amount_median", label="Median", measure="euro_sketch",
+                                 function="sketch_median"),
+                    _model_entry(name="apc_amount_p90", label="90th Percentile", measure="euro_sketch",
+                                 function="sketch_p90")
+                ]
+            # without implicit_aggregates, cubes would add a sum aggregate for every stored measure
+            cubes.append(_model_entry(name=name, label=label, info=info, measures=measures,
+                                      aggregates=aggregates, implicit_aggregates=False, dimensions=grain))
+    return cubes
+
+def build_model(layout="flat", single_cube=False):
+    """
+    Assemble the cubes model from the templates and the institutions file.
+
+    Args:
+        layout: The table layout, "flat" or "star" (see convert_to_star_schema())
+        single_cube: Bool. If True, no cubes are created for the institutions
+
+    Returns:
+        The model as JSON-formatted unicode string.
+    """
     content = u""
     with open("static/templates/MODEL_FIRST_PART", "r") as model:
         content += model.read()
@@ -317,19 +1565,55 @@ def generate_model_file(path):
     with open("static/templates/MODEL_CUBE_STATIC_PART", "r") as model:
         static_part = model.read()
 
-    reader = UnicodeReader(open("static/institutions.csv", "rb"))
-    for row in reader:
-        content += u"        ,\n        {\n"
-        content += u'            "name": "{}",\n'.format((row["institution_cubes_name"]))
-        content += u'            "label": "{} openAPC data cube",\n'.format((row["institution_full_name"]))
-        content += static_part
+    # with a single cube, the institution cubes are served from the openapc cube by the server
+    if not single_cube:
+        reader = UnicodeReader(open("static/institutions.csv", "rb"))
+        for row in reader:
+            content += u"        ,\n        {\n"
+            content += u'            "name": "{}",\n'.format((row["institution_cubes_name"]))
+            content += u'            "label": "{} openAPC data cube",\n'.format((row["institution_full_name"]))
+            content += static_part
         
     with open("static/templates/MODEL_LAST_PART", "r") as model:
-        content += model.read()
-    
+        last_part = model.read()
+    # The rollup cubes are appended to the end of the cubes list
+    cubes_end = last_part.rindex('    ],\n    "dimensions"')
+    content += last_part[:cubes_end]
+    for cube in _rollup_cubes():
+        cube_json = json.dumps(cube, indent=4, separators=(',', ': '))
+        content += u"        ,\n" + u"\n".join([u"        " + line for line in cube_json.splitlines()]) + u"\n"
+    content += last_part[cubes_end:]
+    if layout == "star":
+        model = json.loads(content, object_pairs_hook=OrderedDict)
+        for cube in model["cubes"]:
+            if "institution" in cube["dimensions"] and "rollup_of" not in cube.get("info", {}):
+                _add_star_mappings(cube)
+        content = json.dumps(model, indent=4, separators=(',', ': '), ensure_ascii=False) + u"\n"
+    return content
+
+def _add_star_mappings(cube):
+    """
+    Add the joins and mappings of the star layout to a fact cube definition.
+    """
+    joins = []
+    mappings = OrderedDict()
+    for table_name, key_column, _, natural_key, attributes in STAR_DIMENSIONS:
+        # "master" keeps fact rows without a matching dimension entry (LEFT OUTER JOIN)
+        joins.append(OrderedDict([("master", key_column), ("detail", table_name + ".id"), ("method", "master")]))
+        if natural_key in cube["dimensions"]:
+            mappings[natural_key] = table_name + "." + natural_key
+    cube["joins"] = joins
+    cube["mappings"] = mappings
+
+def generate_model_file(path, layout="flat", single_cube=False):
+    content = build_model(layout, single_cube)
     output_file = os.path.join(path, "model.json")
     with open(output_file, "w") as model:
         model.write(content.encode("utf-8"))
+    # precompiled index for the lazy model provider of the server (see lazy_model.py)
+    index = compile_model_index(json.loads(content, object_pairs_hook=OrderedDict))
+    with open(os.path.join(path, MODEL_INDEX_FILE), "w") as index_file:
+        index_file.write(json.dumps(index, separators=(",", ":")))
         
 def generate_yamls(path):
     with open("static/templates/YAML_STATIC_PART", "r") as yaml:
@@ -356,5 +1640,142 @@ def generate_yamls(path):
             outfile.write(content.encode("utf-8"))
 
 
+# Cubes with treemaps which are not generated from the institutions file
+STATIC_EXPORT_CUBES = ["openapc", "combined"]
+
+def treemap_aggregates(browser, filters, hierarchies, base_cuts=None):
+    """
+    Run all aggregate queries the treemaps can request from a cube.
+
+    All combinations of filter values (including unset filters) are queried
+    at every hierarchy level, with cuts on every member of the levels above.
+    Queries are run lazily, one for every item taken from the generator.
+
+    Args:
+        browser: A cubes aggregation browser for the cube
+        filters: A list of filter fields (see _read_treemap_template())
+        hierarchies: A list of lists of drilldown levels
+        base_cuts: A list of (dimension, value) cuts applied to all queries,
+                   but not part of the returned cut strings (used to query
+                   institution cubes which are served from the openapc cube)
+
+    Returns:
+        A generator of tuples (drilldown, cut_string, result)
+    """
+    from cubes import Cell, cuts_from_string
+
+    def cut_string_of(cuts):
+        return u"|".join([u"{}:{}".format(dim, escape_cut_value(value)) for dim, value in cuts])
+
+    def aggregate(drilldown, cuts):
+        cut_string = cut_string_of(cuts)
+        query_cut_string = cut_string_of((base_cuts or []) + cuts)
+        cell = Cell(browser.cube, cuts_from_string(browser.cube, query_cut_string) if query_cut_string else [])
+        result = browser.aggregate(cell, drilldown=[drilldown])
+        result.cells = list(result.cells)
+        return (drilldown, cut_string, result)
+
+    def drill(hierarchy, level, cuts):
+        query = aggregate(hierarchy[level], cuts)
+        yield query
+        if level + 1 < len(hierarchy):
+            for cell in query[2].cells:
+                member = cell[hierarchy[level]]
+                if member is not None:
+                    for subquery in drill(hierarchy, level + 1, cuts + [(hierarchy[level], unicode(member))]):
+                        yield subquery
+
+    filter_combinations = [[]]
+    for filter_field in filters:
+        query = aggregate(filter_field, [])
+        yield query
+        values = [None] + [unicode(cell[filter_field]) for cell in query[2].cells if cell[filter_field] is not None]
+        filter_combinations = [combination + [(filter_field, value)]
+                               for combination in filter_combinations for value in values]
+    for combination in filter_combinations:
+        cuts = [(field, value) for field, value in combination if value is not None]
+        for hierarchy in hierarchies:
+            for query in drill(hierarchy, 0, cuts):
+                yield query
+
+def treemap_cubes(model):
+    """
+    List all cubes with treemaps and how to query them.
+
+    Institution cubes which are not part of the model (see the single_cube
+    option of build_model()) are queried on the openapc cube with a cut on
+    the institution.
+
+    Returns:
+        A list of tuples (cube_name, model_cube_name, base_cuts)
+    """
+    model_cubes = [cube["name"] for cube in model["cubes"]]
+    cubes = [(cube_name, cube_name, []) for cube_name in STATIC_EXPORT_CUBES]
+    reader = UnicodeReader(open("static/institutions.csv", "rb"))
+    for row in reader:
+        cube_name = row["institution_cubes_name"]
+        if cube_name in model_cubes:
+            cubes.append((cube_name, cube_name, []))
+        else:
+            cubes.append((cube_name, "openapc", [("institution", row["institution"])]))
+    for cube_name, model_cube_name, _ in cubes:
+        if model_cube_name not in model_cubes:
+            print colorise(u"Cube {} not found in the model, skipping.".format(model_cube_name), "yellow")
+    return [cube for cube in cubes if cube[1] in model_cubes]
+
+def export_static_aggregates(path, config_path="slicer.ini", single_cube=False):
+    """
+    Precompute all aggregate responses requested by the treemaps.
+
+    The treemap YAMLs define a fixed drilldown hierarchy and a fixed set of
+    filters, so the set of possible aggregate queries is finite (see
+    treemap_aggregates()). The queries run directly against the configured
+    store.
+
+    The responses are written to
+    <path>/cube/<cube>/aggregate/<normalized query string>.json, so a web server
+    can serve them for requests using the canonical query form (see
+    olap_middleware.normalize_query_string()).
+    """
+    from cubes import Workspace
+    from cubes.server.utils import SlicerJSONEncoder
+    from aggregate_functions import register_aggregate_functions
+    import lazy_model # registers the "lazy" model provider
+    from olap_middleware import normalize_query_string
+    
+    register_aggregate_functions()
+    workspace = Workspace(config=config_path)
+    filters, hierarchies = _read_treemap_template()
+    model = json.loads(build_model(single_cube=single_cube))
+    
+    stats = {"queries": 0, "skipped": 0}
+    start = time.time()
+    
+    for cube_name, model_cube_name, base_cuts in treemap_cubes(model):
+        print u"Exporting aggregates for cube {}...".format(cube_name)
+        browser = workspace.browser(model_cube_name)
+        for drilldown, cut_string, result in treemap_aggregates(browser, filters, hierarchies, base_cuts):
+            params = [("drilldown", drilldown)]
+            if cut_string:
+                params.append(("cut", cut_string.encode("utf-8")))
+            query_string = normalize_query_string(urllib.urlencode(params))
+            stats["queries"] += 1
+            if stats["queries"] % 1000 == 0:
+                msg = "{} queries exported ({:.0f} queries/s)"
+                print msg.format(stats["queries"], stats["queries"] / (time.time() - start))
+            out_dir = os.path.join(path, "cube", cube_name, "aggregate")
+            out_file_name = query_string + ".json"
+            if len(out_file_name) > 255:
+                # too long for most file systems, will be answered by the live server
+                stats["skipped"] += 1
+                continue
+            if not os.path.isdir(out_dir):
+                os.makedirs(out_dir)
+            with open(os.path.join(out_dir, out_file_name), "w") as out_file:
+                out_file.write(json.dumps(result, cls=SlicerJSONEncoder))
+    msg = "Done. {} queries exported in {:.2f}s, {} responses skipped due to file name length."
+    print msg.format(stats["queries"], time.time() - start, stats["skipped"])
+
+
 if __name__ == '__main__':
     main()
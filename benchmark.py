@@ -0,0 +1,507 @@
+#!/usr/bin/env python
+
+import argparse
+from bisect import bisect
+import ConfigParser
+import csv
+import datetime
+import hashlib
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+import assets_generator as ag
+from util import DEFAULT_CSV_BATCH_SIZE, CSVBatchReader, UnicodeReader, colorise
+
+# Number of rows of the synthetic data files at scale 1, roughly the size of
+# the real data files. Keep these fixed, results are only comparable to
+# baselines which were measured on the same data.
+BASE_APC_ROWS = 70000
+BASE_OFFSETTING_ROWS = 15000
+
+SCALES = [1, 10, 100]
+
+# Number of synthetic publishers besides Springer Nature and journals per publisher
+SYNTHETIC_PUBLISHERS = 60
+SYNTHETIC_JOURNALS_PER_PUBLISHER = 40
+
+SYNTHETIC_PERIODS = range(2005, 2019)
+
+BENCHMARK_SCHEMA = ag.LIVE_SCHEMA + "_benchmark"
+BENCHMARK_DATA_DIR = "benchmark_data"
+BENCHMARK_RESULTS_FILE = "benchmark_results.json"
+
+ARG_HELP_STRINGS = {
+    "input": "The OpenAPC CSV file to read during the ingest benchmark. Defaults " +
+             "to the core data file (apc_de.csv).",
+    "repetitions": "Number of timed runs per variant. The best run is reported.",
+    "batch_size": "Number of CSV lines per batch for the batch reader.",
+    "scales": "Scale factors of the synthetic data (multiples of the current " +
+              "data size) for the generate and run jobs.",
+    "seed": "Random seed for the synthetic data. Use the same seed for runs " +
+            "which should be compared.",
+    "dir": "Directory for the synthetic data files and generated assets.",
+    "output": "Path of the JSON results file written by the run job.",
+    "compare": "Path of a results file from an earlier run (a baseline). Every " +
+               "metric which got slower by more than the tolerance is reported " +
+               "as a regression and the job exits with status 1.",
+    "tolerance": "Allowed slowdown relative to the baseline (0.2 = 20%%).",
+    "max_queries": "Maximum number of treemap aggregate queries replayed per cube.",
+    "config": "The slicer configuration to take the store settings from. The " +
+              "schema is replaced with the benchmark schema."
+}
+
+def _load_institution_countries():
+    institution_countries = {}
+    reader = UnicodeReader(open("static/institutions.csv", "rb"))
+    for row in reader:
+        institution_countries[row["institution"]] = row["country"]
+    return institution_countries
+
+def _read_rows(file_name, batch_size):
+    num_rows = 0
+    for batch in CSVBatchReader(open(file_name, "rb"), batch_size=batch_size):
+        num_rows += len(batch)
+    return num_rows
+
+def _legacy_read_rows(file_name):
+    num_rows = 0
+    for row in UnicodeReader(open(file_name, "rb")):
+        num_rows += 1
+    return num_rows
+
+def _ingest_rows(file_name, institution_countries, batch_size):
+    """
+    The ingest path of the tables job: CSV batches, batch preparation and COPY rendering.
+
+    Returns:
+        The number of rows processed
+    """
+    key_counts = {}
+    num_rows = 0
+    reader = CSVBatchReader(open(file_name, "rb"), [name for name, _ in ag.APC_FIELDS if name != "country"],
+                            batch_size)
+    for batch in reader:
+        rows = ag._prepare_batch(batch, "openapc", ag.APC_FIELDS, institution_countries, "institutions", key_counts)
+        for row in rows:
+            ag._copy_line(row)
+        num_rows += len(rows)
+    return num_rows
+
+def _legacy_ingest_rows(file_name, institution_countries):
+    """
+    The previous ingest path: one decoded dict per row, prepared and rendered row by row.
+
+    Returns:
+        The number of rows processed
+    """
+    key_counts = {}
+    num_rows = 0
+    columns = [name for name, _ in ag.APC_FIELDS + ag.KEY_FIELDS]
+    for row in UnicodeReader(open(file_name, "rb")):
+        row["journal_full_title"] = row["journal_full_title"].replace(":", "")
+        row["country"] = institution_countries[row["institution"]]
+        values = [row.get(name) for name, _ in ag.APC_FIELDS]
+        row["row_key"], row["row_hash"] = ag._row_key(values, row.get("doi"), "openapc", key_counts)
+        ag._copy_line([row.get(column) for column in columns])
+        num_rows += 1
+    return num_rows
+
+def _best_time(function, repetitions, *args):
+    timings = []
+    for _ in range(repetitions):
+        start = time.time()
+        result = function(*args)
+        timings.append(time.time() - start)
+    return min(timings), result
+
+def run_ingest_benchmark(file_name, repetitions, batch_size):
+    """
+    Compare the batch ingest path with the previous row-by-row path.
+
+    Both variants read the file, prepare every row (colon stripping, country
+    lookup, row key and hash) and render it in the COPY text format, but do
+    not access the database.
+    """
+    institution_countries = _load_institution_countries()
+    # (title, legacy function and arguments, batch function and arguments)
+    comparisons = [
+        ("Reading only", (_legacy_read_rows, [file_name]), (_read_rows, [file_name, batch_size])),
+        ("Reading, preparation and COPY rendering", (_legacy_ingest_rows, [file_name, institution_countries]),
+         (_ingest_rows, [file_name, institution_countries, batch_size]))
+    ]
+    for title, legacy_variant, batch_variant in comparisons:
+        print colorise(title, "blue")
+        variants = [
+            ("UnicodeReader (dict per row)", legacy_variant),
+            ("CSVBatchReader (batch size {})".format(batch_size), batch_variant)
+        ]
+        timings = []
+        for label, (variant_function, args) in variants:
+            elapsed, num_rows = _best_time(variant_function, repetitions, *args)
+            timings.append(elapsed)
+            msg = u"    {:<40} {:>8} rows in {:7.3f}s ({:>9.0f} rows/s)"
+            print msg.format(label, num_rows, elapsed, num_rows / elapsed if elapsed else 0)
+        if timings[1] > 0:
+            print colorise(u"    Speedup: {:.2f}x".format(timings[0] / timings[1]), "green")
+
+def _weighted_chooser(rng, items, weights):
+    """
+    Create a function which draws an item according to the given weights.
+    """
+    cumulative = []
+    total = 0.0
+    for weight in weights:
+        total += weight
+        cumulative.append(total)
+    return lambda: items[min(bisect(cumulative, rng.random() * total), len(items) - 1)]
+
+def _zipf_chooser(rng, items):
+    """
+    Create a function which draws items with a Zipf-like distribution.
+
+    Few items (like large institutions or publishers) are drawn very often,
+    most items only rarely. The ranks are assigned randomly.
+    """
+    items = list(items)
+    rng.shuffle(items)
+    return _weighted_chooser(rng, items, [1.0 / rank for rank in range(1, len(items) + 1)])
+
+def _read_column(file_name, column):
+    return [row[column] for row in UnicodeReader(open(file_name, "rb"))]
+
+def _springer_journals():
+    """
+    Read the Springer Nature journals known to the coverage caches.
+
+    Returns:
+        A tuple (journals, weights, articles). journals is a list of ISSNs,
+        weighted by their total number of articles in the coverage stats.
+        articles is a list of (issn, doi, pub_year) tuples from the
+        publication year cache.
+    """
+    with open(ag.oc.COVERAGE_CACHE_FILE, "r") as f:
+        coverage = json.loads(f.read())
+    with open(ag.oc.PUBDATES_CACHE_FILE, "r") as f:
+        pubdates = json.loads(f.read())
+    journals = sorted(coverage.keys())
+    weights = []
+    for issn in journals:
+        total = sum([stats.get("num_journal_total_articles", 0) for stats in coverage[issn].values()])
+        weights.append(max(total, 1))
+    articles = sorted([(issn, doi, pub_year) for issn, dois in pubdates.iteritems()
+                       for doi, pub_year in dois.iteritems()])
+    return (journals, weights, articles)
+
+def _synthetic_journal(publisher, number, issn):
+    title = u"{} Journal {}".format(publisher, number)
+    if number % 10 == 0:
+        # some titles contain colons, which are removed by the tables job
+        title += u": Letters"
+    return (publisher, title, issn)
+
+def generate_synthetic_data(path, scale, seed):
+    """
+    Generate synthetic apc_de.csv and offsetting.csv files.
+
+    Institutions are drawn from static/institutions.csv and
+    static/institutions_offsetting.csv with a Zipf-like distribution.
+    Springer Nature journals and offsetting articles (including their DOIs,
+    so publication years are found in the cache) are taken from the coverage
+    caches, weighted by their total number of articles. Journals of the other
+    publishers are synthetic. The output only depends on scale and seed.
+
+    Args:
+        path: The directory to write the files to
+        scale: Multiple of BASE_APC_ROWS and BASE_OFFSETTING_ROWS to generate
+        seed: The random seed
+
+    Returns:
+        A dict with the row counts and a checksum of the generated files
+    """
+    rng = random.Random(seed)
+    institution = _zipf_chooser(rng, _read_column("static/institutions.csv", "institution"))
+    offsetting_institution = _zipf_chooser(rng, _read_column("static/institutions_offsetting.csv", "institution"))
+    springer_issns, springer_weights, articles = _springer_journals()
+    springer_issn = _weighted_chooser(rng, springer_issns, springer_weights)
+    publishers = [u"Publisher {}".format(number) for number in range(1, SYNTHETIC_PUBLISHERS + 1)]
+    journals = {}
+    for publisher_index, publisher in enumerate(publishers):
+        journals[publisher] = [_synthetic_journal(publisher, number, u"{:04d}-{:04d}".format(publisher_index, number))
+                               for number in range(1, SYNTHETIC_JOURNALS_PER_PUBLISHER + 1)]
+    # Springer Nature is the largest publisher by far (about a quarter of all articles)
+    publisher_weights = [1.0 / rank for rank in range(1, len(publishers) + 1)]
+    publisher = _weighted_chooser(rng, [u"Springer Nature"] + publishers,
+                                  [sum(publisher_weights) / 3] + publisher_weights)
+    journal = {name: _zipf_chooser(rng, journal_list) for name, journal_list in journals.iteritems()}
+    # the number of articles grows over time
+    period = _weighted_chooser(rng, SYNTHETIC_PERIODS, [index + 1 for index in range(len(SYNTHETIC_PERIODS))])
+    fields = [field_name for field_name, _ in ag.APC_FIELDS if field_name != "country"]
+    checksum = hashlib.md5()
+
+    def write_rows(file_name, rows):
+        with open(os.path.join(path, file_name), "wb") as f:
+            writer = csv.writer(f)
+            writer.writerow(fields)
+            for row in rows:
+                line = [row.get(field, u"NA").encode("utf-8") for field in fields]
+                writer.writerow(line)
+                checksum.update("\x1f".join(line))
+
+    def apc_rows():
+        for number in xrange(BASE_APC_ROWS * scale):
+            row_publisher = publisher()
+            if row_publisher == u"Springer Nature":
+                issn = springer_issn()
+                title = u"Journal " + issn
+            else:
+                _, title, issn = journal[row_publisher]()
+            is_hybrid = rng.random() < 0.3
+            euro = rng.lognormvariate(7.8 if is_hybrid else 7.3, 0.4)
+            yield {
+                "institution": institution(),
+                "period": unicode(period()),
+                "euro": u"{:.2f}".format(euro),
+                "doi": u"NA" if rng.random() < 0.05 else u"10.99999/synthetic.apc.{}".format(number),
+                "is_hybrid": u"TRUE" if is_hybrid else u"FALSE",
+                "publisher": row_publisher,
+                "journal_full_title": title,
+                "issn": issn,
+                "issn_l": issn,
+                "license_ref": u"http://creativecommons.org/licenses/by/4.0",
+                "indexed_in_crossref": u"TRUE",
+                "doaj": u"FALSE" if is_hybrid else u"TRUE"
+            }
+
+    def offsetting_rows():
+        for number in xrange(BASE_OFFSETTING_ROWS * scale):
+            issn, doi, pub_year = articles[rng.randrange(len(articles))]
+            yield {
+                "institution": offsetting_institution(),
+                "period": pub_year,
+                "euro": u"NA",
+                "doi": doi,
+                "is_hybrid": u"TRUE",
+                "publisher": u"Springer Nature",
+                "journal_full_title": u"Journal " + issn,
+                "issn": issn,
+                "issn_l": issn,
+                "license_ref": u"http://creativecommons.org/licenses/by/4.0",
+                "indexed_in_crossref": u"TRUE",
+                "doaj": u"FALSE"
+            }
+
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    write_rows(ag.APC_DE_FILE, apc_rows())
+    write_rows(ag.OFFSETTING_FILE, offsetting_rows())
+    return {
+        "apc_rows": BASE_APC_ROWS * scale,
+        "offsetting_rows": BASE_OFFSETTING_ROWS * scale,
+        "checksum": checksum.hexdigest()
+    }
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+def _latency_stats(latencies):
+    latencies = sorted(latencies)
+    return {
+        "count": len(latencies),
+        "total": sum(latencies),
+        "mean": sum(latencies) / len(latencies) if latencies else None,
+        "p50": _percentile(latencies, 0.5),
+        "p90": _percentile(latencies, 0.9),
+        "p99": _percentile(latencies, 0.99),
+        "max": latencies[-1] if latencies else None
+    }
+
+def _timed(timings, name, function, *args, **kwargs):
+    print colorise(u"Running {}...".format(name), "blue")
+    start = time.time()
+    result = function(*args, **kwargs)
+    timings[name] = time.time() - start
+    print u"{} took {:.3f}s".format(name, timings[name])
+    return result
+
+def _benchmark_workspace(config_path, model_path, schema):
+    """
+    Create a cubes workspace using the store settings of a slicer configuration.
+
+    The store schema is replaced and snapshots are disabled, so queries are
+    answered from the benchmark tables.
+    """
+    from cubes import Workspace
+    config = ConfigParser.SafeConfigParser()
+    config.read(config_path)
+    config.set("store", "schema", schema)
+    config.remove_option("store", "snapshot")
+    if not config.has_section("model"):
+        config.add_section("model")
+    config.set("model", "path", model_path)
+    return Workspace(config=config)
+
+def replay_treemap_queries(workspace, model, max_queries):
+    """
+    Replay the treemap aggregate queries against every treemap cube and measure their latencies.
+
+    Returns:
+        A dict with latency statistics (in seconds) over all queries and per cube
+    """
+    filters, hierarchies = ag._read_treemap_template()
+    all_latencies = []
+    cubes = {}
+    for cube_name, model_cube_name, base_cuts in ag.treemap_cubes(model):
+        browser = workspace.browser(model_cube_name)
+        queries = ag.treemap_aggregates(browser, filters, hierarchies, base_cuts)
+        latencies = []
+        while len(latencies) < max_queries:
+            start = time.time()
+            try:
+                queries.next()
+            except StopIteration:
+                break
+            latencies.append(time.time() - start)
+        cubes[cube_name] = _latency_stats(latencies)
+        all_latencies += latencies
+    statistics = _latency_stats(all_latencies)
+    statistics["cubes"] = cubes
+    return statistics
+
+def run_scale_benchmark(path, scale, seed, config_path, max_queries):
+    """
+    Time the asset generation and the treemap queries on synthetic data of one scale.
+
+    The tables are created in BENCHMARK_SCHEMA, which is dropped and
+    re-created first. The live schema is not touched.
+
+    Returns:
+        A dict with the data description, timings (in seconds) and query latencies
+    """
+    data_path = os.path.join(path, "{}x".format(scale))
+    timings = {}
+    data = _timed(timings, "generate_synthetic_data", generate_synthetic_data, data_path, scale, seed)
+    engine = ag._create_db_engine()
+    ag.create_staging_schema(engine, schema=BENCHMARK_SCHEMA)
+    apc_file = os.path.join(data_path, ag.APC_DE_FILE)
+    offsetting_file = os.path.join(data_path, ag.OFFSETTING_FILE)
+    _timed(timings, "create_cubes_tables", ag.create_cubes_tables, engine, apc_file, offsetting_file,
+           schema=BENCHMARK_SCHEMA)
+    _timed(timings, "create_rollup_tables", ag.create_rollup_tables, engine, schema=BENCHMARK_SCHEMA)
+    model = json.loads(ag.build_model())
+    _timed(timings, "create_cube_indexes", ag.create_cube_indexes, engine, model, schema=BENCHMARK_SCHEMA)
+    with engine.begin() as connection:
+        connection.execute("GRANT USAGE ON SCHEMA {} TO cubes_user".format(BENCHMARK_SCHEMA))
+        connection.execute("GRANT SELECT ON ALL TABLES IN SCHEMA {} TO cubes_user".format(BENCHMARK_SCHEMA))
+    _timed(timings, "generate_model_file", ag.generate_model_file, data_path)
+    yaml_path = os.path.join(data_path, "yamls")
+    if not os.path.isdir(yaml_path):
+        os.makedirs(yaml_path)
+    _timed(timings, "generate_yamls", ag.generate_yamls, yaml_path)
+    workspace = _benchmark_workspace(config_path, os.path.join(data_path, "model.json"), BENCHMARK_SCHEMA)
+    queries = _timed(timings, "treemap_queries", replay_treemap_queries, workspace, model, max_queries)
+    return {"data": data, "timings": timings, "queries": queries}
+
+def _git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare_results(results, baseline, tolerance):
+    """
+    Compare benchmark results to a baseline.
+
+    Load timings and the mean, p50 and p90 query latencies are compared for
+    every scale present in both results.
+
+    Returns:
+        The number of regressions (metrics slower than baseline * (1 + tolerance))
+    """
+    regressions = 0
+    for scale, result in sorted(results["scales"].items()):
+        if scale not in baseline["scales"]:
+            print colorise(u"Scale {}x is not part of the baseline, skipping.".format(scale), "yellow")
+            continue
+        baseline_result = baseline["scales"][scale]
+        if baseline_result["data"]["checksum"] != result["data"]["checksum"]:
+            msg = u"Scale {}x: The synthetic data differs from the baseline data, results are not comparable."
+            print colorise(msg.format(scale), "yellow")
+        print colorise(u"Scale {}x (baseline: revision {})".format(scale, baseline.get("revision")), "blue")
+        metrics = [(name, result["timings"][name], baseline_result["timings"].get(name))
+                   for name in sorted(result["timings"])]
+        metrics += [("query " + name, result["queries"][name], baseline_result["queries"].get(name))
+                    for name in ["mean", "p50", "p90"]]
+        for name, value, baseline_value in metrics:
+            if value is None or not baseline_value:
+                continue
+            ratio = value / baseline_value
+            line = u"    {:<28} {:10.4f}s {:10.4f}s {:+7.1f}%".format(name, baseline_value, value, (ratio - 1) * 100)
+            if ratio > 1 + tolerance:
+                regressions += 1
+                print colorise(line + u"  REGRESSION", "red")
+            else:
+                print line
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("job", choices=["ingest", "generate", "run"])
+    parser.add_argument("-i", "--input", default=ag.APC_DE_FILE, help=ARG_HELP_STRINGS["input"])
+    parser.add_argument("-r", "--repetitions", type=int, default=3, help=ARG_HELP_STRINGS["repetitions"])
+    parser.add_argument("-b", "--batch_size", type=int, default=DEFAULT_CSV_BATCH_SIZE, help=ARG_HELP_STRINGS["batch_size"])
+    parser.add_argument("-s", "--scales", type=int, nargs="+", choices=SCALES, default=[1], help=ARG_HELP_STRINGS["scales"])
+    parser.add_argument("--seed", type=int, default=1, help=ARG_HELP_STRINGS["seed"])
+    parser.add_argument("-d", "--dir", default=BENCHMARK_DATA_DIR, help=ARG_HELP_STRINGS["dir"])
+    parser.add_argument("-o", "--output", default=BENCHMARK_RESULTS_FILE, help=ARG_HELP_STRINGS["output"])
+    parser.add_argument("-c", "--compare", help=ARG_HELP_STRINGS["compare"])
+    parser.add_argument("-t", "--tolerance", type=float, default=0.2, help=ARG_HELP_STRINGS["tolerance"])
+    parser.add_argument("-q", "--max_queries", type=int, default=500, help=ARG_HELP_STRINGS["max_queries"])
+    parser.add_argument("--config", default="slicer.ini", help=ARG_HELP_STRINGS["config"])
+    args = parser.parse_args()
+
+    if args.repetitions < 1:
+        print "Error: The number of repetitions must be at least 1"
+        sys.exit()
+    if args.job == "ingest":
+        run_ingest_benchmark(args.input, args.repetitions, args.batch_size)
+    elif args.job == "generate":
+        for scale in args.scales:
+            data_path = os.path.join(args.dir, "{}x".format(scale))
+            data = generate_synthetic_data(data_path, scale, args.seed)
+            msg = u"Scale {}x: {} APC rows and {} offsetting rows written to {}"
+            print msg.format(scale, data["apc_rows"], data["offsetting_rows"], data_path)
+    elif args.job == "run":
+        baseline = None
+        if args.compare:
+            with open(args.compare, "r") as f:
+                baseline = json.loads(f.read())
+        results = {
+            "revision": _git_revision(),
+            "created": datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "seed": args.seed,
+            "max_queries": args.max_queries,
+            "scales": {}
+        }
+        for scale in args.scales:
+            results["scales"][str(scale)] = run_scale_benchmark(args.dir, scale, args.seed, args.config,
+                                                                args.max_queries)
+        with open(args.output, "w") as f:
+            f.write(json.dumps(results, sort_keys=True, indent=4, separators=(',', ': ')))
+        print u"Results written to " + args.output
+        if baseline is not None:
+            if baseline.get("seed") != args.seed or baseline.get("max_queries") != args.max_queries:
+                print colorise(u"The baseline was measured with a different seed or query limit.", "yellow")
+            if compare_results(results, baseline, args.tolerance) > 0:
+                sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+
+import json
+import os
+import sqlite3
+import time
+
+CACHE_DB_FILE = "coverage_cache.db"
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS pubdates (
+           issn TEXT NOT NULL,
+           doi TEXT NOT NULL,
+           pub_year TEXT NOT NULL,
+           PRIMARY KEY (issn, doi)
+       )""",
+    """CREATE TABLE IF NOT EXISTS coverage (
+           issn TEXT NOT NULL,
+           year TEXT NOT NULL,
+           name TEXT NOT NULL,
+           value INTEGER NOT NULL,
+           PRIMARY KEY (issn, year, name)
+       )""",
+    # SpringerLink journal IDs which had to be looked up on DOI landing pages
+    """CREATE TABLE IF NOT EXISTS journal_ids (
+           issn TEXT PRIMARY KEY,
+           journal_id TEXT NOT NULL
+       )""",
+    # validators of the last download of every journal CSV file
+    """CREATE TABLE IF NOT EXISTS csv_validators (
+           issn TEXT PRIMARY KEY,
+           url TEXT NOT NULL,
+           etag TEXT,
+           last_modified TEXT
+       )""",
+    # DOIs which could not be found in the CSV file of their journal
+    """CREATE TABLE IF NOT EXISTS missing_dois (
+           issn TEXT NOT NULL,
+           doi TEXT NOT NULL,
+           checked REAL NOT NULL,
+           PRIMARY KEY (issn, doi)
+       )""",
+    # (mtime, size) of every JSON file at the time of the last import or export
+    """CREATE TABLE IF NOT EXISTS json_files (
+           path TEXT PRIMARY KEY,
+           mtime REAL NOT NULL,
+           size INTEGER NOT NULL
+       )"""
+]
+
+class CoverageCache(object):
+    """
+    A transactional store for journal coverage stats and article publication years.
+
+    Entries are kept in an SQLite database, so single values can be looked up
+    without loading the whole cache and changes become persistent with every
+    checkpoint() - a crash only loses the lookups made since the last one.
+
+    The JSON files (coverage_stats.json and article_pubdates.json) remain the
+    distributed form of the caches. They are imported whenever they changed
+    since the last import or export (for example after a git pull) and can be
+    rewritten in their usual layout using export_json().
+    """
+    def __init__(self, db_path, coverage_json, pubdates_json):
+        self.db_path = db_path
+        self.coverage_json = coverage_json
+        self.pubdates_json = pubdates_json
+        self.connection = sqlite3.connect(db_path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        for statement in SCHEMA:
+            self.connection.execute(statement)
+        self.connection.commit()
+        self.import_json()
+
+    def _json_file_changed(self, path):
+        if not os.path.isfile(path):
+            return False
+        stat = os.stat(path)
+        row = self.connection.execute("SELECT mtime, size FROM json_files WHERE path = ?", (path,)).fetchone()
+        return row is None or row[0] != stat.st_mtime or row[1] != stat.st_size
+
+    def _record_json_file(self, path):
+        stat = os.stat(path)
+        self.connection.execute("INSERT OR REPLACE INTO json_files VALUES (?, ?, ?)",
+                                (path, stat.st_mtime, stat.st_size))
+
+    def import_json(self, force=False):
+        """
+        Import the JSON cache files into the database if they have changed.
+
+        Entries from the JSON files replace existing entries with the same key.
+
+        Args:
+            force: Import the files even if they did not change
+
+        Returns:
+            A list of imported file paths
+        """
+        imported = []
+        if force or self._json_file_changed(self.coverage_json):
+            with open(self.coverage_json, "r") as f:
+                coverage = json.loads(f.read())
+            values = []
+            for issn, years in coverage.iteritems():
+                for year, stats in years.iteritems():
+                    for name, value in stats.iteritems():
+                        values.append((issn, year, name, value))
+            self.connection.executemany("INSERT OR REPLACE INTO coverage VALUES (?, ?, ?, ?)", values)
+            self._record_json_file(self.coverage_json)
+            imported.append(self.coverage_json)
+        if force or self._json_file_changed(self.pubdates_json):
+            with open(self.pubdates_json, "r") as f:
+                pubdates = json.loads(f.read())
+            values = []
+            for issn, dois in pubdates.iteritems():
+                for doi, pub_year in dois.iteritems():
+                    values.append((issn, doi, pub_year))
+            self.connection.executemany("INSERT OR REPLACE INTO pubdates VALUES (?, ?, ?)", values)
+            self._record_json_file(self.pubdates_json)
+            imported.append(self.pubdates_json)
+        self.connection.commit()
+        return imported
+
+    def export_json(self):
+        """
+        Write the cache content to the JSON files, using the established layout.
+        """
+        coverage = {}
+        for issn, year, name, value in self.connection.execute("SELECT issn, year, name, value FROM coverage"):
+            coverage.setdefault(issn, {}).setdefault(year, {})[name] = value
+        pubdates = {}
+        for issn, doi, pub_year in self.connection.execute("SELECT issn, doi, pub_year FROM pubdates"):
+            pubdates.setdefault(issn, {})[doi] = pub_year
+        for path, content in [(self.coverage_json, coverage), (self.pubdates_json, pubdates)]:
+            temp_path = path + ".tmp"
+            with open(temp_path, "w") as f:
+                f.write(json.dumps(content, sort_keys=True, indent=4, separators=(',', ': ')))
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(temp_path, path)
+            self._record_json_file(path)
+        self.connection.commit()
+
+    def get_pub_year(self, issn, doi):
+        """
+        Look up the publication year of an article.
+
+        Returns:
+            The publication year as string or None if the article is not cached.
+        """
+        row = self.connection.execute("SELECT pub_year FROM pubdates WHERE issn = ? AND doi = ?",
+                                      (issn, doi)).fetchone()
+        return row[0] if row else None
+
+    def set_pub_year(self, issn, doi, pub_year):
+        self.connection.execute("INSERT OR REPLACE INTO pubdates VALUES (?, ?, ?)", (issn, doi, pub_year))
+
+    def get_coverage(self, issn, year):
+        """
+        Look up the coverage stats of a journal in a publication year.
+
+        Returns:
+            A dict with all cached values (like "num_journal_total_articles"),
+            empty if nothing was cached.
+        """
+        rows = self.connection.execute("SELECT name, value FROM coverage WHERE issn = ? AND year = ?",
+                                       (issn, year))
+        return {name: value for name, value in rows}
+
+    def set_coverage_value(self, issn, year, name, value):
+        self.connection.execute("INSERT OR REPLACE INTO coverage VALUES (?, ?, ?, ?)", (issn, year, name, value))
+
+    def get_journal_ids(self):
+        """
+        Returns:
+            A dict mapping ISSNs to all stored SpringerLink journal IDs
+        """
+        return dict(self.connection.execute("SELECT issn, journal_id FROM journal_ids"))
+
+    def set_journal_id(self, issn, journal_id):
+        self.connection.execute("INSERT OR REPLACE INTO journal_ids VALUES (?, ?)", (issn, journal_id))
+
+    def get_csv_validators(self, issn, url):
+        """
+        Look up the HTTP validators of the last download of a journal CSV file.
+
+        Returns:
+            A tuple (etag, last_modified), (None, None) if the file was never
+            downloaded from the given URL (see offsetting_coverage._journal_csv_key()).
+        """
+        row = self.connection.execute("SELECT etag, last_modified FROM csv_validators WHERE issn = ? AND url = ?",
+                                      (issn, url)).fetchone()
+        return row if row else (None, None)
+
+    def set_csv_validators(self, issn, url, etag, last_modified):
+        self.connection.execute("INSERT OR REPLACE INTO csv_validators VALUES (?, ?, ?, ?)",
+                                (issn, url, etag, last_modified))
+
+    def is_known_missing(self, issn, doi, ttl):
+        """
+        Check if a DOI was recently found to be missing in the CSV file of its journal.
+
+        Args:
+            ttl: Maximum age of a negative entry (seconds)
+        """
+        row = self.connection.execute("SELECT checked FROM missing_dois WHERE issn = ? AND doi = ?",
+                                      (issn, doi)).fetchone()
+        return row is not None and row[0] > time.time() - ttl
+
+    def set_missing(self, issn, doi):
+        self.connection.execute("INSERT OR REPLACE INTO missing_dois VALUES (?, ?, ?)", (issn, doi, time.time()))
+
+    def clear_missing(self, issn, doi):
+        self.connection.execute("DELETE FROM missing_dois WHERE issn = ? AND doi = ?", (issn, doi))
+
+    def count_pubdates(self):
+        return self.connection.execute("SELECT COUNT(*) FROM pubdates").fetchone()[0]
+
+    def checkpoint(self):
+        """
+        Make all changes since the last checkpoint persistent.
+        """
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
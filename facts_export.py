@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+from collections import OrderedDict
+import csv
+from cStringIO import StringIO
+
+from cubes import Cell, cuts_from_string
+from cubes.backends.sql.query import QueryBuilder
+from cubes.errors import ArgumentError, UserError
+from cubes.server.errors import server_error_codes
+from cubes.server.utils import SlicerJSONEncoder
+from flask import Blueprint, Response, current_app, jsonify, request
+
+# Number of rows fetched from the server-side cursor and sent as one chunk
+FETCH_SIZE = 2000
+
+EXPORT_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv; charset=utf-8"
+}
+
+export = Blueprint("export", __name__)
+
+@export.errorhandler(UserError)
+def user_error_handler(error):
+    # same error format and status codes as the slicer
+    error_type = error.__class__.error_type
+    response = jsonify({"error": error_type, "message": str(error)})
+    response.status_code = server_error_codes.get(error_type, 400)
+    return response
+
+def _ndjson_chunks(result, labels):
+    encoder = SlicerJSONEncoder()
+    while True:
+        rows = result.fetchmany(FETCH_SIZE)
+        if not rows:
+            break
+        yield "".join([encoder.encode(OrderedDict(zip(labels, row))) + "\n" for row in rows])
+
+def _csv_chunks(result, header):
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([unicode(label).encode("utf-8") for label in header])
+    while True:
+        rows = result.fetchmany(FETCH_SIZE)
+        if not rows:
+            break
+        for row in rows:
+            writer.writerow([u"" if value is None else unicode(value).encode("utf-8") for value in row])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.getvalue():
+        yield buffer.getvalue()
+
+@export.route("/cube/<cube_name>/export")
+def export_facts(cube_name):
+    """
+    Stream all facts of a cube cell as NDJSON (one JSON object per line) or CSV.
+
+    Accepts the cut and fields parameters of the facts endpoint of the
+    slicer, the format parameter selects the output ("ndjson" (default) or
+    "csv"). Rows and CSV header are those of the facts endpoint, without
+    its fact key column. Unlike the facts endpoint, the response is not
+    limited by json_record_limit: the rows are read in a single pass from a
+    server-side cursor and sent in chunks as they arrive, so the memory used
+    by an export does not depend on its size.
+    """
+    output_format = request.args.get("format", "ndjson")
+    if output_format not in EXPORT_FORMATS:
+        raise ArgumentError("Unknown export format '{}', use one of: {}".format(output_format,
+                                                                            ", ".join(sorted(EXPORT_FORMATS))))
+    workspace = current_app.cubes_workspace
+    cube = workspace.cube(cube_name)
+    browser = workspace.browser(cube)
+    if not hasattr(browser, "connectable"):
+        raise ArgumentError("Exports are only supported by the sql store")
+    cell = Cell(cube, cuts_from_string(cube, request.args.get("cut")))
+    fields = request.args.get("fields")
+    attributes = cube.get_attributes(fields.split(",") if fields else None)
+
+    builder = QueryBuilder(browser)
+    # like the facts endpoint, without its fact key column
+    builder.denormalized_statement(cell, attributes, include_fact_key=False)
+    # stream_results makes psycopg2 use a server-side (named) cursor
+    connection = browser.connectable.connect().execution_options(stream_results=True)
+    try:
+        result = connection.execute(builder.statement)
+    except:
+        connection.close()
+        raise
+    if output_format == "csv":
+        # the CSV header of the facts endpoint
+        chunks = _csv_chunks(result, [attribute.label or attribute.name for attribute in attributes])
+    else:
+        chunks = _ndjson_chunks(result, builder.labels)
+
+    def generate():
+        try:
+            for chunk in chunks:
+                yield chunk
+        finally:
+            result.close()
+            connection.close()
+
+    response = Response(generate(), content_type=EXPORT_FORMATS[output_format])
+    if output_format == "csv":
+        response.headers["Content-Disposition"] = "attachment; filename={}.csv".format(cube_name)
+    return response
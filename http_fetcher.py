@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+
+import datetime
+import hashlib
+import json
+import os
+import threading
+import time
+import urllib2
+
+from util import colorise
+
+FETCH_MODES = ["live", "record", "replay", "offline"]
+
+CONDITIONAL_HEADERS = ["If-None-Match", "If-Modified-Since"]
+
+class RateLimiter(object):
+    """
+    Enforce a minimum delay between the start of two requests, shared by all threads.
+    """
+    def __init__(self, delay):
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.next_slot = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.delay
+        if slot > now:
+            time.sleep(slot - now)
+
+class Response(object):
+    """
+    A successful HTTP response, either received from the network or replayed.
+    """
+    def __init__(self, url, code, headers, body):
+        self.url = url
+        self.code = code
+        self.headers = {name.lower(): value for name, value in headers.iteritems()}
+        self.body = body
+
+    def read(self):
+        return self.body
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+class ResponseStore(object):
+    """
+    An on-disk store for recorded HTTP responses, keyed on their URL or on a
+    key given by the caller.
+
+    Every response is kept in two files, <hash>.body with the raw content and
+    <hash>.json with the URL, status and headers. The JSON file is written last,
+    so incomplete entries are never served.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, key, extension):
+        return os.path.join(self.directory, hashlib.sha1(key).hexdigest() + extension)
+
+    def _write(self, path, content):
+        temp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.current_thread().ident)
+        with open(temp_path, "wb") as f:
+            f.write(content)
+        os.rename(temp_path, path)
+
+    def get(self, key):
+        """
+        Look up a recorded response. The Response has the URL it was recorded from.
+        """
+        try:
+            with open(self._path(key, ".json"), "r") as f:
+                meta = json.loads(f.read())
+            with open(self._path(key, ".body"), "rb") as f:
+                body = f.read()
+        except (IOError, ValueError):
+            return None
+        return Response(meta["url"], meta["code"], meta["headers"], body)
+
+    def put(self, response, key=None):
+        key = key or response.url
+        meta = {
+            "url": response.url,
+            "key": key,
+            "code": response.code,
+            "headers": response.headers,
+            "recorded": datetime.datetime.now().isoformat()
+        }
+        self._write(self._path(key, ".body"), response.body)
+        self._write(self._path(key, ".json"), json.dumps(meta, sort_keys=True, indent=4))
+
+class HTTPFetcher(object):
+    """
+    The HTTP layer used for all network access of the coverage pipeline.
+
+    Modes:
+        live: Fetch everything from the network (default).
+        record: Fetch everything from the network and record every successful
+                response. Conditional request headers are dropped, so complete
+                responses are captured.
+        replay: Serve recorded responses, fetch and record missing ones.
+        offline: Serve recorded responses only, never access the network.
+
+    Network requests respect a shared rate limit. Failed requests are retried
+    with exponential backoff, unless the server responded with a status code
+    below 500 other than 429 (Too Many Requests). This includes 304 (Not
+    Modified), which is raised as an urllib2.HTTPError - also when a replayed
+    response matches the validators of a conditional request.
+    """
+    def __init__(self, mode="live", store_directory=None, request_delay=0.5, max_retries=3, retry_backoff=2.0):
+        if mode not in FETCH_MODES:
+            raise ValueError("Unknown fetch mode '{}'".format(mode))
+        if mode != "live" and store_directory is None:
+            raise ValueError("Fetch mode '{}' requires a response store directory".format(mode))
+        self.mode = mode
+        self.store = ResponseStore(store_directory) if mode != "live" else None
+        self.rate_limiter = RateLimiter(request_delay)
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.lock = threading.Lock()
+        self.network_requests = 0
+        self.replayed_requests = 0
+
+    def _not_modified(self, response, headers):
+        etag = response.getheader("ETag")
+        last_modified = response.getheader("Last-Modified")
+        if ((etag and headers.get("If-None-Match") == etag) or
+                (last_modified and headers.get("If-Modified-Since") == last_modified)):
+            return True
+        return False
+
+    def _open_network(self, url, headers):
+        attempt = 0
+        while True:
+            self.rate_limiter.wait()
+            with self.lock:
+                self.network_requests += 1
+            try:
+                result = urllib2.urlopen(urllib2.Request(url, None, headers))
+                info = result.info()
+                response_headers = {name: info.getheader(name) for name in info.keys()}
+                return Response(url, result.getcode(), response_headers, result.read())
+            except urllib2.URLError as ue:
+                code = getattr(ue, "code", None)
+                if attempt >= self.max_retries or (code is not None and code < 500 and code != 429):
+                    raise
+                wait = self.retry_backoff * (2 ** attempt)
+                print colorise(u"Request to {} failed ({}), retrying in {}s...".format(url, ue, wait), "yellow")
+                time.sleep(wait)
+                attempt += 1
+
+    def open(self, url, headers=None, key=None):
+        """
+        Open a URL according to the fetch mode.
+
+        Args:
+            url: The URL to open
+            headers: A dict of additional request headers
+            key: The key of the response in the response store. Defaults to
+                 the URL, URLs containing volatile parts (like the current
+                 year) should use a key without them.
+
+        Returns:
+            A Response object
+        """
+        headers = dict(headers or {})
+        if self.mode in ["replay", "offline"]:
+            response = self.store.get(key or url)
+            if response is not None:
+                with self.lock:
+                    self.replayed_requests += 1
+                if self._not_modified(response, headers):
+                    raise urllib2.HTTPError(url, 304, "Not Modified", None, None)
+                return response
+            if self.mode == "offline":
+                raise urllib2.URLError("offline mode: no recorded response for " + url)
+        if self.mode == "record":
+            for name in CONDITIONAL_HEADERS:
+                headers.pop(name, None)
+        response = self._open_network(url, headers)
+        if self.mode != "live":
+            self.store.put(response, key)
+        return response
+
+    def fetch(self, url):
+        """
+        Fetch the content of a URL (see open()).
+        """
+        return self.open(url).read()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+from collections import OrderedDict
+import json
+import threading
+
+from cubes import ModelProvider
+
+DEFAULT_CUBE_CACHE_SIZE = 32
+
+class _CubeDefinitions(object):
+    """
+    A read-only mapping of cube names to cube metadata, decoding the compact
+    definitions of a model index on every access.
+    """
+    def __init__(self, definitions):
+        self.definitions = definitions
+
+    def __contains__(self, name):
+        return name in self.definitions
+
+    def __getitem__(self, name):
+        return json.loads(self.definitions[name])
+
+    def keys(self):
+        return self.definitions.keys()
+
+class LazyModelProvider(ModelProvider):
+    """
+    A cubes model provider reading a precompiled model index (written by the
+    model job, see util.compile_model_index()).
+
+    Starting the server only requires to read the index, which keeps the
+    definition of every cube as a compact JSON string. A cube definition is
+    decoded when the workspace creates the cube, which happens on the first
+    request to it (see install_cube_cache() for how long cubes are kept).
+    Cube lists are answered from the index alone. Set the path of the
+    [model] section in the slicer configuration to the index to use it.
+    """
+    __extension_name__ = "lazy"
+
+    def __init__(self, metadata=None):
+        super(LazyModelProvider, self).__init__(metadata)
+        self.cube_index = self.metadata.get("cube_index", [])
+        definitions = dict([(entry["name"], entry["definition"]) for entry in self.cube_index])
+        # replaces the decoded cube definitions used by ModelProvider.cube_metadata()
+        self.cubes_metadata = _CubeDefinitions(definitions)
+
+    def list_cubes(self):
+        cubes = []
+        for entry in self.cube_index:
+            cubes.append({
+                "name": entry["name"],
+                "label": entry["label"],
+                "category": entry["category"],
+                "info": entry["info"]
+            })
+        return cubes
+
+class CubeCache(object):
+    """
+    A bounded LRU replacement for the cube cache of a cubes workspace.
+
+    The workspace keeps every cube it created (together with its dimensions)
+    for the lifetime of the process. This cache keeps at most max_entries
+    cubes and calls on_evict with every cube it drops.
+    """
+    def __init__(self, max_entries, on_evict=None):
+        self.max_entries = max_entries
+        self.on_evict = on_evict
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def __contains__(self, key):
+        with self.lock:
+            cube = self.entries.pop(key, None)
+            if cube is not None:
+                self.entries[key] = cube
+        # Workspace.cube() reads the cube right after checking for it, so it is
+        # kept for this thread in case another thread evicts it in between.
+        self.local.hit = (key, cube)
+        return cube is not None
+
+    def __getitem__(self, key):
+        hit = getattr(self.local, "hit", None)
+        self.local.hit = None
+        if hit is not None and hit[0] == key and hit[1] is not None:
+            return hit[1]
+        with self.lock:
+            return self.entries[key]
+
+    def __setitem__(self, key, cube):
+        evicted = []
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = cube
+            while len(self.entries) > self.max_entries:
+                evicted.append(self.entries.popitem(last=False)[1])
+        if self.on_evict is not None:
+            for evicted_cube in evicted:
+                self.on_evict(evicted_cube)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+def install_cube_cache(workspace, max_cubes=DEFAULT_CUBE_CACHE_SIZE):
+    """
+    Limit the number of cubes a cubes workspace keeps in memory.
+
+    When a cube is evicted, the fact table the SQL store reflected for it is
+    released as well. It is reflected again on the next request to the cube.
+
+    Args:
+        workspace: The cubes Workspace
+        max_cubes: The maximum number of cubes to keep
+    """
+    def release_fact_table(cube):
+        store = cube.store
+        if not store or isinstance(store, basestring):
+            store = workspace.get_store(store or "default")
+        metadata = getattr(store, "metadata", None)
+        if metadata is None:
+            return
+        table_name = cube.fact or cube.basename
+        if store.schema:
+            table_name = store.schema + "." + table_name
+        table = metadata.tables.get(table_name)
+        if table is not None:
+            metadata.remove(table)
+
+    workspace._cubes = CubeCache(max_cubes, release_fact_table)
@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+
+import math
+import threading
+import time
+
+from cubes import AggregationBrowser, AggregationResult
+from cubes.errors import ArgumentError, ConfigurationError
+from cubes.stores import Store
+import sqlalchemy
+
+from snapshot import NULL_CODE, Snapshot, read_snapshot_generation
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+BUILTIN_FUNCTIONS = ["sum", "count", "avg", "stddev"]
+
+def _ref(obj):
+    """
+    Get the reference name of a cubes attribute or aggregate.
+    """
+    ref = getattr(obj, "ref", obj)
+    return ref() if callable(ref) else ref
+
+def _key_string(value):
+    """
+    Create the string representation used to match cut values.
+    """
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return unicode(value)
+
+def _comparable(value):
+    """
+    Convert a value for comparisons: numeric if possible, otherwise a string.
+    """
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return unicode(value)
+
+class DimensionColumn(object):
+    """
+    A dictionary-encoded column: every row holds a small integer code,
+    indexing into the list of distinct values.
+    """
+    def __init__(self, values, codes):
+        self.values = values
+        self.codes = codes
+        self.key_codes = {}
+        for code, value in enumerate(self.values):
+            self.key_codes.setdefault(_key_string(value), []).append(code)
+
+    @classmethod
+    def from_values(cls, values):
+        distinct_values = []
+        value_codes = {}
+        codes = numpy.empty(len(values), dtype=numpy.int32)
+        for i, value in enumerate(values):
+            code = value_codes.get(value)
+            if code is None:
+                code = len(distinct_values)
+                value_codes[value] = code
+                distinct_values.append(value)
+            codes[i] = code
+        return cls(distinct_values, codes)
+
+    def dictionary_mask(self, predicate):
+        """
+        Evaluate a predicate once per distinct value.
+
+        Returns:
+            A boolean array indexed by code
+        """
+        return numpy.array([predicate(value) for value in self.values] or [False], dtype=bool)
+
+    def mask_for_keys(self, keys):
+        dictionary_mask = numpy.zeros(max(len(self.values), 1), dtype=bool)
+        for key in keys:
+            for code in self.key_codes.get(_key_string(key), []):
+                dictionary_mask[code] = True
+        return dictionary_mask[self.codes]
+
+def _float_array(values):
+    return numpy.array([numpy.nan if value is None else float(value) for value in values], dtype=numpy.float64)
+
+class ColumnarTable(object):
+    """
+    An in-memory copy of a fact table, holding dimension attributes as
+    dictionary-encoded columns and measures as float arrays (NaN for NULL).
+    """
+    def __init__(self, name, num_rows, dimensions, measures):
+        self.name = name
+        self.num_rows = num_rows
+        self.dimensions = dimensions
+        self.measures = measures
+
+    @classmethod
+    def from_rows(cls, name, rows, dimension_columns, measure_columns):
+        dimensions = {}
+        measures = {}
+        for i, column in enumerate(dimension_columns):
+            dimensions[column] = DimensionColumn.from_values([row[i] for row in rows])
+        offset = len(dimension_columns)
+        for i, column in enumerate(measure_columns):
+            measures[column] = _float_array([row[offset + i] for row in rows])
+        return cls(name, len(rows), dimensions, measures)
+
+    @classmethod
+    def from_snapshot(cls, snapshot, name, dimension_columns, measure_columns):
+        """
+        Create a table from a snapshot (see snapshot.py) without copying codes and measures.
+        """
+        dimensions = {}
+        measures = {}
+        for column in dimension_columns:
+            if snapshot.column_description(name, column)["type"] == "string":
+                # None is appended to the dictionary to represent NULL values
+                values = snapshot.dictionary(name, column) + [None]
+                codes = snapshot.column(name, column)
+                if (codes == NULL_CODE).any():
+                    codes = numpy.where(codes == NULL_CODE, len(values) - 1, codes).astype(numpy.int32)
+                dimensions[column] = DimensionColumn(values, codes)
+            else:
+                values = [None if numpy.isnan(value) else value for value in snapshot.column(name, column)]
+                dimensions[column] = DimensionColumn.from_values(values)
+        for column in measure_columns:
+            measures[column] = snapshot.column(name, column)
+        return cls(name, snapshot.num_rows(name), dimensions, measures)
+
+class MemoryStore(Store):
+    """
+    A cubes store answering aggregate queries from in-memory columnar copies
+    of the fact tables.
+
+    If the "snapshot" option names a snapshot file written by the tables job,
+    tables are mapped from it. Every "snapshot_check_interval" seconds (default:
+    5), the store checks if a snapshot of a newer data generation was written
+    and switches over to it. Tables missing in the snapshot (or all tables, if
+    no snapshot is configured) are read from the database given by "url" and
+    "schema" (just like the sql store) the first time one of their cubes is
+    queried and kept for the lifetime of the process. Requires NumPy and the
+    flat table layout.
+    """
+    __extension_name__ = "memory"
+    default_browser_name = "memory"
+
+    def __init__(self, url=None, schema=None, snapshot=None, snapshot_check_interval=5, **options):
+        if numpy is None:
+            raise ConfigurationError("The memory store (type: memory in the [store] section) requires NumPy, "
+                                     "which could not be imported. Install the packages from requirements.txt.")
+        super(MemoryStore, self).__init__(**options)
+        self.engine = sqlalchemy.create_engine(url) if url else None
+        self.schema = schema
+        self.snapshot_path = snapshot
+        self.snapshot_check_interval = float(snapshot_check_interval)
+        self.snapshot = None
+        self.snapshot_checked = 0
+        self.tables = {}
+        self.lock = threading.Lock()
+
+    def _check_snapshot(self):
+        now = time.time()
+        if self.snapshot_path is None or now - self.snapshot_checked < self.snapshot_check_interval:
+            return
+        self.snapshot_checked = now
+        generation = read_snapshot_generation(self.snapshot_path)
+        if generation is None or (self.snapshot is not None and generation == self.snapshot.generation):
+            return
+        # Arrays of the previous snapshot keep their mapping alive until all
+        # queries using them have finished.
+        self.snapshot = Snapshot(self.snapshot_path)
+        self.tables = {}
+
+    def table(self, name, dimension_columns, measure_columns):
+        """
+        Get the columnar copy of a table, loading it on first access.
+        """
+        with self.lock:
+            self._check_snapshot()
+            if name not in self.tables:
+                if self.snapshot is not None and name in self.snapshot.table_names():
+                    table = ColumnarTable.from_snapshot(self.snapshot, name, dimension_columns, measure_columns)
+                elif self.engine is not None:
+                    metadata = sqlalchemy.MetaData(bind=self.engine)
+                    db_table = sqlalchemy.Table(name, metadata, autoload=True, schema=self.schema)
+                    columns = [db_table.c[column] for column in dimension_columns + measure_columns]
+                    rows = self.engine.execute(sqlalchemy.select(columns)).fetchall()
+                    table = ColumnarTable.from_rows(name, rows, dimension_columns, measure_columns)
+                else:
+                    raise ArgumentError("Table '{}' is not available in the memory store".format(name))
+                self.tables[name] = table
+            return self.tables[name]
+
+class MemoryBrowser(AggregationBrowser):
+    """
+    Aggregation browser for the memory store.
+
+    Cuts are evaluated once per distinct value and expanded to row masks by
+    indexing with the column codes. Drilldowns combine the codes of all
+    drilldown attributes into a single group id, all aggregates are then
+    computed with one numpy.bincount() call per measure.
+    """
+    __extension_name__ = "memory"
+
+    def __init__(self, cube, store, locale=None, **options):
+        super(MemoryBrowser, self).__init__(cube, store, locale)
+        self.cube = cube
+        self.store = store
+        self.dimension_columns = []
+        for dimension in cube.dimensions:
+            for attribute in dimension.attributes:
+                if attribute.name not in self.dimension_columns:
+                    self.dimension_columns.append(attribute.name)
+        self.measure_columns = []
+        for aggregate in cube.aggregates:
+            if aggregate.function != "count" and aggregate.measure not in self.measure_columns:
+                self.measure_columns.append(aggregate.measure)
+
+    def features(self):
+        return {"actions": ["aggregate"]}
+
+    def is_builtin_function(self, function_name, aggregate):
+        return function_name in BUILTIN_FUNCTIONS
+
+    def _table(self):
+        return self.store.table(self.cube.fact or self.cube.name, self.dimension_columns, self.measure_columns)
+
+    def _cut_mask(self, table, cut):
+        # all dimensions of the model are flat, so cuts always refer to the first level
+        dimension = self.cube.dimension(cut.dimension)
+        column = table.dimensions[dimension.levels[0].key.name]
+        if hasattr(cut, "paths"):
+            mask = column.mask_for_keys([path[0] for path in cut.paths if path])
+        elif hasattr(cut, "from_path"):
+            lower = _comparable(cut.from_path[0]) if cut.from_path else None
+            upper = _comparable(cut.to_path[0]) if cut.to_path else None
+            def in_range(value):
+                value = _comparable(value)
+                # NULL values never match a range, like in SQL
+                if value is None or (lower is not None and value < lower):
+                    return False
+                return upper is None or value <= upper
+            mask = column.dictionary_mask(in_range)[column.codes]
+        else:
+            mask = column.mask_for_keys([cut.path[0]] if cut.path else [])
+        if cut.invert:
+            # NOT (...) does not match NULL values in SQL either
+            mask = ~mask & column.dictionary_mask(lambda value: value is not None)[column.codes]
+        return mask
+
+    def _aggregate_values(self, table, aggregates, mask, groups, num_groups):
+        """
+        Compute all aggregates for every group.
+
+        Returns:
+            A dict mapping aggregate names to lists of values, one per group
+        """
+        counts = numpy.bincount(groups, minlength=num_groups)
+        results = {}
+        for aggregate in aggregates:
+            if aggregate.function == "count":
+                results[aggregate.name] = [int(count) for count in counts]
+                continue
+            values = table.measures[aggregate.measure][mask]
+            present = ~numpy.isnan(values)
+            values = numpy.where(present, values, 0.0)
+            n = numpy.bincount(groups, weights=present, minlength=num_groups)
+            sums = numpy.bincount(groups, weights=values, minlength=num_groups)
+            if aggregate.function == "sum":
+                column = [float(s) if c else None for s, c in zip(sums, n)]
+            elif aggregate.function == "avg":
+                column = [float(s / c) if c else None for s, c in zip(sums, n)]
+            elif aggregate.function == "stddev":
+                # sample standard deviation, like PostgreSQL's stddev()
+                squares = numpy.bincount(groups, weights=values * values, minlength=num_groups)
+                column = []
+                for s, q, c in zip(sums, squares, n):
+                    if c < 2:
+                        column.append(None)
+                    else:
+                        column.append(math.sqrt(max(float(q - s * s / c) / (c - 1), 0.0)))
+            else:
+                raise ArgumentError("Aggregate function '{}' is not supported by the memory store"
+                                    .format(aggregate.function))
+            results[aggregate.name] = column
+        return results
+
+    def provide_aggregate(self, cell, aggregates, drilldown, split, order, page, page_size, **options):
+        if split:
+            raise ArgumentError("Split cells are not supported by the memory store")
+        table = self._table()
+        mask = numpy.ones(table.num_rows, dtype=bool)
+        for cut in cell.cuts:
+            mask &= self._cut_mask(table, cut)
+
+        result = AggregationResult(cell=cell, aggregates=aggregates, drilldown=drilldown)
+        summary_groups = numpy.zeros(int(mask.sum()), dtype=numpy.int64)
+        summary = self._aggregate_values(table, aggregates, mask, summary_groups, 1)
+        result.summary = {name: values[0] for name, values in summary.iteritems()}
+
+        attributes = []
+        for item in drilldown or []:
+            for level in item.levels:
+                for attribute in level.attributes:
+                    attributes.append((_ref(attribute), table.dimensions[attribute.name]))
+        if not attributes:
+            result.cells = []
+            result.total_cell_count = None
+            return result
+
+        shape = tuple(max(len(column.values), 1) for _, column in attributes)
+        group_ids = numpy.ravel_multi_index([column.codes[mask] for _, column in attributes], shape)
+        unique_ids, groups = numpy.unique(group_ids, return_inverse=True)
+        values = self._aggregate_values(table, aggregates, mask, groups, len(unique_ids))
+        codes = numpy.unravel_index(unique_ids, shape)
+        cells = []
+        for i in range(len(unique_ids)):
+            record = {}
+            for j, (ref, column) in enumerate(attributes):
+                record[ref] = column.values[codes[j][i]]
+            for name, column_values in values.iteritems():
+                record[name] = column_values[i]
+            cells.append(record)
+
+        sort_keys = [(_ref(item), direction) for item, direction in order or []]
+        if not sort_keys:
+            sort_keys = [(ref, "asc") for ref, _ in attributes]
+        for ref, direction in reversed(sort_keys):
+            cells.sort(key=lambda record: _comparable(record.get(ref)), reverse=(direction == "desc"))
+        result.total_cell_count = len(cells)
+        if page is not None and page_size is not None:
+            cells = cells[page * page_size:(page + 1) * page_size]
+        result.cells = cells
+        result.levels = drilldown.result_levels()
+        return result
@@ -2,82 +2,259 @@
 
 import datetime
 from HTMLParser import HTMLParser
-import json
 import os
+from Queue import Queue
 import re
 import sys
+import threading
 import urllib2
 
-from util import UnicodeReader, colorise
+from coverage_cache import CoverageCache, CACHE_DB_FILE
+from http_fetcher import HTTPFetcher
+from profiling import PROFILER
+from util import CSVBatchReader, UnicodeReader, colorise
 
 JOURNAL_ID_RE = re.compile('<a href="/journal/(?P<journal_id>\d+)" title=".*?">', re.IGNORECASE)
 SEARCH_RESULTS_COUNT_RE = re.compile('<h1 class="number-of-search-results-and-search-terms">\s*<strong>(?P<count>[\d,]+)</strong>', re.IGNORECASE)
 SEARCH_RESULTS_TITLE_RE = re.compile('<p class="message">You are now only searching within the Journal</p>\s*<p class="title">\s*<a href="/journal/\d+">(?P<title>.*?)</a>', re.IGNORECASE | re.UNICODE)
 
-SPRINGER_OA_SEARCH = "https://link.springer.com/search?facet-journal-id={}&package=openaccessarticles&search-within=Journal&query=&date-facet-mode=in&facet-start-year={}&facet-end-year={}"
-SPRINGER_FULL_SEARCH = "https://link.springer.com/search?facet-journal-id={}&query=&date-facet-mode=in&facet-start-year={}&facet-end-year={}"
-SPRINGER_GET_CSV = "https://link.springer.com/search/csv?date-facet-mode=between&search-within=Journal&package=openaccessarticles&facet-journal-id={}&facet-end-year={}&query=&facet-start-year=2015"
+# Base URLs can be changed to run against a local stand-in server
+SPRINGER_BASE_URL = "https://link.springer.com"
+DOI_RESOLVER_URL = "https://doi.org/"
 
-COVERAGE_CACHE = {}
-PERSISTENT_PUBDATES_CACHE = {} # Persistent cache, loaded from PUBDATES_CACHE_FILE on startup
+SPRINGER_OA_SEARCH = "/search?facet-journal-id={}&package=openaccessarticles&search-within=Journal&query=&date-facet-mode=in&facet-start-year={}&facet-end-year={}"
+SPRINGER_FULL_SEARCH = "/search?facet-journal-id={}&query=&date-facet-mode=in&facet-start-year={}&facet-end-year={}"
+SPRINGER_GET_CSV = "/search/csv?date-facet-mode=between&search-within=Journal&package=openaccessarticles&facet-journal-id={}&facet-end-year={}&query=&facet-start-year=2015"
+# the end year is always the current one, so it is left out of the keys of recorded responses and validators
+CSV_END_YEAR_RE = re.compile("&facet-end-year=\d+")
+
+DEFAULT_REQUEST_DELAY = 0.5 # minimum delay between the start of two requests (seconds)
+MAX_RETRIES = 3
+RETRY_BACKOFF = 2.0 # delay before the first retry (seconds), doubled for every further attempt
+
+CACHE = None # Persistent CoverageCache for coverage stats and publication dates, opened on startup
+CHECKPOINT_INTERVAL = 25 # number of lookups after which the persistent cache is checkpointed
 
 TEMP_JOURNAL_CACHE = {} # keeps cached journal statistics imported from CSV files. Intended to reduce I/O workload when multiple articles from the same journal have to be looked up. 
-TEMP_JOURNAL_ID_CACHE = {} # keeps journal IDs cached which had to be retreived from SpringerLink to avoid multiple lookups.
+TEMP_JOURNAL_ID_CACHE = {} # keeps journal IDs cached which had to be retreived from SpringerLink to avoid multiple lookups. Persisted in CACHE.
 
 COVERAGE_CACHE_FILE = "coverage_stats.json"
 PUBDATES_CACHE_FILE = "article_pubdates.json"
 
 JOURNAL_CSV_DIR = "coverage_article_files"
+HTTP_CACHE_DIR = "http_cache" # recorded responses for the record, replay and offline fetch modes
+
+FETCHED_JOURNAL_CSVS = set() # ISSNs of journals whose CSV file has already been downloaded during this run
+NEGATIVE_CACHE_TTL = 7 * 24 * 3600 # seconds during which a DOI missing in its journal CSV will not trigger a re-fetch
 
 ERROR_MSGS = []
 
+FETCHER = HTTPFetcher("live", request_delay=DEFAULT_REQUEST_DELAY, max_retries=MAX_RETRIES,
+                      retry_backoff=RETRY_BACKOFF) # replaced by update_coverage_stats() according to the fetch mode
+
+def _run_parallel(function, tasks, num_workers):
+    """
+    Apply a function to every task using a pool of worker threads.
+
+    Returns:
+        A dict mapping every task to a tuple (result, exception), one of them
+        being None.
+    """
+    queue = Queue()
+    for task in tasks:
+        queue.put(task)
+    results = {}
+    def worker():
+        while True:
+            try:
+                task = queue.get_nowait()
+            except Exception:
+                return
+            try:
+                results[task] = (function(task), None)
+            except Exception as e:
+                results[task] = (None, e)
+    threads = [threading.Thread(target=worker) for _ in range(min(num_workers, len(tasks)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        # join with a timeout, otherwise Ctrl-C would not interrupt the main thread
+        while thread.is_alive():
+            thread.join(1)
+    return results
+
          
+def _checkpoint():
+    """
+    Make all cache changes persistent, including journal IDs found so far.
+    """
+    for issn, journal_id in TEMP_JOURNAL_ID_CACHE.items():
+        CACHE.set_journal_id(issn, journal_id)
+    CACHE.checkpoint()
+
 def _shutdown():
     """
     Write cache content back to disk before terminating and display collected error messages.
     """
     print "Updating cache files.."
-    with open(COVERAGE_CACHE_FILE, "w") as f:
-        f.write(json.dumps(COVERAGE_CACHE, sort_keys=True, indent=4, separators=(',', ': ')))
-        f.flush()
-    with open(PUBDATES_CACHE_FILE, "w") as f:
-        f.write(json.dumps(PERSISTENT_PUBDATES_CACHE, sort_keys=True, indent=4, separators=(',', ': ')))
-        f.flush()
+    with PROFILER.stage("write cache files"):
+        _checkpoint()
+        CACHE.export_json()
     print "Done."
-    num_articles = 0
-    for issn, dois in PERSISTENT_PUBDATES_CACHE.iteritems():
-        num_articles += len(dois)
+    num_articles = CACHE.count_pubdates()
+    CACHE.close()
     print "The article cache now contains publication dates for {} DOIs".format(num_articles)
+    msg = "HTTP requests ({} mode): {} sent over the network, {} replayed from {}"
+    print msg.format(FETCHER.mode, FETCHER.network_requests, FETCHER.replayed_requests, HTTP_CACHE_DIR)
     if ERROR_MSGS:
         print colorise("There were errors during the lookup process:", "yellow")
         for msg in ERROR_MSGS:
             print msg
     sys.exit()
     
-def update_coverage_stats(offsetting_file, max_lookups):
-    global COVERAGE_CACHE, PERSISTENT_PUBDATES_CACHE
-    if os.path.isfile(COVERAGE_CACHE_FILE):
-        with open(COVERAGE_CACHE_FILE, "r") as f:
-            try:
-               COVERAGE_CACHE  = json.loads(f.read())
-               print "coverage cache file sucessfully loaded."
-            except ValueError:
-                print "Could not decode a cache structure from " + COVERAGE_CACHE_FILE + ", starting with an empty coverage cache."
-    else:
-        print "No cache file (" + COVERAGE_CACHE_FILE + ") found, starting with an empty coverage cache."
-    if os.path.isfile(PUBDATES_CACHE_FILE):
-        with open(PUBDATES_CACHE_FILE, "r") as f:
-            try:
-               PERSISTENT_PUBDATES_CACHE  = json.loads(f.read())
-               print "Pub dates cache file sucessfully loaded."
-            except ValueError:
-                print "Could not decode a cache structure from " + PUBDATES_CACHE_FILE + ", starting with an empty pub date cache."
-    else:
-        print "No cache file (" + PUBDATES_CACHE_FILE + ") found, starting with an empty pub date cache."
+def _prefetch_springer_data(offsetting_file, num_workers, max_lookups):
+    """
+    Fetch all missing SpringerLink data concurrently.
+
+    The required work is deduplicated first: Journal IDs are resolved once per
+    journal, article CSV files are downloaded once per journal and search
+    statistics once per unique (journal_id, year, oa) combination. All
+    results end up in the same caches the sequential lookup process in
+    update_coverage_stats() uses, which then only has to handle what could
+    not be fetched here.
+    """
+    journals = {}
+    reader = UnicodeReader(open(offsetting_file, "r"))
+    for line in reader:
+        if line["publisher"] != "Springer Nature":
+            continue
+        issn = line["issn"]
+        if issn not in journals:
+            journals[issn] = {"doi": line["doi"], "articles": []}
+        journals[issn]["articles"].append((line["doi"], line["period"]))
+    
+    def report(results, description):
+        failed = 0
+        for task, (_, exception) in results.iteritems():
+            if exception is not None:
+                failed += 1
+                msg = colorise(u"Prefetch error ({}, {}): {}".format(description, task, exception), "red")
+                print msg
+                ERROR_MSGS.append(msg)
+        print u"Prefetched {} {} ({} failed)".format(len(results) - failed, description, failed)
+    
+    journal_ids = {}
+    id_results = _run_parallel(lambda issn: _get_springer_journal_id_from_doi(journals[issn]["doi"], issn),
+                               journals.keys(), num_workers)
+    report(id_results, "journal ids")
+    for issn, (journal_id, _) in id_results.iteritems():
+        if journal_id is not None:
+            journal_ids[issn] = journal_id
+    
+    csv_tasks = []
+    for issn, journal in journals.iteritems():
+        missing = [doi for doi, _ in journal["articles"] if CACHE.get_pub_year(issn, doi) is None and
+                   not CACHE.is_known_missing(issn, doi, NEGATIVE_CACHE_TTL)]
+        if not missing or issn not in journal_ids:
+            continue
+        path = os.path.join(JOURNAL_CSV_DIR, issn + ".csv")
+        if os.path.isfile(path):
+            TEMP_JOURNAL_CACHE[issn] = _get_journal_cache_from_csv(issn, journal_ids[issn], refetch=False)
+            if all([doi in TEMP_JOURNAL_CACHE[issn] for doi in missing]):
+                continue
+        csv_tasks.append(issn)
+    # the cache database may only be used from the main thread, so validators are looked up beforehand
+    validators = {}
+    for issn in csv_tasks:
+        validators[issn] = CACHE.get_csv_validators(issn, _journal_csv_key(journal_ids[issn]))
+    def fetch_csv(issn):
+        return _fetch_springer_journal_csv(os.path.join(JOURNAL_CSV_DIR, issn + ".csv"), journal_ids[issn],
+                                           validators[issn])
+    csv_results = _run_parallel(fetch_csv, csv_tasks, num_workers)
+    report(csv_results, "journal CSV files")
+    for issn, (result, _) in csv_results.iteritems():
+        if result is not None:
+            _store_csv_fetch_result(issn, journal_ids[issn], result)
+            TEMP_JOURNAL_CACHE[issn] = _get_journal_cache_from_csv(issn, journal_ids[issn], refetch=False)
     
+    stats_tasks = {}
+    for issn, journal in journals.iteritems():
+        if issn not in journal_ids:
+            continue
+        for doi, period in journal["articles"]:
+            pub_year = CACHE.get_pub_year(issn, doi)
+            if pub_year is None:
+                pub_year = TEMP_JOURNAL_CACHE.get(issn, {}).get(doi, period)
+            cached = CACHE.get_coverage(issn, pub_year)
+            for oa, key in [(False, "num_journal_total_articles"), (True, "num_journal_oa_articles")]:
+                if key not in cached:
+                    stats_tasks.setdefault((journal_ids[issn], pub_year, oa), set()).add(issn)
+    tasks = sorted(stats_tasks.keys())
+    if max_lookups is not None:
+        tasks = tasks[:max_lookups]
+    stats_results = _run_parallel(lambda task: _get_springer_journal_stats(*task), tasks, num_workers)
+    report(stats_results, "journal statistics")
+    for (journal_id, pub_year, oa), (stats, _) in stats_results.iteritems():
+        if stats is None:
+            continue
+        key = "num_journal_oa_articles" if oa else "num_journal_total_articles"
+        for issn in stats_tasks[(journal_id, pub_year, oa)]:
+            CACHE.set_coverage_value(issn, pub_year, key, stats["count"])
+    _checkpoint()
+
+def update_coverage_stats(offsetting_file, max_lookups, num_workers=1, request_delay=DEFAULT_REQUEST_DELAY,
+                          fetch_mode="live"):
+    """
+    Update the coverage and publication dates caches for all Springer Nature
+    articles in the offsetting file.
+
+    Args:
+        offsetting_file: Path to the offsetting CSV file
+        max_lookups: Stop after this many lookups (None for no limit). In concurrent
+                     mode, this also limits the number of prefetched statistics.
+        num_workers: Number of concurrent requests. If greater than 1, all missing
+                     data is prefetched concurrently before the sequential pass.
+        request_delay: Minimum delay between the start of two requests (seconds)
+        fetch_mode: The mode of the HTTP layer, one of "live", "record",
+                    "replay" or "offline" (see http_fetcher.HTTPFetcher).
+                    Recorded responses are kept in HTTP_CACHE_DIR.
+    """
+    global FETCHER
+    FETCHER = HTTPFetcher(fetch_mode, HTTP_CACHE_DIR, request_delay, MAX_RETRIES, RETRY_BACKOFF)
     if not os.path.isdir(JOURNAL_CSV_DIR):
         raise IOError("Journal CSV directory " + JOURNAL_CSV_DIR + " not found!")
-    
+    with PROFILER.stage("load coverage caches"):
+        open_cache()
+    try:
+        if num_workers > 1:
+            print "Prefetching SpringerLink data using {} workers...".format(num_workers)
+            with PROFILER.stage("prefetch"):
+                _prefetch_springer_data(offsetting_file, num_workers, max_lookups)
+        with PROFILER.stage("sequential lookups"):
+            _lookup_coverage_stats(offsetting_file, max_lookups)
+    except KeyboardInterrupt:
+        print colorise("Interrupted, keeping all lookups performed so far.", "yellow")
+    _shutdown()
+
+def open_cache():
+    """
+    Open the persistent coverage cache, importing changed JSON cache files.
+
+    Returns:
+        The CoverageCache instance, also available as CACHE.
+    """
+    global CACHE
+    if CACHE is None:
+        try:
+            CACHE = CoverageCache(CACHE_DB_FILE, COVERAGE_CACHE_FILE, PUBDATES_CACHE_FILE)
+        except ValueError:
+            msg = "Could not decode a cache structure from {} or {}."
+            raise ValueError(msg.format(COVERAGE_CACHE_FILE, PUBDATES_CACHE_FILE))
+        TEMP_JOURNAL_ID_CACHE.update(CACHE.get_journal_ids())
+    return CACHE
+
+def _lookup_coverage_stats(offsetting_file, max_lookups):
     reader = UnicodeReader(open(offsetting_file, "r"))
     num_lookups = 0
     for line in reader:
@@ -97,15 +274,22 @@ def update_coverage_stats(offsetting_file, max_lookups):
         #  2. if the journal is not present, repopulate local cache segment from a CSV file in the journal CSV dir
         #  3a. if no CSV for the journal could be found, fetch it from SpringerLink
         #  3b. Alternative to 3: If a CSV was found but it does not contain the DOI, re-fetch it from SpringerLink 
-        try:
-            _ = PERSISTENT_PUBDATES_CACHE[issn][doi]
+        pub_year = CACHE.get_pub_year(issn, doi)
+        if pub_year is not None:
             print u"Journal {} ('{}'): DOI {} already cached.".format(issn, title, doi)
-        except KeyError:
+        else:
             if issn not in TEMP_JOURNAL_CACHE:
                 msg = u"Journal {} ('{}'): Not found in temp cache, repopulating..."
                 print msg.format(issn, title)
                 TEMP_JOURNAL_CACHE[issn] = _get_journal_cache_from_csv(issn, journal_id, refetch=False)
-            if doi not in TEMP_JOURNAL_CACHE[issn]:
+            if doi not in TEMP_JOURNAL_CACHE[issn] and CACHE.is_known_missing(issn, doi, NEGATIVE_CACHE_TTL):
+                # Avoid re-fetching the CSV file for DOIs which were recently found to be missing
+                msg = u"Journal {} ('{}'): DOI {} NOT FOUND in SpringerLink data (cached result of an earlier run)!"
+                msg = colorise(msg.format(title, issn, doi), "red")
+                print msg
+                ERROR_MSGS.append(msg)
+                found = False
+            elif doi not in TEMP_JOURNAL_CACHE[issn]:
                 msg = u"Journal {} ('{}'): DOI {} not found in cache, re-fetching csv file..."
                 print msg.format(issn, title, doi)
                 TEMP_JOURNAL_CACHE[issn] = _get_journal_cache_from_csv(issn, journal_id, refetch=True)
@@ -114,13 +298,13 @@ def update_coverage_stats(offsetting_file, max_lookups):
                     msg = colorise(msg.format(title, issn, doi), "red")
                     print msg
                     ERROR_MSGS.append(msg)
+                    CACHE.set_missing(issn, doi)
                     found = False
             lookup_performed = True
-            if issn not in PERSISTENT_PUBDATES_CACHE:
-                PERSISTENT_PUBDATES_CACHE[issn] = {}
             if found:
-                PERSISTENT_PUBDATES_CACHE[issn][doi] = TEMP_JOURNAL_CACHE[issn][doi]
-                pub_year = PERSISTENT_PUBDATES_CACHE[issn][doi]
+                pub_year = TEMP_JOURNAL_CACHE[issn][doi]
+                CACHE.set_pub_year(issn, doi, pub_year)
+                CACHE.clear_missing(issn, doi)
                 compare_msg = u"DOI {} found in Springer data, Pub year is {} ".format(doi, pub_year)
                 if pub_year == period:
                     compare_msg += colorise("(same as offsetting period)", "green")
@@ -129,47 +313,35 @@ def update_coverage_stats(offsetting_file, max_lookups):
                 msg = u"Journal {} ('{}'): ".format(issn, title)
                 print msg.ljust(80) + compare_msg
         # Retreive journal total and OA statistics for every covered publication year.
-        if found:
-            pub_year = PERSISTENT_PUBDATES_CACHE[issn][doi]
-        else:
+        if not found:
             # If a lookup error occured we will retreive coverage stats for the period year instead, since
             # the aggregation process will make use of this value.
             pub_year = period
-        if issn not in COVERAGE_CACHE:
-            COVERAGE_CACHE[issn] = {}
-        if pub_year not in COVERAGE_CACHE[issn]:
-            COVERAGE_CACHE[issn][pub_year] = {}
+        coverage = CACHE.get_coverage(issn, pub_year)
         # If coverage stats are missing, we have to scrap them from the SpringerLink search site HTML
-        try:
-            _ = COVERAGE_CACHE[issn][pub_year]["num_journal_total_articles"]
-        except KeyError:
+        if "num_journal_total_articles" not in coverage:
             msg = u'No cached entry found for total article numbers in journal "{}" ({}) in the {} publication period, querying SpringerLink...'
             print msg.format(title, issn, pub_year)
-            if issn not in COVERAGE_CACHE:
-                COVERAGE_CACHE[issn] = {}
             if journal_id is None:
                 journal_id = _get_springer_journal_id_from_doi(doi, issn)
             total = _get_springer_journal_stats(journal_id, pub_year, oa=False)
-            COVERAGE_CACHE[issn][pub_year]["num_journal_total_articles"] = total["count"]
+            CACHE.set_coverage_value(issn, pub_year, "num_journal_total_articles", total["count"])
             lookup_performed = True
-        try:
-            _ = COVERAGE_CACHE[issn][pub_year]["num_journal_oa_articles"]
-        except KeyError:
+        if "num_journal_oa_articles" not in coverage:
             msg = u'No cached entry found for OA article numbers in journal "{}" ({}) in the {} publication period, querying SpringerLink...'
             print msg.format(title, issn, pub_year)
-            if issn not in COVERAGE_CACHE:
-                COVERAGE_CACHE[issn] = {}
             if journal_id is None:
                 journal_id = _get_springer_journal_id_from_doi(doi, issn)
             oa = _get_springer_journal_stats(journal_id, pub_year, oa=True)
-            COVERAGE_CACHE[issn][pub_year]["num_journal_oa_articles"] = oa["count"]
+            CACHE.set_coverage_value(issn, pub_year, "num_journal_oa_articles", oa["count"])
             lookup_performed = True
         if lookup_performed:
             num_lookups += 1
+            if num_lookups % CHECKPOINT_INTERVAL == 0:
+                _checkpoint()
         if max_lookups is not None and num_lookups >= max_lookups:
             print u"maximum number of lookups performed."
-            _shutdown()
-    _shutdown()
+            return
     
 def _get_journal_cache_from_csv(issn, journal_id, refetch):
     """
@@ -183,35 +355,84 @@ def _get_journal_cache_from_csv(issn, journal_id, refetch):
         issn: The journal ISSN
         journal_id: The SpringerLink internal journal ID. Can be obtained
                     using _get_springer_journal_id_from_doi()
-        refetch: Bool. If True, the CSV file will always be re-downloaded, otherwise
-                 a local copy will be tried first.
+        refetch: Bool. If True, the CSV file will be re-downloaded unless this
+                 already happened during the current run, otherwise a local copy
+                 will be tried first. A re-download is a conditional request,
+                 so an unchanged file is not transferred again.
     
     Returns:
         A dict with a doi -> pub_year mapping.
     """
     path = os.path.join(JOURNAL_CSV_DIR, issn + ".csv")
-    if not os.path.isfile(path) or refetch:
-        _fetch_springer_journal_csv(path, journal_id)
+    if not os.path.isfile(path) or (refetch and issn not in FETCHED_JOURNAL_CSVS):
         msg = u"Journal {}: Fetching article CSV table from SpringerLink..."
         print msg.format(issn)
-    with open(path) as p:
-        reader = UnicodeReader(p)
+        validators = CACHE.get_csv_validators(issn, _journal_csv_key(journal_id))
+        result = _fetch_springer_journal_csv(path, journal_id, validators)
+        _store_csv_fetch_result(issn, journal_id, result)
+    with open(path, "rb") as p, PROFILER.stage("parse journal CSV files") as stage:
         cache = {}
-        for line in reader:
-            doi = line["Item DOI"]
-            year = line["Publication Year"]
-            cache[doi] = year
+        for batch in CSVBatchReader(p, ["Item DOI", "Publication Year"]):
+            cache.update(batch.rows())
+            stage.items += len(batch)
         return cache
         
-def _fetch_springer_journal_csv(path, journal_id):
+def _journal_csv_url(journal_id, year=None):
     # WARNING: SpringerLink caps CSV size at 1000 lines. This will become a problem
     # when a single journal reaches a total number of more than 1000 OA articles.
-    year = datetime.datetime.now().year
-    url = SPRINGER_GET_CSV.format(journal_id, year)
-    handle = urllib2.urlopen(url)
-    content = handle.read()
+    if year is None:
+        year = datetime.datetime.now().year
+    return SPRINGER_BASE_URL + SPRINGER_GET_CSV.format(journal_id, year)
+
+def _journal_csv_key(journal_id):
+    """
+    Get the key of a journal CSV file for recorded responses and validators,
+    its URL without the end year. Otherwise all of them would become useless
+    at the turn of the year.
+    """
+    return CSV_END_YEAR_RE.sub("", _journal_csv_url(journal_id, 0))
+
+def _fetch_springer_journal_csv(path, journal_id, validators=(None, None)):
+    """
+    Download a journal CSV file from SpringerLink.
+
+    If a local copy exists, the request is made conditional on the validators
+    of the previous download.
+
+    Args:
+        path: The local path of the CSV file
+        journal_id: The SpringerLink internal journal ID
+        validators: A tuple (etag, last_modified) from the previous download
+
+    Returns:
+        A tuple (modified, etag, last_modified). modified is False if the
+        server responded with 304 (Not Modified) and the local copy was kept.
+    """
+    etag, last_modified = validators
+    headers = {}
+    if os.path.isfile(path):
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+    try:
+        with PROFILER.stage("network: journal CSV download"):
+            response = FETCHER.open(_journal_csv_url(journal_id), headers, _journal_csv_key(journal_id))
+    except urllib2.HTTPError as he:
+        if he.code == 304:
+            return (False, etag, last_modified)
+        raise
+    content = response.read()
     with open(path, "wb") as f:
         f.write(content)
+    return (True, response.getheader("ETag"), response.getheader("Last-Modified"))
+
+def _store_csv_fetch_result(issn, journal_id, result):
+    modified, etag, last_modified = result
+    if not modified:
+        print u"Journal {}: Article CSV table not modified since the last download.".format(issn)
+    CACHE.set_csv_validators(issn, _journal_csv_key(journal_id), etag, last_modified)
+    FETCHED_JOURNAL_CSVS.add(issn)
     
 def _get_springer_journal_id_from_doi(doi, issn=None):
     global TEMP_JOURNAL_ID_CACHE
@@ -221,9 +442,8 @@ def _get_springer_journal_id_from_doi(doi, issn=None):
     # In case of the "European Physical journal" family, the journal id cannot be extracted directly from the DOI.
         if issn is None or issn not in TEMP_JOURNAL_ID_CACHE:
             print "No local journal id extraction possible for doi " + doi + ", analysing landing page..." 
-            req = urllib2.Request("https://doi.org/" + doi, None)
-            response = urllib2.urlopen(req)
-            content = response.read()
+            with PROFILER.stage("network: journal ID lookup"):
+                content = FETCHER.fetch(DOI_RESOLVER_URL + doi)
             match = JOURNAL_ID_RE.search(content)
             if match:
                 journal_id = match.groupdict()["journal_id"]
@@ -238,16 +458,15 @@ def _get_springer_journal_id_from_doi(doi, issn=None):
     else:
         raise ValueError(doi + " does not seem to be a Springer DOI (prefix not in list)!") 
     
-def _get_springer_journal_stats(journal_id, period, oa=False, pause=0.5):
+def _get_springer_journal_stats(journal_id, period, oa=False):
     if not journal_id.isdigit():
         raise ValueError("Invalid journal id " + journal_id + " (not a number)")
-    url = SPRINGER_FULL_SEARCH.format(journal_id, period, period)
+    url = SPRINGER_BASE_URL + SPRINGER_FULL_SEARCH.format(journal_id, period, period)
     if oa:
-        url = SPRINGER_OA_SEARCH.format(journal_id, period, period)
+        url = SPRINGER_BASE_URL + SPRINGER_OA_SEARCH.format(journal_id, period, period)
     print url
-    req = urllib2.Request(url, None)
-    response = urllib2.urlopen(req)
-    content = response.read()
+    with PROFILER.stage("network: OA article search" if oa else "network: total article search"):
+        content = FETCHER.fetch(url)
     results = {}
     count_match = SEARCH_RESULTS_COUNT_RE.search(content)
     if count_match:
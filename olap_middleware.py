@@ -0,0 +1,1177 @@
+#!/usr/bin/env python
+
+from bisect import bisect_left
+import calendar
+from collections import OrderedDict
+import cPickle
+from email.utils import formatdate, mktime_tz, parsedate_tz
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import urllib
+import urlparse
+import zlib
+
+from ConfigParser import NoOptionError, NoSectionError
+
+from util import UnicodeReader, escape_cut_value, read_generation_stamp, read_model_cubes
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+AGGREGATE_PATH_RE = re.compile(r"^/cube/(?P<cube>[^/]+)/aggregate/?$")
+CUBE_PATH_RE = re.compile(r"^/cube/(?P<cube>[^/]+)/(?P<endpoint>[^/]+)(?P<rest>/.*)?$")
+# endpoints of the facts export (see facts_export.py), their responses are never buffered
+STREAMING_ENDPOINTS = ["export"]
+# endpoints of the cubes API (and the facts export) used as metric labels
+METRICS_ENDPOINTS = ["model", "aggregate", "facts", "fact", "members", "cell", "report", "search"] + STREAMING_ENDPOINTS
+# metric label for cubes, endpoints and dimensions unknown to the model
+OTHER_LABEL = "other"
+# clients allowed to purge the cache and, by default, to read the metrics
+LOCAL_ADDRESSES = ["127.0.0.1", "::1"]
+# cubes separates list elements by "|", a pipe may be escaped with a backslash
+LIST_SEPARATOR_RE = re.compile(r"(?<!\\)\|")
+# records the data generation of the entries of a DiskCacheStore
+DISK_CACHE_GENERATION_FILE = "generation"
+
+def _get_option(config, section, option, default=None):
+    try:
+        return config.get(section, option)
+    except (NoSectionError, NoOptionError):
+        return default
+
+def _get_boolean_option(config, section, option, default=False):
+    try:
+        return config.getboolean(section, option)
+    except (NoSectionError, NoOptionError):
+        return default
+
+def _get_int_option(config, section, option, default=None):
+    try:
+        return config.getint(section, option)
+    except (NoSectionError, NoOptionError):
+        return default
+
+def _get_float_option(config, section, option, default=None):
+    try:
+        return config.getfloat(section, option)
+    except (NoSectionError, NoOptionError):
+        return default
+
+def _json_response(start_response, status, content):
+    body = json.dumps(content)
+    start_response(status, [("Content-Type", "application/json"), ("Content-Length", str(len(body)))])
+    return [body]
+
+def _call_app(app, environ):
+    """
+    Call a WSGI app and collect its complete response.
+
+    Returns:
+        A tuple (status, headers, body)
+    """
+    captured = {}
+    def start_response(status, headers, exc_info=None):
+        captured["status"] = status
+        captured["headers"] = headers
+        return lambda data: captured.setdefault("written", []).append(data)
+    result = app(environ, start_response)
+    try:
+        body = "".join(captured.get("written", [])) + "".join(result)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+    return (captured["status"], captured["headers"], body)
+
+def split_list(value):
+    """
+    Split a cubes URL list parameter (like "publisher|journal_full_title").
+    """
+    return [item for item in LIST_SEPARATOR_RE.split(value) if item]
+
+def dimension_name(spec):
+    """
+    Extract the dimension name from a drilldown, cut or order element.
+
+    Handles elements like "publisher", "!period:2015", "period:2015-2017" or
+    "publisher@default:journal_full_title".
+    """
+    spec = spec.lstrip("!")
+    for separator in [":", "@", "."]:
+        spec = spec.split(separator, 1)[0]
+    return spec
+
+class RollupRouter(object):
+    """
+    WSGI middleware which sends aggregate queries to pre-aggregated rollup cubes.
+
+    Rollup cubes are identified by their "info" entry in the model (see
+    assets_generator.create_rollup_tables()). An aggregate request is routed
+    to the smallest rollup cube of the requested cube if all dimensions used
+    for drilldown, cuts and ordering are part of the rollup grain and all
+    requested aggregates are provided by the rollup cube. All other requests
+    are passed through unchanged.
+    """
+    def __init__(self, app, model_path):
+        self.app = app
+        self.cube_aggregates = {}
+        self.rollups = {}
+        for cube in read_model_cubes(model_path):
+            aggregates = cube["aggregates"]
+            self.cube_aggregates[cube["name"]] = aggregates
+            info = cube["info"]
+            if "rollup_of" in info:
+                rollup = (cube["name"], set(info["grain"]), set(aggregates))
+                self.rollups.setdefault(info["rollup_of"], []).append(rollup)
+        for rollups in self.rollups.values():
+            rollups.sort(key=lambda rollup: len(rollup[1]))
+
+    def find_rollup(self, cube, params):
+        """
+        Find a rollup cube which is able to answer an aggregate query.
+
+        Args:
+            cube: The name of the requested cube
+            params: A list of (name, value) tuples from the query string
+
+        Returns:
+            The name of the rollup cube or None if no matching cube exists.
+        """
+        if cube not in self.rollups:
+            return None
+        dimensions = set()
+        requested_aggregates = None
+        order_names = set()
+        for name, value in params:
+            if name == "drilldown" or name == "cut":
+                dimensions.update([dimension_name(item) for item in split_list(value)])
+            elif name == "order":
+                order_names.update([dimension_name(item) for item in split_list(value)])
+            elif name == "aggregates":
+                requested_aggregates = set(split_list(value))
+            elif name not in ["page", "pagesize", "format", "callback"]:
+                # split cells and other special options are not supported by rollups
+                return None
+        if requested_aggregates is None:
+            requested_aggregates = set(self.cube_aggregates[cube])
+        for rollup_name, grain, aggregates in self.rollups[cube]:
+            if not dimensions.issubset(grain):
+                continue
+            if not requested_aggregates.issubset(aggregates):
+                continue
+            if not order_names.issubset(grain | aggregates):
+                continue
+            return rollup_name
+        return None
+
+    def __call__(self, environ, start_response):
+        match = AGGREGATE_PATH_RE.match(environ.get("PATH_INFO", ""))
+        if match:
+            cube = match.group("cube")
+            params = urlparse.parse_qsl(environ.get("QUERY_STRING", ""), keep_blank_values=True)
+            rollup = self.find_rollup(cube, params)
+            if rollup is not None:
+                if "aggregates" not in [name for name, _ in params]:
+                    # keep the response identical to the one of the source cube
+                    params.append(("aggregates", "|".join(self.cube_aggregates[cube])))
+                environ["PATH_INFO"] = "/cube/{}/aggregate".format(rollup)
+                environ["QUERY_STRING"] = urllib.urlencode(params)
+        return self.app(environ, start_response)
+
+class InstitutionRouter(object):
+    """
+    WSGI middleware which serves institution cubes from the openapc cube.
+
+    If the model was generated without institution cubes (see the single_cube
+    option of assets_generator.build_model()), requests to
+    /cube/<institution_cubes_name>/... are rewritten to /cube/openapc/... with
+    an additional cut on the institution, so treemaps using the institution
+    cubes as dataset keep working.
+
+    Institution cubes which are part of the model are only rewritten for
+    aggregate requests asking for aggregates they do not offer, like medians
+    and percentiles. A RollupRouter behind this middleware answers those from
+    the institution_publisher rollup of the target cube.
+    """
+    def __init__(self, app, model_path, institutions_file, target_cube="openapc"):
+        self.app = app
+        self.target_cube = target_cube
+        model_aggregates = dict([(cube["name"], set(cube["aggregates"])) for cube in read_model_cubes(model_path)])
+        self.institutions = {}
+        self.model_institutions = {}
+        for row in UnicodeReader(open(institutions_file, "rb")):
+            cubes_name = row["institution_cubes_name"].encode("utf-8")
+            if cubes_name not in model_aggregates:
+                self.institutions[cubes_name] = row["institution"]
+            elif cubes_name != target_cube:
+                self.model_institutions[cubes_name] = (row["institution"], model_aggregates[cubes_name])
+
+    def find_institution(self, cube, endpoint, query_string):
+        """
+        Find the institution of a request which has to be served from the target cube.
+
+        Returns:
+            The institution or None if the request is passed through unchanged.
+        """
+        if cube in self.institutions:
+            return self.institutions[cube]
+        if cube not in self.model_institutions or endpoint != "aggregate":
+            return None
+        institution, aggregates = self.model_institutions[cube]
+        for name, value in urlparse.parse_qsl(query_string, keep_blank_values=True):
+            if name == "aggregates" and not set(split_list(value)).issubset(aggregates):
+                return institution
+        return None
+
+    def rewrite_query_string(self, query_string, institution):
+        """
+        Add a cut on an institution to a query string, keeping all other parameters.
+        """
+        institution_cut = u"institution:" + escape_cut_value(institution)
+        params = urlparse.parse_qsl(query_string, keep_blank_values=True)
+        cut_found = False
+        for i, (name, value) in enumerate(params):
+            if name == "cut" and not cut_found:
+                cuts = split_list(value) + [institution_cut.encode("utf-8")]
+                params[i] = (name, "|".join(cuts))
+                cut_found = True
+        if not cut_found:
+            params.append(("cut", institution_cut.encode("utf-8")))
+        return urllib.urlencode(params)
+
+    def __call__(self, environ, start_response):
+        match = CUBE_PATH_RE.match(environ.get("PATH_INFO", ""))
+        institution = None
+        if match:
+            institution = self.find_institution(match.group("cube"), match.group("endpoint"),
+                                                environ.get("QUERY_STRING", ""))
+        if institution is not None:
+            path = "/cube/{}/{}{}".format(self.target_cube, match.group("endpoint"), match.group("rest") or "")
+            environ["PATH_INFO"] = path
+            environ["QUERY_STRING"] = self.rewrite_query_string(environ.get("QUERY_STRING", ""), institution)
+        return self.app(environ, start_response)
+
+def normalize_query(path, query_string):
+    """
+    Create a normalized representation of a cubes request.
+
+    Parameters are sorted by name and the elements of a cut are sorted, so
+    equivalent requests (like "cut=a:1|b:2" and "cut=b:2|a:1") share the same
+    representation. The order of drilldowns and aggregates is kept, since it
+    influences the response.
+    """
+    return path.rstrip("/") + "?" + normalize_query_string(query_string)
+
+def normalize_query_string(query_string):
+    """
+    Create the normalized form of a query string (see normalize_query()).
+    """
+    params = []
+    for name, value in urlparse.parse_qsl(query_string, keep_blank_values=True):
+        if name == "cut":
+            value = "|".join(sorted(split_list(value)))
+        params.append((name, value))
+    params.sort()
+    return urllib.urlencode(params)
+
+class GenerationStamp(object):
+    """
+    Follows the data generation stamp written by the tables job (see
+    util.write_generation_stamp()). The stamp is only read again when the
+    modification time of its file changes.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.stamp = None
+
+    def current(self):
+        """
+        Returns:
+            The current stamp (a dict with the keys "generation" and
+            "created") or None if no stamp exists.
+        """
+        if self.path is None:
+            return None
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            mtime = None
+        if mtime != self.mtime:
+            self.mtime = mtime
+            self.stamp = read_generation_stamp(self.path) if mtime is not None else None
+        return self.stamp
+
+class MemoryCacheStore(object):
+    """
+    An in-process LRU store for cached responses.
+    """
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.generation = None
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.entries[key] = entry
+            return entry
+
+    def set(self, key, entry):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = entry
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def switch_generation(self, generation):
+        """
+        Discard all entries if they belong to another data generation.
+        """
+        with self.lock:
+            if generation != self.generation:
+                self.generation = generation
+                self.entries.clear()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+class DiskCacheStore(object):
+    """
+    A store for cached responses which can be shared between processes.
+
+    Every entry is kept in a pickle file named after its key. File modification
+    times are used to evict the least recently used entries. The data
+    generation of the entries is recorded in the directory as well, so a
+    starting process keeps the entries cached by the other processes.
+    """
+    def __init__(self, directory, max_entries):
+        self.directory = directory
+        self.max_entries = max_entries
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".cache")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                entry = cPickle.load(f)
+            os.utime(path, None)
+            return entry
+        except (IOError, OSError, EOFError, cPickle.UnpicklingError):
+            return None
+
+    def set(self, key, entry):
+        path = self._path(key)
+        temp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(temp_path, "wb") as f:
+            cPickle.dump(entry, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(temp_path, path)
+        files = self._files()
+        if len(files) > self.max_entries:
+            files.sort(key=lambda path: os.path.getmtime(path) if os.path.exists(path) else 0)
+            for path in files[:len(files) - self.max_entries]:
+                self._remove(path)
+
+    def switch_generation(self, generation):
+        """
+        Discard all entries if the generation recorded in the directory differs.
+        """
+        path = os.path.join(self.directory, DISK_CACHE_GENERATION_FILE)
+        try:
+            with open(path) as f:
+                recorded = f.read()
+        except IOError:
+            recorded = None
+        if recorded == (generation or ""):
+            return
+        self.clear()
+        temp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(temp_path, "w") as f:
+            f.write(generation or "")
+        os.rename(temp_path, path)
+
+    def _files(self):
+        return [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                if name.endswith(".cache")]
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def clear(self):
+        for path in self._files():
+            self._remove(path)
+
+    def __len__(self):
+        return len(self._files())
+
+class QueryCache(object):
+    """
+    WSGI middleware caching successful GET responses of the cubes API.
+
+    Requests are identified by their normalized query (see normalize_query())
+    and the current data generation stamp, which is written by the tables
+    job. Whenever the stamp changes, all cached responses are discarded.
+
+    The Origin header of a request is part of its key, since the CORS headers
+    of a response depend on it. Responses carry a Vary: Origin header, so
+    shared caches keep them apart as well.
+
+    Two additional endpoints are offered: /cache/stats returns hit and miss
+    counters, a POST request to /cache/purge (only accepted from localhost)
+    removes all cached responses.
+    """
+    def __init__(self, app, store, ttl=None, generation_file=None):
+        self.app = app
+        self.store = store
+        self.ttl = ttl
+        self.stamp = GenerationStamp(generation_file)
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self.check_generation()
+
+    def check_generation(self):
+        stamp = self.stamp.current()
+        generation = stamp["generation"] if stamp else None
+        if generation != self.generation:
+            self.generation = generation
+            self.store.switch_generation(generation)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self.store),
+            "generation": self.generation
+        }
+
+    def __call__(self, environ, start_response):
+        path = environ.get("PATH_INFO", "")
+        method = environ.get("REQUEST_METHOD", "GET")
+        if path == "/cache/stats":
+            return _json_response(start_response, "200 OK", self.stats())
+        if path == "/cache/purge":
+            if method != "POST":
+                return _json_response(start_response, "405 Method Not Allowed", {"error": "use POST"})
+            if environ.get("REMOTE_ADDR") not in LOCAL_ADDRESSES:
+                return _json_response(start_response, "403 Forbidden", {"error": "purging is only allowed from localhost"})
+            self.store.clear()
+            return _json_response(start_response, "200 OK", self.stats())
+        match = CUBE_PATH_RE.match(path)
+        if method != "GET" or not match or match.group("endpoint") in STREAMING_ENDPOINTS:
+            return self.app(environ, start_response)
+        self.check_generation()
+        normalized = normalize_query(path, environ.get("QUERY_STRING", ""))
+        origin = environ.get("HTTP_ORIGIN", "")
+        key = hashlib.sha1("{}|{}|{}".format(self.generation, origin, normalized)).hexdigest()
+        entry = self.store.get(key)
+        if entry is not None and (entry["expires"] is None or entry["expires"] > time.time()):
+            self.hits += 1
+            start_response(entry["status"], entry["headers"] + [("X-Cache", "HIT")])
+            return [entry["body"]]
+        self.misses += 1
+        status, headers, body = _call_app(self.app, environ)
+        if not _varies_on(headers, "Origin"):
+            headers = headers + [("Vary", "Origin")]
+        if status.startswith("200"):
+            expires = time.time() + self.ttl if self.ttl else None
+            self.store.set(key, {"status": status, "headers": headers, "body": body, "expires": expires})
+        start_response(status, headers + [("X-Cache", "MISS")])
+        return [body]
+
+def _varies_on(headers, header_name):
+    """
+    Check whether the Vary headers of a response contain a header name.
+    """
+    for name, value in headers:
+        if name.lower() == "vary" and \
+                header_name.lower() in [field.strip().lower() for field in value.split(",")]:
+            return True
+    return False
+
+def _etag_values(header):
+    """
+    Parse an If-None-Match header into a set of opaque tags, ignoring the
+    weak indicator (weak comparison, as required for If-None-Match).
+    """
+    values = set()
+    for value in header.split(","):
+        value = value.strip()
+        if value.startswith("W/"):
+            value = value[2:]
+        if value:
+            values.add(value)
+    return values
+
+class ConditionalGet(object):
+    """
+    WSGI middleware adding cache validators to cube API responses and
+    answering revalidations with 304 Not Modified.
+
+    The data only changes when the tables job writes a new data generation
+    stamp, so the ETag of a response is derived from the generation and the
+    normalized query (see normalize_query()) and the Last-Modified date is
+    the creation time of the stamp. A revalidation (a request with a
+    matching If-None-Match header or, without one, an If-Modified-Since
+    date not older than the stamp) is answered with 304 without calling the
+    app if the app already answered the query with 200 in this generation.
+    Otherwise the app is called and a 200 response is turned into a 304,
+    any other status is sent unchanged. At most max_tags tags are
+    remembered per generation. Without a stamp, requests are passed through
+    unchanged.
+    """
+    def __init__(self, app, generation_file, max_age=0, max_tags=100000):
+        self.app = app
+        self.stamp = GenerationStamp(generation_file)
+        self.max_age = max_age
+        self.max_tags = max_tags
+        self.generation = None
+        # ETags of the 200 responses in the current generation
+        self.issued = set()
+
+    def remember(self, generation, etag):
+        if generation != self.generation:
+            self.generation = generation
+            self.issued = set()
+        if len(self.issued) >= self.max_tags:
+            self.issued.clear()
+        self.issued.add(etag)
+
+    def __call__(self, environ, start_response):
+        match = CUBE_PATH_RE.match(environ.get("PATH_INFO", ""))
+        stamp = self.stamp.current()
+        if environ.get("REQUEST_METHOD", "GET") != "GET" or not match or stamp is None or \
+                match.group("endpoint") in STREAMING_ENDPOINTS:
+            return self.app(environ, start_response)
+        generation = stamp["generation"]
+        normalized = normalize_query(environ["PATH_INFO"], environ.get("QUERY_STRING", ""))
+        # weak, since compressed and uncompressed representations share the tag
+        etag = 'W/"{}"'.format(hashlib.sha1("{}|{}".format(generation, normalized)).hexdigest())
+        modified = calendar.timegm(time.strptime(stamp["created"], "%Y-%m-%dT%H:%M:%SZ"))
+        validators = [
+            ("ETag", etag),
+            ("Last-Modified", formatdate(modified, usegmt=True)),
+            ("Cache-Control", "public, max-age={}".format(self.max_age))
+        ]
+        if_none_match = environ.get("HTTP_IF_NONE_MATCH")
+        if if_none_match is not None:
+            values = _etag_values(if_none_match)
+            not_modified = "*" in values or etag[2:] in values
+        else:
+            since = parsedate_tz(environ.get("HTTP_IF_MODIFIED_SINCE", ""))
+            not_modified = since is not None and modified <= mktime_tz(since)
+        if not_modified and generation == self.generation and etag in self.issued:
+            start_response("304 Not Modified", validators)
+            return []
+        if not_modified:
+            status, headers, body = _call_app(self.app, environ)
+            if status.startswith("200"):
+                self.remember(generation, etag)
+                start_response("304 Not Modified", validators)
+                return []
+            start_response(status, headers)
+            return [body]
+
+        def validated_start_response(status, headers, exc_info=None):
+            if status.startswith("200"):
+                self.remember(generation, etag)
+                headers = headers + validators
+            return start_response(status, headers, exc_info)
+        return self.app(environ, validated_start_response)
+
+COMPRESSIBLE_TYPES = ["application/json", "application/javascript", "text/"]
+
+class Compression(object):
+    """
+    WSGI middleware compressing large responses with brotli (if the brotli
+    module is installed and the client accepts it) or gzip.
+
+    Only bodies of at least min_size bytes with a textual content type (see
+    COMPRESSIBLE_TYPES) are compressed. Responses of the streaming endpoints
+    are passed through unchanged.
+    """
+    def __init__(self, app, min_size=1024, level=6):
+        self.app = app
+        self.min_size = min_size
+        self.level = level
+
+    def choose_encoding(self, accept_encoding):
+        """
+        Choose the content coding for an Accept-Encoding header.
+
+        Returns:
+            "br", "gzip" or None
+        """
+        qualities = {}
+        for item in accept_encoding.split(","):
+            parts = item.split(";")
+            coding = parts[0].strip().lower()
+            quality = 1.0
+            for parameter in parts[1:]:
+                name, _, value = parameter.partition("=")
+                if name.strip() == "q":
+                    try:
+                        quality = float(value)
+                    except ValueError:
+                        quality = 0.0
+            if coding:
+                qualities[coding] = quality
+        codings = ["br", "gzip"] if brotli is not None else ["gzip"]
+        for coding in codings:
+            if qualities.get(coding, qualities.get("*", 0.0)) > 0:
+                return coding
+        return None
+
+    def compress(self, body, encoding):
+        if encoding == "br":
+            return brotli.compress(body, quality=min(self.level, 11))
+        # wbits 16 + MAX_WBITS writes a gzip header and trailer
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(body) + compressor.flush()
+
+    def __call__(self, environ, start_response):
+        match = CUBE_PATH_RE.match(environ.get("PATH_INFO", ""))
+        if match and match.group("endpoint") in STREAMING_ENDPOINTS:
+            return self.app(environ, start_response)
+        encoding = self.choose_encoding(environ.get("HTTP_ACCEPT_ENCODING", ""))
+        if encoding is None:
+            def vary_start_response(status, headers, exc_info=None):
+                return start_response(status, headers + [("Vary", "Accept-Encoding")], exc_info)
+            return self.app(environ, vary_start_response)
+        status, headers, body = _call_app(self.app, environ)
+        header_names = dict([(name.lower(), value) for name, value in headers])
+        content_type = header_names.get("content-type", "")
+        if status.startswith("200") and len(body) >= self.min_size and "content-encoding" not in header_names \
+                and any([content_type.startswith(prefix) for prefix in COMPRESSIBLE_TYPES]):
+            body = self.compress(body, encoding)
+            headers = [(name, value) for name, value in headers if name.lower() != "content-length"]
+            headers += [("Content-Encoding", encoding), ("Content-Length", str(len(body)))]
+        start_response(status, headers + [("Vary", "Accept-Encoding")])
+        return [body]
+
+# Upper bounds of the histogram buckets for durations (seconds) and row counts
+DURATION_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+ROW_BUCKETS = [1, 10, 100, 1000, 10000, 100000]
+
+# name -> (type, help text, buckets)
+METRICS = OrderedDict([
+    ("openapc_request_duration_seconds",
+     ("histogram", "Duration of cubes API requests, including cache hits", DURATION_BUCKETS)),
+    ("openapc_request_sql_duration_seconds",
+     ("histogram", "Total duration of the SQL statements executed for a cubes API request", DURATION_BUCKETS)),
+    ("openapc_sql_statement_duration_seconds",
+     ("histogram", "Duration of single SQL statements", DURATION_BUCKETS)),
+    ("openapc_sql_statement_rows",
+     ("histogram", "Number of rows returned or affected by single SQL statements", ROW_BUCKETS)),
+    ("openapc_sql_slow_statements_total",
+     ("counter", "Number of SQL statements slower than the slow query threshold", None)),
+    ("openapc_sql_statement_timeouts_total",
+     ("counter", "Number of requests failed because a SQL statement exceeded the statement timeout", None)),
+    ("openapc_admission_wait_seconds",
+     ("histogram", "Time requests waited for a slot of their cost class", DURATION_BUCKETS)),
+    ("openapc_admission_rejected_total",
+     ("counter", "Number of requests rejected because all slots of their cost class were taken", None))
+])
+
+SLOW_QUERY_LOGGER = "openapc.slow_queries"
+
+class RollingHistogram(object):
+    """
+    A histogram of the observations made during a sliding time window.
+
+    The window is divided into slots, observations older than the window are
+    dropped slot by slot.
+    """
+    def __init__(self, buckets, window=300.0, num_slots=5):
+        self.buckets = buckets
+        self.slot_length = float(window) / num_slots
+        self.num_slots = num_slots
+        # slot number -> [bucket counts (one more than buckets for +Inf), sum]
+        self.slots = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, now=None):
+        slot_number = int((now or time.time()) // self.slot_length)
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            slot = self.slots.get(slot_number)
+            if slot is None:
+                slot = [[0] * (len(self.buckets) + 1), 0.0]
+                self.slots[slot_number] = slot
+                for number in self.slots.keys():
+                    if number <= slot_number - self.num_slots:
+                        del self.slots[number]
+            slot[0][index] += 1
+            slot[1] += value
+
+    def snapshot(self, now=None):
+        """
+        Returns:
+            A tuple (cumulative bucket counts, sum, count), the last bucket being +Inf.
+        """
+        oldest = int((now or time.time()) // self.slot_length) - self.num_slots + 1
+        counts = [0] * (len(self.buckets) + 1)
+        total = 0.0
+        with self.lock:
+            for number, (slot_counts, slot_sum) in self.slots.items():
+                if number >= oldest:
+                    counts = [count + slot_count for count, slot_count in zip(counts, slot_counts)]
+                    total += slot_sum
+        cumulative = []
+        running = 0
+        for count in counts:
+            running += count
+            cumulative.append(running)
+        return (cumulative, total, running)
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = []
+    for name, value in labels:
+        value = unicode(value).replace(u"\\", u"\\\\").replace(u"\"", u"\\\"").replace(u"\n", u"\\n")
+        escaped.append(u'{}="{}"'.format(name, value))
+    return u"{" + u",".join(escaped) + u"}"
+
+def _format_number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class MetricsRegistry(object):
+    """
+    Rolling histograms and counters (see METRICS), identified by name and labels.
+    """
+    def __init__(self, window=300.0):
+        self.window = window
+        self.histograms = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def observe(self, name, labels, value):
+        key = (name, tuple(labels))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(key, RollingHistogram(METRICS[name][2], self.window))
+        histogram.observe(value)
+
+    def increment(self, name, labels, value=1):
+        key = (name, tuple(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def render(self):
+        """
+        Render all metrics in the Prometheus text exposition format.
+
+        Histograms cover the observations of the last window, so their values
+        may decrease. Counters are totals since the start of the process.
+        """
+        now = time.time()
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+        lines = []
+        for name, (metric_type, help_text, buckets) in METRICS.iteritems():
+            lines.append(u"# HELP {} {}".format(name, help_text))
+            if metric_type == "counter":
+                lines.append(u"# TYPE {} counter".format(name))
+                for (counter_name, labels), value in counters:
+                    if counter_name == name:
+                        lines.append(u"{}{} {}".format(name, _format_labels(labels), value))
+                continue
+            lines.append(u"# TYPE {} histogram".format(name))
+            for (histogram_name, labels), histogram in histograms:
+                if histogram_name != name:
+                    continue
+                counts, total, count = histogram.snapshot(now)
+                for bound, bucket_count in zip(buckets + [float("inf")], counts):
+                    bucket_labels = list(labels) + [("le", _format_number(bound))]
+                    lines.append(u"{}_bucket{} {}".format(name, _format_labels(bucket_labels), bucket_count))
+                lines.append(u"{}_sum{} {}".format(name, _format_labels(labels), _format_number(total)))
+                lines.append(u"{}_count{} {}".format(name, _format_labels(labels), count))
+        return (u"\n".join(lines) + u"\n").encode("utf-8")
+
+class _TimedResponse(object):
+    """
+    Wraps a WSGI response iterable, the request is finished when it is closed.
+    """
+    def __init__(self, result, finish):
+        self.result = result
+        self.finish = finish
+
+    def __iter__(self):
+        return iter(self.result)
+
+    def close(self):
+        try:
+            if hasattr(self.result, "close"):
+                self.result.close()
+        finally:
+            self.finish()
+
+class MetricsMiddleware(object):
+    """
+    WSGI middleware recording latency metrics of the cubes API and its SQL statements.
+
+    Requests to cube endpoints are timed (until the response has been sent
+    completely) and labeled with the cube, the endpoint (like aggregate,
+    members or facts) and the sorted drilldown dimensions. Cubes and
+    dimensions which are not part of the model, as well as unknown endpoints,
+    are labeled "other", so clients cannot create arbitrary label values.
+    SQL statements are timed using SQLAlchemy engine events (see
+    instrument_sql()) and attributed to the request of the current thread,
+    so the time spent in PostgreSQL can be told apart from the time spent in
+    cubes. Statements slower than slow_query_threshold (seconds) are logged
+    with their SQL and parameters to the "openapc.slow_queries" logger.
+
+    The metrics are served at /metrics in the Prometheus text format, only
+    to clients from allowed_addresses (default: localhost).
+    """
+    def __init__(self, app, registry, model_path, slow_query_threshold=None, allowed_addresses=None):
+        self.app = app
+        self.registry = registry
+        self.slow_query_threshold = slow_query_threshold
+        self.allowed_addresses = allowed_addresses if allowed_addresses is not None else LOCAL_ADDRESSES
+        self.cube_dimensions = dict([(cube["name"], set(cube["dimensions"])) for cube in read_model_cubes(model_path)])
+        self.local = threading.local()
+        self.slow_query_log = logging.getLogger(SLOW_QUERY_LOGGER)
+
+    def instrument_sql(self):
+        """
+        Time every SQL statement executed by any SQLAlchemy engine in this process.
+        """
+        from sqlalchemy import event
+        from sqlalchemy.engine import Engine
+        event.listen(Engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", self._after_cursor_execute)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("openapc_statement_start", []).append(time.time())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get("openapc_statement_start")
+        if not starts:
+            return
+        duration = time.time() - starts.pop()
+        request = getattr(self.local, "request", None)
+        cube = request["cube"] if request else ""
+        statement_type = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ""
+        labels = [("cube", cube), ("statement", statement_type)]
+        self.registry.observe("openapc_sql_statement_duration_seconds", labels, duration)
+        rows = getattr(cursor, "rowcount", -1)
+        if rows is not None and rows >= 0:
+            self.registry.observe("openapc_sql_statement_rows", labels, rows)
+        if request is not None:
+            request["sql_duration"] += duration
+        if self.slow_query_threshold is not None and duration >= self.slow_query_threshold:
+            self.registry.increment("openapc_sql_slow_statements_total", [("cube", cube)])
+            msg = "Slow SQL statement ({:.3f}s, {} rows) for request {}:\n{}\nParameters: {!r}"
+            self.slow_query_log.warning(msg.format(duration, rows, request["url"] if request else "-",
+                                                   statement, parameters))
+
+    def request_labels(self, cube, endpoint, query_string):
+        """
+        Create the labels of a cube API request.
+
+        Returns:
+            A list of (name, value) tuples for the labels cube, endpoint and
+            drilldown
+        """
+        dimensions = self.cube_dimensions.get(cube)
+        if dimensions is None:
+            cube = OTHER_LABEL
+            dimensions = set()
+        if endpoint not in METRICS_ENDPOINTS:
+            endpoint = OTHER_LABEL
+        params = urlparse.parse_qsl(query_string, keep_blank_values=True)
+        drilldown = set()
+        for name, value in params:
+            if name == "drilldown":
+                for item in split_list(value):
+                    dimension = dimension_name(item)
+                    drilldown.add(dimension if dimension in dimensions else OTHER_LABEL)
+        return [("cube", cube), ("endpoint", endpoint), ("drilldown", "|".join(sorted(drilldown)))]
+
+    def __call__(self, environ, start_response):
+        path = environ.get("PATH_INFO", "")
+        if path == "/metrics":
+            if environ.get("REMOTE_ADDR") not in self.allowed_addresses:
+                return _json_response(start_response, "403 Forbidden",
+                                      {"error": "metrics are only available to the allowed addresses"})
+            body = self.registry.render()
+            start_response("200 OK", [("Content-Type", "text/plain; version=0.0.4; charset=utf-8"),
+                                      ("Content-Length", str(len(body)))])
+            return [body]
+        match = CUBE_PATH_RE.match(path)
+        if not match:
+            return self.app(environ, start_response)
+        labels = self.request_labels(match.group("cube"), match.group("endpoint"), environ.get("QUERY_STRING", ""))
+        query_string = environ.get("QUERY_STRING", "")
+        request = {
+            "cube": labels[0][1],
+            "url": path + ("?" + query_string if query_string else ""),
+            "sql_duration": 0.0
+        }
+        start = time.time()
+        self.local.request = request
+
+        def finish():
+            self.local.request = None
+            self.registry.observe("openapc_request_duration_seconds", labels, time.time() - start)
+            self.registry.observe("openapc_request_sql_duration_seconds", labels, request["sql_duration"])
+
+        try:
+            result = self.app(environ, start_response)
+        except:
+            finish()
+            raise
+        return _TimedResponse(result, finish)
+
+class _ConcurrencyBudget(object):
+    """
+    A counting semaphore whose acquire() gives up after a timeout.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, timeout):
+        deadline = time.time() + timeout
+        with self.condition:
+            while self.active >= self.limit:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            self.active += 1
+            return True
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+class AdmissionControl(object):
+    """
+    WSGI middleware limiting the number of concurrent requests per cost class.
+
+    Requests to cube endpoints are either "heavy" or "light". Heavy requests
+    return single articles: fact lists and exports, drilldowns to one of the leaf
+    dimensions (like doi, unless it is cut to specific values as well) and
+    member lists of the leaf dimensions. Every class has its own budget of
+    concurrent requests (0 meaning unlimited). A request which does not get a
+    slot within queue_timeout seconds is answered with 503 right away, so a
+    few expensive queries cannot occupy all workers and database connections
+    while the cheap treemap queries queue up behind them.
+    """
+    def __init__(self, app, leaf_dimensions, heavy_concurrency, light_concurrency=0, queue_timeout=0.0,
+                 registry=None):
+        self.app = app
+        self.leaf_dimensions = set(leaf_dimensions)
+        self.budgets = {}
+        if heavy_concurrency:
+            self.budgets["heavy"] = _ConcurrencyBudget(heavy_concurrency)
+        if light_concurrency:
+            self.budgets["light"] = _ConcurrencyBudget(light_concurrency)
+        self.queue_timeout = queue_timeout
+        self.registry = registry
+
+    def cost_class(self, endpoint, rest, params):
+        """
+        Get the cost class of a request to a cube endpoint.
+
+        Args:
+            endpoint: The endpoint, like aggregate, members or facts
+            rest: The remainder of the path after the endpoint (or None)
+            params: A list of (name, value) tuples from the query string
+
+        Returns:
+            "heavy" or "light"
+        """
+        if endpoint == "facts" or endpoint in STREAMING_ENDPOINTS:
+            return "heavy"
+        if endpoint == "members" and rest and dimension_name(rest.strip("/")) in self.leaf_dimensions:
+            return "heavy"
+        drilldown = set()
+        cuts = set()
+        for name, value in params:
+            if name == "drilldown":
+                drilldown.update([dimension_name(item) for item in split_list(value)])
+            elif name == "cut":
+                cuts.update([dimension_name(item) for item in split_list(value) if not item.startswith("!")])
+        if (drilldown - cuts) & self.leaf_dimensions:
+            return "heavy"
+        return "light"
+
+    def __call__(self, environ, start_response):
+        match = CUBE_PATH_RE.match(environ.get("PATH_INFO", ""))
+        if not match:
+            return self.app(environ, start_response)
+        params = urlparse.parse_qsl(environ.get("QUERY_STRING", ""), keep_blank_values=True)
+        cost_class = self.cost_class(match.group("endpoint"), match.group("rest"), params)
+        budget = self.budgets.get(cost_class)
+        if budget is None:
+            return self.app(environ, start_response)
+        start = time.time()
+        admitted = budget.acquire(self.queue_timeout)
+        labels = [("class", cost_class)]
+        if self.registry is not None:
+            self.registry.observe("openapc_admission_wait_seconds", labels, time.time() - start)
+        if not admitted:
+            if self.registry is not None:
+                self.registry.increment("openapc_admission_rejected_total", labels)
+            body = json.dumps({
+                "error": "overloaded",
+                "message": "Too many concurrent {} requests, please try again later".format(cost_class)
+            })
+            start_response("503 Service Unavailable", [("Content-Type", "application/json"),
+                                                       ("Content-Length", str(len(body))),
+                                                       ("Retry-After", "1")])
+            return [body]
+        try:
+            result = self.app(environ, start_response)
+        except:
+            budget.release()
+            raise
+        # the slot is held until the response has been sent completely
+        return _TimedResponse(result, budget.release)
+
+def set_statement_timeout(engine, timeout):
+    """
+    Let PostgreSQL cancel statements running longer than timeout seconds on
+    all connections of a SQLAlchemy engine.
+    """
+    from sqlalchemy import event
+    def set_timeout(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("SET statement_timeout = {}".format(int(timeout * 1000)))
+        cursor.close()
+        # otherwise the setting is undone when the pool rolls the connection back
+        dbapi_connection.commit()
+    event.listen(engine, "connect", set_timeout)
+
+def install_statement_timeout(app, workspace, timeout, registry=None):
+    """
+    Limit the run time of the SQL statements of the default store of a cubes
+    workspace (PostgreSQL only). Requests failing because of the timeout are
+    answered with 503.
+
+    Args:
+        app: The Flask app serving the slicer blueprint
+        workspace: The cubes Workspace of the app
+        timeout: The statement timeout in seconds
+        registry: A MetricsRegistry counting the timeouts or None
+    """
+    from flask import jsonify
+    from sqlalchemy.exc import OperationalError
+    store = workspace.get_store("default")
+    engine = getattr(store, "connectable", None) or getattr(store, "engine", None)
+    if engine is None or engine.dialect.name != "postgresql":
+        return
+    set_statement_timeout(engine, timeout)
+
+    def statement_timeout_error(error):
+        # 57014: query_canceled
+        if getattr(error.orig, "pgcode", None) != "57014":
+            raise
+        if registry is not None:
+            registry.increment("openapc_sql_statement_timeouts_total", [])
+        response = jsonify({
+            "error": "query_timeout",
+            "message": "The query took too long, please add cuts or drill down to fewer levels"
+        })
+        response.status_code = 503
+        return response
+    app.register_error_handler(OperationalError, statement_timeout_error)
+
+def setup_middleware(app, config):
+    """
+    Install all middleware enabled in the slicer configuration on a Flask app.
+
+    Args:
+        app: The Flask app serving the slicer blueprint
+        config: A ConfigParser instance holding the slicer configuration
+    """
+    model_path = _get_option(config, "model", "path", "model.json")
+    workspace = getattr(app, "cubes_workspace", None)
+    max_cubes = _get_int_option(config, "model", "max_cubes")
+    if max_cubes and workspace is not None:
+        from lazy_model import install_cube_cache
+        install_cube_cache(workspace, max_cubes)
+    registry = None
+    if _get_boolean_option(config, "metrics", "enabled"):
+        registry = MetricsRegistry(_get_float_option(config, "metrics", "window", 300.0))
+    # rollup cubes are of no use for the memory store, which aggregates the source cubes directly
+    memory_store = _get_option(config, "store", "type") == "memory"
+    if _get_boolean_option(config, "rollups", "enabled") and not memory_store:
+        app.wsgi_app = RollupRouter(app.wsgi_app, model_path)
+    if _get_boolean_option(config, "institutions", "routing"):
+        # outside of the rollup router, which has to see the institution cut
+        institutions_file = _get_option(config, "institutions", "file", "static/institutions.csv")
+        app.wsgi_app = InstitutionRouter(app.wsgi_app, model_path, institutions_file)
+    statement_timeout = _get_float_option(config, "limits", "statement_timeout")
+    if statement_timeout and workspace is not None:
+        install_statement_timeout(app, workspace, statement_timeout, registry)
+    heavy_concurrency = _get_int_option(config, "limits", "heavy_concurrency", 0)
+    light_concurrency = _get_int_option(config, "limits", "light_concurrency", 0)
+    if heavy_concurrency or light_concurrency:
+        # inside of the cache, answers from the cache do not take a slot
+        leaf_dimensions = split_list(_get_option(config, "limits", "leaf_dimensions", "doi"))
+        queue_timeout = _get_float_option(config, "limits", "queue_timeout", 0.5)
+        app.wsgi_app = AdmissionControl(app.wsgi_app, leaf_dimensions, heavy_concurrency, light_concurrency,
+                                        queue_timeout, registry)
+    if _get_boolean_option(config, "cache", "enabled"):
+        max_entries = _get_int_option(config, "cache", "max_entries", 1000)
+        directory = _get_option(config, "cache", "directory")
+        if directory:
+            store = DiskCacheStore(directory, max_entries)
+        else:
+            store = MemoryCacheStore(max_entries)
+        ttl = _get_float_option(config, "cache", "ttl")
+        generation_file = _get_option(config, "cache", "generation_file", "data_generation.json")
+        app.wsgi_app = QueryCache(app.wsgi_app, store, ttl, generation_file)
+    compress_min_size = _get_int_option(config, "http", "compress_min_size")
+    if compress_min_size is not None:
+        app.wsgi_app = Compression(app.wsgi_app, compress_min_size)
+    if _get_boolean_option(config, "http", "validators"):
+        # outside of the cache and the compression, revalidations are answered before both
+        generation_file = _get_option(config, "cache", "generation_file", "data_generation.json")
+        app.wsgi_app = ConditionalGet(app.wsgi_app, generation_file, _get_int_option(config, "http", "max_age", 0))
+    if registry is not None:
+        # outermost, so requests answered from the cache are measured as well
+        allowed_addresses = _get_option(config, "metrics", "allowed_addresses")
+        if allowed_addresses is not None:
+            allowed_addresses = [address.strip() for address in allowed_addresses.split(",") if address.strip()]
+        metrics = MetricsMiddleware(app.wsgi_app, registry, model_path,
+                                    _get_float_option(config, "metrics", "slow_query_threshold"), allowed_addresses)
+        metrics.instrument_sql()
+        slow_query_log = _get_option(config, "metrics", "slow_query_log")
+        if slow_query_log:
+            handler = logging.FileHandler(slow_query_log)
+            handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+            logger = logging.getLogger(SLOW_QUERY_LOGGER)
+            logger.addHandler(handler)
+            logger.setLevel(logging.WARNING)
+        app.wsgi_app = metrics
@@ -3,12 +3,23 @@ from ConfigParser import SafeConfigParser as ConfigParser
 from cubes.server import slicer
 from flask.ext.cors import CORS
 
+from aggregate_functions import register_aggregate_functions
+from facts_export import export
+import lazy_model # registers the "lazy" model provider
+import memory_store # registers the "memory" store type
+from olap_middleware import setup_middleware
+
+
+# aggregate functions of the rollup cubes and the quantile aggregates
+register_aggregate_functions()
 
 app = Flask(__name__)
 CORS(app)
 config_parser = ConfigParser()
 config_parser.read("slicer.ini")
 app.register_blueprint(slicer, config=config_parser)
+app.register_blueprint(export)
+setup_middleware(app, config_parser)
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=3001)
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+import atexit
+from collections import OrderedDict
+import cProfile
+import resource
+import sys
+import threading
+import time
+
+from util import colorise
+
+# Minimum number of seconds between two progress messages of the same stage
+PROGRESS_INTERVAL = 10.0
+
+def _max_rss():
+    """
+    Returns:
+        The peak resident set size of the process in bytes
+    """
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+def _megabytes(num_bytes):
+    return num_bytes / (1024.0 * 1024.0)
+
+class StageStats(object):
+    """
+    Accumulated measurements of a named stage.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.duration = 0.0
+        self.items = 0
+        self.peak_rss = 0
+        self.rss_growth = 0
+        self.last_progress = time.time()
+
+class _StageTimer(object):
+    def __init__(self, profiler, name, items):
+        self.profiler = profiler
+        self.name = name
+        self.items = items
+
+    def __enter__(self):
+        self.start = time.time()
+        self.start_rss = _max_rss()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.record(self.name, time.time() - self.start, self.items, self.start_rss, _max_rss())
+        return False
+
+class _NullTimer(object):
+    items = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+NULL_TIMER = _NullTimer()
+
+class StageProfiler(object):
+    """
+    Collect timings, throughput and memory usage of the stages of a job.
+
+    A stage is timed with a with statement and may be entered any number of
+    times (by several threads as well), all measurements are accumulated:
+
+        with PROFILER.stage("APC inserts") as stage:
+            ...
+            stage.items += len(rows)
+
+    Stages may be nested, the time of an inner stage is then part of the
+    outer one. Memory usage is measured as the peak resident set size of the
+    process after a stage, the growth column shows by how much the stage
+    raised the peak. While the profiler is disabled, stage() does nothing.
+
+    Once enabled, a summary table is printed when the process exits. If a
+    cProfile output path is given, the main thread is profiled as well and
+    the profile is written to that path (readable with pstats).
+    """
+    def __init__(self):
+        self.enabled = False
+        self.stages = OrderedDict()
+        self.lock = threading.Lock()
+        self.start_time = None
+        self.profile = None
+        self.profile_output = None
+
+    def enable(self, profile_output=None):
+        if self.enabled:
+            return
+        self.enabled = True
+        self.start_time = time.time()
+        if profile_output:
+            self.profile_output = profile_output
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        atexit.register(self.finish)
+
+    def stage(self, name, items=0):
+        """
+        Create a context manager timing a stage.
+
+        Args:
+            name: The name of the stage
+            items: The number of items processed, can be increased using
+                   the items attribute of the context manager
+        """
+        if not self.enabled:
+            return NULL_TIMER
+        return _StageTimer(self, name, items)
+
+    def record(self, name, duration, items, start_rss, end_rss):
+        with self.lock:
+            stats = self.stages.get(name)
+            if stats is None:
+                stats = StageStats(name)
+                self.stages[name] = stats
+            stats.calls += 1
+            stats.duration += duration
+            stats.items += items
+            stats.peak_rss = max(stats.peak_rss, end_rss)
+            stats.rss_growth += end_rss - start_rss
+            now = time.time()
+            if now - stats.last_progress < PROGRESS_INTERVAL:
+                return
+            stats.last_progress = now
+        msg = u"[profile] {}: {} calls, {} items in {:.1f}s so far"
+        print colorise(msg.format(name, stats.calls, stats.items, stats.duration), "cyan")
+
+    def summary(self):
+        """
+        Returns:
+            The summary table as a list of lines
+        """
+        total = time.time() - self.start_time
+        header = u"{:<40} {:>8} {:>10} {:>6} {:>10} {:>12} {:>10} {:>11}".format(
+            "Stage", "Calls", "Time (s)", "Share", "Items", "Items/s", "Peak (MB)", "Growth (MB)")
+        lines = [header, u"-" * len(header)]
+        with self.lock:
+            stages = self.stages.values()
+        for stats in stages:
+            rate = u"{:.0f}".format(stats.items / stats.duration) if stats.items and stats.duration > 0 else u"-"
+            lines.append(u"{:<40} {:>8} {:>10.2f} {:>5.1f}% {:>10} {:>12} {:>10.1f} {:>11.1f}".format(
+                stats.name[:40], stats.calls, stats.duration, 100.0 * stats.duration / total if total > 0 else 0,
+                stats.items or u"-", rate, _megabytes(stats.peak_rss), _megabytes(stats.rss_growth)))
+        lines.append(u"-" * len(header))
+        lines.append(u"Total run time: {:.2f}s, peak memory: {:.1f} MB".format(total, _megabytes(_max_rss())))
+        return lines
+
+    def finish(self):
+        """
+        Print the summary table and write the cProfile data, if enabled.
+        """
+        if not self.enabled:
+            return
+        self.enabled = False
+        if self.profile is not None:
+            self.profile.disable()
+            self.profile.dump_stats(self.profile_output)
+        print colorise("Profile summary:", "blue")
+        for line in self.summary():
+            print line
+        if self.profile is not None:
+            print u"cProfile data written to {}".format(self.profile_output)
+
+# The profiler shared by all modules, enabled by the --profile option of assets_generator.py
+PROFILER = StageProfiler()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+
+import math
+
+import sqlalchemy
+
+# Quantile sketches are histograms over logarithmic buckets: bucket 1 holds all
+# values below SKETCH_MIN_VALUE, bucket b > 1 holds the values in
+# [gamma^(b-2), gamma^(b-1)). Every value of a bucket is represented by a value
+# with a relative error of at most SKETCH_RELATIVE_ACCURACY. Sketches are
+# merged by adding the counts of equal buckets, so merged sketches answer
+# quantile queries with the same error bound as a sketch built from all values.
+SKETCH_RELATIVE_ACCURACY = 0.01
+SKETCH_MIN_VALUE = 1.0
+# Larger values are counted in the last bucket
+SKETCH_MAX_VALUE = 1000000.0
+SKETCH_GAMMA = (1 + SKETCH_RELATIVE_ACCURACY) / (1 - SKETCH_RELATIVE_ACCURACY)
+SKETCH_LOG_GAMMA = math.log(SKETCH_GAMMA)
+SKETCH_NUM_BUCKETS = 2 + int(math.ceil(math.log(SKETCH_MAX_VALUE / SKETCH_MIN_VALUE) / SKETCH_LOG_GAMMA))
+
+# Quantile aggregate functions of the rollup cubes ("sketch_<name>"), they
+# merge the sketches stored in a measure.
+QUANTILES = [
+    ("median", 0.5),
+    ("p90", 0.9)
+]
+
+# Functions and aggregates created in the public schema of the database (see
+# create_sketch_functions()). A stored sketch is a two-dimensional integer
+# array of (bucket, count) pairs, ordered by bucket, aggregates work on dense
+# arrays of bucket counts.
+SKETCH_FUNCTIONS_SQL = """
+CREATE OR REPLACE FUNCTION public.apc_sketch_bucket(value double precision) RETURNS integer AS $$
+    SELECT CASE WHEN value < {min_value!r} THEN 1
+                ELSE least(2 + floor(ln(value / {min_value!r}) / {log_gamma!r})::integer, {num_buckets})
+           END
+$$ LANGUAGE sql IMMUTABLE STRICT;
+
+CREATE OR REPLACE FUNCTION public.apc_sketch_value(bucket integer) RETURNS double precision AS $$
+    SELECT CASE WHEN bucket = 1 THEN 0.0
+                ELSE 2 * {min_value!r}::double precision * power({gamma!r}::double precision, bucket - 1)
+                     / ({gamma!r}::double precision + 1)
+           END
+$$ LANGUAGE sql IMMUTABLE STRICT;
+
+CREATE OR REPLACE FUNCTION public.apc_sketch_add_value(counts integer[], value double precision)
+        RETURNS integer[] AS $$
+DECLARE
+    bucket integer := public.apc_sketch_bucket(value);
+BEGIN
+    counts[bucket] := counts[bucket] + 1;
+    RETURN counts;
+END
+$$ LANGUAGE plpgsql IMMUTABLE STRICT;
+
+CREATE OR REPLACE FUNCTION public.apc_sketch_add_sketch(counts integer[], sketch integer[])
+        RETURNS integer[] AS $$
+DECLARE
+    i integer;
+BEGIN
+    FOR i IN 1 .. coalesce(array_length(sketch, 1), 0) LOOP
+        counts[sketch[i][1]] := counts[sketch[i][1]] + sketch[i][2];
+    END LOOP;
+    RETURN counts;
+END
+$$ LANGUAGE plpgsql IMMUTABLE STRICT;
+
+CREATE OR REPLACE FUNCTION public.apc_sketch_compact(counts integer[]) RETURNS integer[] AS $$
+    SELECT array_agg(ARRAY[bucket, counts[bucket]] ORDER BY bucket)
+    FROM generate_subscripts(counts, 1) AS bucket
+    WHERE counts[bucket] > 0
+$$ LANGUAGE sql IMMUTABLE STRICT;
+
+CREATE OR REPLACE FUNCTION public.apc_sketch_quantile(sketch integer[], fraction double precision)
+        RETURNS double precision AS $$
+    SELECT public.apc_sketch_value(bucket)
+    FROM (SELECT sketch[i][1] AS bucket,
+                 sum(sketch[i][2]) OVER (ORDER BY i) AS position,
+                 sum(sketch[i][2]) OVER () AS total
+          FROM generate_subscripts(sketch, 1) AS i) AS cumulative
+    WHERE position >= ceil(fraction * total)
+    ORDER BY bucket
+    LIMIT 1
+$$ LANGUAGE sql IMMUTABLE STRICT;
+
+DROP AGGREGATE IF EXISTS public.apc_sketch(double precision);
+CREATE AGGREGATE public.apc_sketch(double precision) (
+    SFUNC = public.apc_sketch_add_value,
+    STYPE = integer[],
+    FINALFUNC = public.apc_sketch_compact,
+    INITCOND = '{empty_counts}'
+);
+
+DROP AGGREGATE IF EXISTS public.apc_sketch_merge(integer[]);
+CREATE AGGREGATE public.apc_sketch_merge(integer[]) (
+    SFUNC = public.apc_sketch_add_sketch,
+    STYPE = integer[],
+    FINALFUNC = public.apc_sketch_compact,
+    INITCOND = '{empty_counts}'
+);
+"""
+
+def bucket(value):
+    """
+    Get the sketch bucket of a value, like apc_sketch_bucket() in the database.
+    """
+    if value < SKETCH_MIN_VALUE:
+        return 1
+    return min(2 + int(math.floor(math.log(value / SKETCH_MIN_VALUE) / SKETCH_LOG_GAMMA)), SKETCH_NUM_BUCKETS)
+
+def bucket_value(bucket):
+    """
+    Get the value representing a sketch bucket, like apc_sketch_value() in the database.
+    """
+    if bucket == 1:
+        return 0.0
+    return 2 * SKETCH_MIN_VALUE * math.pow(SKETCH_GAMMA, bucket - 1) / (SKETCH_GAMMA + 1)
+
+def build_sketch(values):
+    """
+    Build a sketch from values, like the apc_sketch() aggregate in the database.
+
+    Returns:
+        A list of [bucket, count] pairs ordered by bucket, None for no values
+    """
+    counts = {}
+    for value in values:
+        if value is not None:
+            counts[bucket(value)] = counts.get(bucket(value), 0) + 1
+    return [[b, counts[b]] for b in sorted(counts)] or None
+
+def merge_sketches(sketches):
+    """
+    Merge sketches, like the apc_sketch_merge() aggregate in the database.
+    """
+    counts = {}
+    for sketch in sketches:
+        for b, count in sketch or []:
+            counts[b] = counts.get(b, 0) + count
+    return [[b, counts[b]] for b in sorted(counts)] or None
+
+def sketch_quantile(sketch, fraction):
+    """
+    Read a quantile from a sketch, like apc_sketch_quantile() in the database.
+
+    Uses the definition of PostgreSQL's percentile_disc(): The quantile is
+    the first value whose position in the ordering equals or exceeds the
+    fraction.
+    """
+    if not sketch:
+        return None
+    total = sum([count for _, count in sketch])
+    position = 0
+    for b, count in sketch:
+        position += count
+        if position >= math.ceil(fraction * total):
+            return bucket_value(b)
+
+def create_sketch_functions(connectable):
+    """
+    Create the SQL functions and aggregates for quantile sketches.
+
+    apc_sketch(value) builds a sketch from values, apc_sketch_merge(sketch)
+    merges sketches and apc_sketch_quantile(sketch, fraction) reads a quantile
+    from a sketch. They are created in the public schema, so they are not
+    affected by schema swaps.
+    Requires PostgreSQL 9.5 or newer.
+    """
+    empty_counts = "{" + ",".join(["0"] * SKETCH_NUM_BUCKETS) + "}"
+    statements = SKETCH_FUNCTIONS_SQL.format(min_value=SKETCH_MIN_VALUE, log_gamma=SKETCH_LOG_GAMMA,
+                                             gamma=SKETCH_GAMMA, num_buckets=SKETCH_NUM_BUCKETS,
+                                             empty_counts=empty_counts)
+    # all in one transaction, queries running meanwhile never miss an aggregate
+    with connectable.begin() as connection:
+        connection.execute(statements)
+
+def quantile_expression(column, fraction):
+    """
+    Create the SQL expression for a quantile of the merged sketches stored in
+    a column (see aggregate_functions.register_aggregate_functions()).
+    """
+    func = sqlalchemy.func
+    return func.public.apc_sketch_quantile(func.public.apc_sketch_merge(column), fraction)
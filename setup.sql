@@ -8,4 +8,11 @@ CREATE DATABASE openapc_db;
 \c openapc_db;
 CREATE SCHEMA openapc_schema;
 GRANT ALL PRIVILEGES ON SCHEMA openapc_schema TO table_creator WITH GRANT OPTION;
+-- required for shadow builds (assets_generator.py tables -s), which create a
+-- staging schema and rename it to openapc_schema
+GRANT CREATE ON DATABASE openapc_db TO table_creator;
+ALTER SCHEMA openapc_schema OWNER TO table_creator;
 GRANT USAGE ON SCHEMA openapc_schema TO cubes_user;
+-- the tables job creates the quantile sketch functions (see quantile_sketch.py) in
+-- the public schema
+GRANT CREATE ON SCHEMA public TO table_creator;
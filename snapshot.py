@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+
+from array import array
+import datetime
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+SNAPSHOT_MAGIC = "OAPCSNAP"
+SNAPSHOT_VERSION = 1
+# magic, format version, header length
+PREAMBLE = struct.Struct("<8sII")
+ALIGNMENT = 8
+NULL_CODE = -1
+
+def _aligned(position):
+    return (position + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def _little_endian(values):
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tostring()
+
+class _DataSection(object):
+    """
+    Collects the aligned column buffers of a snapshot and their checksum.
+    """
+    def __init__(self, f):
+        self.f = f
+        self.size = 0
+        self.checksum = hashlib.sha256()
+
+    def append(self, data):
+        padding = "\0" * (_aligned(self.size) - self.size)
+        for chunk in [padding, data]:
+            self.f.write(chunk)
+            self.checksum.update(chunk)
+        offset = self.size + len(padding)
+        self.size = offset + len(data)
+        return offset
+
+def _encode_column(data, name, column_type, values):
+    """
+    Append a column to the data section.
+
+    Float columns are stored as little-endian float64 values, NULL as NaN.
+    String columns are dictionary-encoded: int32 codes (NULL_CODE for NULL)
+    referencing a sorted dictionary, which is stored as UTF-8 data plus an
+    uint32 offset array with one entry more than there are values. Sorting
+    keeps the code order identical to the value order.
+
+    Returns:
+        The column description for the snapshot header
+    """
+    if column_type == "float":
+        floats = array("d", [float("nan") if value is None else float(value) for value in values])
+        return {"name": name, "type": "float", "offset": data.append(_little_endian(floats))}
+    if column_type != "string":
+        raise ValueError("Unsupported snapshot column type '{}'".format(column_type))
+    dictionary = sorted(set([value for value in values if value is not None]))
+    value_codes = {value: code for code, value in enumerate(dictionary)}
+    codes = array("i", [NULL_CODE if value is None else value_codes[value] for value in values])
+    encoded = [value.encode("utf-8") for value in dictionary]
+    offsets = array("I", [0])
+    for value in encoded:
+        offsets.append(offsets[-1] + len(value))
+    return {
+        "name": name,
+        "type": "string",
+        "offset": data.append(_little_endian(codes)),
+        "num_values": len(dictionary),
+        "dictionary_offsets": data.append(_little_endian(offsets)),
+        "dictionary_data": data.append("".join(encoded))
+    }
+
+def write_snapshot(path, tables, generation):
+    """
+    Write a columnar snapshot file.
+
+    The file is written to a temporary path first and renamed afterwards, so
+    readers never open a partially written snapshot. Temporary files are
+    removed if writing fails.
+
+    Args:
+        path: The path of the snapshot file
+        tables: A list of tuples (table_name, num_rows, columns), columns
+                being a list of tuples (column_name, type, values) with type
+                "string" or "float"
+        generation: The data generation identifier to embed
+
+    Returns:
+        The snapshot header (a dict)
+    """
+    temp_path = path + ".tmp"
+    data_path = path + ".data.tmp"
+    header = {
+        "version": SNAPSHOT_VERSION,
+        "generation": generation,
+        "created": datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "tables": {}
+    }
+    try:
+        with open(data_path, "w+b") as data_file:
+            data = _DataSection(data_file)
+            for table_name, num_rows, columns in tables:
+                descriptions = []
+                for column_name, column_type, values in columns:
+                    if len(values) != num_rows:
+                        raise ValueError("Column {}.{} has {} values, expected {}".format(table_name, column_name,
+                                                                                         len(values), num_rows))
+                    descriptions.append(_encode_column(data, column_name, column_type, values))
+                header["tables"][table_name] = {"num_rows": num_rows, "columns": descriptions}
+            header["data_size"] = data.size
+            header["checksum"] = data.checksum.hexdigest()
+            encoded_header = json.dumps(header, sort_keys=True)
+            with open(temp_path, "wb") as f:
+                f.write(PREAMBLE.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(encoded_header)))
+                f.write(encoded_header)
+                position = PREAMBLE.size + len(encoded_header)
+                f.write("\0" * (_aligned(position) - position))
+                data_file.seek(0)
+                while True:
+                    chunk = data_file.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+    except BaseException:
+        for partial_path in [data_path, temp_path]:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+        raise
+    os.remove(data_path)
+    os.rename(temp_path, path)
+    return header
+
+def _read_header(f):
+    preamble = f.read(PREAMBLE.size)
+    if len(preamble) != PREAMBLE.size:
+        raise ValueError("Not a snapshot file (too short)")
+    magic, version, header_length = PREAMBLE.unpack(preamble)
+    if magic != SNAPSHOT_MAGIC:
+        raise ValueError("Not a snapshot file (invalid magic)")
+    if version != SNAPSHOT_VERSION:
+        raise ValueError("Unsupported snapshot version {}".format(version))
+    header = json.loads(f.read(header_length))
+    header["data_start"] = _aligned(PREAMBLE.size + header_length)
+    return header
+
+def read_snapshot_generation(path):
+    """
+    Read the generation identifier of a snapshot without mapping it.
+
+    Returns:
+        The generation identifier or None if no valid snapshot exists.
+    """
+    try:
+        with open(path, "rb") as f:
+            return _read_header(f)["generation"]
+    except (IOError, ValueError, KeyError):
+        return None
+
+class Snapshot(object):
+    """
+    Read access to a snapshot file, which is memory-mapped as a whole.
+
+    With NumPy available, columns are returned as arrays backed directly by
+    the mapping (no copy), otherwise as array.array copies. String
+    dictionaries are decoded on first access.
+    """
+    def __init__(self, path, verify=True):
+        self.path = path
+        with open(path, "rb") as f:
+            self.header = _read_header(f)
+            self.mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.data_start = self.header["data_start"]
+        if len(self.mapping) != self.data_start + self.header["data_size"]:
+            raise ValueError("Snapshot file {} is truncated".format(path))
+        if verify and hashlib.sha256(buffer(self.mapping, self.data_start)).hexdigest() != self.header["checksum"]:
+            raise ValueError("Checksum mismatch in snapshot file {}".format(path))
+        self.dictionaries = {}
+
+    @property
+    def generation(self):
+        return self.header["generation"]
+
+    def table_names(self):
+        return self.header["tables"].keys()
+
+    def num_rows(self, table):
+        return self.header["tables"][table]["num_rows"]
+
+    def column_description(self, table, name):
+        for description in self.header["tables"][table]["columns"]:
+            if description["name"] == name:
+                return description
+        raise KeyError("Column {}.{} not found in snapshot".format(table, name))
+
+    def _array(self, offset, typecode, dtype, count):
+        start = self.data_start + offset
+        if numpy is not None:
+            return numpy.frombuffer(self.mapping, dtype=dtype, count=count, offset=start)
+        values = array(typecode)
+        values.fromstring(self.mapping[start:start + values.itemsize * count])
+        if sys.byteorder == "big":
+            values.byteswap()
+        return values
+
+    def column(self, table, name):
+        """
+        Get the values of a float column or the codes of a string column.
+        """
+        description = self.column_description(table, name)
+        if description["type"] == "float":
+            return self._array(description["offset"], "d", "<f8", self.num_rows(table))
+        return self._array(description["offset"], "i", "<i4", self.num_rows(table))
+
+    def dictionary(self, table, name):
+        """
+        Get the sorted distinct values of a string column, indexed by code.
+        """
+        key = (table, name)
+        if key not in self.dictionaries:
+            description = self.column_description(table, name)
+            count = description["num_values"]
+            offsets = self._array(description["dictionary_offsets"], "I", "<u4", count + 1)
+            start = self.data_start + description["dictionary_data"]
+            self.dictionaries[key] = [self.mapping[start + offsets[i]:start + offsets[i + 1]].decode("utf-8")
+                                      for i in range(count)]
+        return self.dictionaries[key]
+
+    def values(self, table, name):
+        """
+        Get the values of a column as a list, NULL being None (the input of write_snapshot()).
+        """
+        description = self.column_description(table, name)
+        if description["type"] == "float":
+            return [None if value != value else float(value) for value in self.column(table, name)]
+        dictionary = self.dictionary(table, name)
+        return [None if code == NULL_CODE else dictionary[code] for code in self.column(table, name)]
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+import json
+import math
+import os
+import random
+import shutil
+import tempfile
+import threading
+import unittest
+from ConfigParser import SafeConfigParser as ConfigParser
+
+import sqlalchemy
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+
+import assets_generator
+from util import write_generation_stamp
+
+PUBLISHERS = ["Elsevier", "Springer Nature", "PLOS", "Frontiers"]
+INSTITUTIONS = ["Bielefeld U", "FU Berlin", "TU Dresden"]
+PERIODS = ["2014", "2015", "2016"]
+# the columns of the flat openapc fact table used by the model
+FACT_COLUMNS = ["institution", "period", "publisher", "journal_full_title", "doi", "is_hybrid", "country"]
+
+class _SampleStddev(object):
+    # PostgreSQL's stddev() for SQLite
+    def __init__(self):
+        self.values = []
+
+    def step(self, value):
+        if value is not None:
+            self.values.append(float(value))
+
+    def finalize(self):
+        if len(self.values) < 2:
+            return None
+        mean = sum(self.values) / len(self.values)
+        return math.sqrt(sum([(value - mean) ** 2 for value in self.values]) / (len(self.values) - 1))
+
+def _add_sqlite_functions(dbapi_connection, connection_record):
+    if not hasattr(dbapi_connection, "create_aggregate"):
+        return
+    dbapi_connection.create_function("sqrt", 1, lambda value: None if value is None else math.sqrt(value))
+    dbapi_connection.create_function("greatest", 2, max)
+    dbapi_connection.create_aggregate("stddev", 1, _SampleStddev)
+
+sqlalchemy.event.listen(sqlalchemy.engine.Engine, "connect", _add_sqlite_functions)
+
+def sample_rows(num_rows=400, seed=1):
+    """
+    Create rows for the openapc fact table, as dicts.
+    """
+    rng = random.Random(seed)
+    rows = []
+    for i in range(num_rows):
+        rows.append({
+            "institution": rng.choice(INSTITUTIONS),
+            "period": rng.choice(PERIODS),
+            "publisher": rng.choice(PUBLISHERS),
+            "journal_full_title": u"Journal {}".format(rng.randint(1, 12)),
+            "doi": u"10.1234/{}".format(i),
+            "is_hybrid": rng.choice(["TRUE", "FALSE"]),
+            "country": u"DEU",
+            "euro": round(rng.lognormvariate(7.3, 0.5), 2)
+        })
+    return rows
+
+class SQLiteCubes(object):
+    """
+    A temporary SQLite database with an openapc fact table, its publisher
+    rollup table and the model built by the model job.
+    """
+    def __init__(self, rows=None):
+        self.directory = tempfile.mkdtemp()
+        self.url = "sqlite:///" + os.path.join(self.directory, "openapc.db")
+        self.engine = sqlalchemy.create_engine(self.url)
+        self.rows = rows if rows is not None else sample_rows()
+        metadata = sqlalchemy.MetaData(bind=self.engine)
+        columns = [sqlalchemy.Column(column, sqlalchemy.String) for column in FACT_COLUMNS]
+        # a float column: SQLite has no decimal type
+        fact_table = sqlalchemy.Table("openapc", metadata, *(columns + [sqlalchemy.Column("euro", sqlalchemy.Float)]))
+        fact_table.create()
+        self.engine.execute(fact_table.insert(), self.rows)
+        self._create_rollup_table(metadata, fact_table)
+        self.model_path = os.path.join(self.directory, "model.json")
+        with open(self.model_path, "w") as model_file:
+            model_file.write(assets_generator.build_model(single_cube=True).encode("utf-8"))
+
+    def _create_rollup_table(self, metadata, fact_table):
+        # like assets_generator.create_rollup_tables(), without the PostgreSQL quantile sketch
+        grain = dict(assets_generator.ROLLUP_GRAINS)["publisher"]
+        name = assets_generator._rollup_table_name("openapc", "publisher")
+        columns = [sqlalchemy.Column(column, sqlalchemy.String) for column in grain]
+        columns += [sqlalchemy.Column(column, sqlalchemy.Float) for column in
+                    ["euro_sum", "euro_count", "euro_sum_squares"]]
+        table = sqlalchemy.Table(name, metadata, *columns)
+        table.create()
+        euro = fact_table.c.euro
+        group_columns = [fact_table.c[column] for column in grain]
+        select = sqlalchemy.select(group_columns + [sqlalchemy.func.sum(euro), sqlalchemy.func.count(euro),
+                                                    sqlalchemy.func.sum(euro * euro)]).group_by(*group_columns)
+        self.engine.execute(table.insert().from_select([column.name for column in columns], select))
+
+    def slicer_config(self, store_type="sql", snapshot=None):
+        config = ConfigParser()
+        config.add_section("model")
+        config.set("model", "path", self.model_path)
+        config.add_section("workspace")
+        config.add_section("store")
+        config.set("store", "type", store_type)
+        config.set("store", "url", self.url)
+        if snapshot is not None:
+            config.set("store", "snapshot", snapshot)
+        return config
+
+    def slicer_app(self, store_type="sql", snapshot=None):
+        """
+        Create a Flask app serving the slicer blueprint on the database.
+        """
+        from cubes.server import slicer
+        from flask import Flask
+        app = Flask(__name__)
+        app.register_blueprint(slicer, config=self.slicer_config(store_type, snapshot))
+        return app
+
+    def close(self):
+        self.engine.dispose()
+        shutil.rmtree(self.directory)
+
+class CubesTestCase(unittest.TestCase):
+    """
+    Base class for tests on the cubes server: a SQLiteCubes database and a
+    slicer app on it (the sql store) are shared by all tests of a class.
+    Subclasses can override fact_rows() to load other rows.
+    """
+    @classmethod
+    def fact_rows(cls):
+        return sample_rows()
+
+    @classmethod
+    def setUpClass(cls):
+        cls.cubes = SQLiteCubes(cls.fact_rows())
+        cls.app = cls.cubes.slicer_app()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.cubes.close()
+
+    def get(self, wsgi_app, url, **kwargs):
+        """
+        Send a GET request to a WSGI app and expect a 200 response.
+        """
+        response = Client(wsgi_app, BaseResponse).get(url, **kwargs)
+        self.assertEqual(response.status_code, 200, response.data)
+        return response.data
+
+    def get_json(self, wsgi_app, url, **kwargs):
+        return json.loads(self.get(wsgi_app, url, **kwargs))
+
+class GenerationTestCase(unittest.TestCase):
+    """
+    Base class for tests depending on the data generation stamp: every test
+    gets a temporary directory holding the stamp file.
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.generation_file = os.path.join(self.directory, "data_generation.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_stamp(self, generation, mtime):
+        write_generation_stamp(self.generation_file, generation)
+        # the stamp is only read again if its modification time changes
+        os.utime(self.generation_file, (mtime, mtime))
+
+class _StandInHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        stand_in = self.server.stand_in
+        stand_in.requests.append(self.path)
+        if stand_in.failures > 0:
+            stand_in.failures -= 1
+            status, headers, body = 503, {}, "unavailable"
+        elif self.path in stand_in.responses:
+            status, headers, body = stand_in.responses[self.path]
+        else:
+            status, headers, body = 404, {}, "not found"
+        etag = headers.get("ETag")
+        if status == 200 and etag and self.headers.getheader("If-None-Match") == etag:
+            status, body = 304, ""
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class StandInServer(object):
+    """
+    A local HTTP server standing in for SpringerLink and the DOI resolver.
+
+    responses maps request paths (including the query string) to tuples
+    (status, headers, body), other paths are answered with 404. The first
+    `failures` requests are answered with 503. All request paths are
+    recorded in `requests`.
+    """
+    def __init__(self):
+        self.responses = {}
+        self.requests = []
+        self.failures = 0
+        self.server = HTTPServer(("127.0.0.1", 0), _StandInHandler)
+        self.server.stand_in = self
+        self.url = "http://127.0.0.1:{}".format(self.server.server_port)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from StringIO import StringIO
+import unittest
+
+from util import CSVBatchReader, UnicodeReader
+
+CSV_DATA = (
+    'institution,period,euro,doi,journal_full_title\r\n'
+    'Bielefeld U,2015,1200.5,10.1234/1,"Journal, with a comma"\r\n'
+    '"FU Berlin",2016,,10.1234/2,"A ""quoted"" title"\r\n'
+    '\r\n'
+    'TU M\xc3\xbcnchen,2016,980,10.1234/3,"Two\r\nlines"\r\n'
+    'Bielefeld U,2015,1200.5,10.1234/4,\xc3\x89tudes\r\n'
+    'FU Berlin,NA,0,,Journal 2\r\n'
+)
+
+class CSVBatchReaderTest(unittest.TestCase):
+    """
+    CSVBatchReader has to return the same rows as UnicodeReader.
+    """
+    def test_same_rows(self):
+        expected = list(UnicodeReader(StringIO(CSV_DATA)))
+        for batch_size in [1, 2, 5000]:
+            rows = []
+            for batch in CSVBatchReader(StringIO(CSV_DATA), batch_size=batch_size):
+                self.assertTrue(len(batch) <= batch_size)
+                rows += batch.dicts()
+            self.assertEqual(rows, expected)
+
+    def test_batches(self):
+        batches = list(CSVBatchReader(StringIO(CSV_DATA), batch_size=2))
+        self.assertEqual([len(batch) for batch in batches], [2, 2, 1])
+
+    def test_selected_fields(self):
+        reader = CSVBatchReader(StringIO(CSV_DATA), ["doi", "euro", "country"])
+        batch = list(reader)[0]
+        self.assertEqual(batch.fields, ["doi", "euro", "country"])
+        self.assertEqual(batch.rows()[0], (u"10.1234/1", u"1200.5", None))
+        self.assertEqual(batch.rows(["euro", "doi"])[1], (u"", u"10.1234/2"))
+        self.assertEqual(batch.columns["country"], [None] * 5)
+
+    def test_short_lines(self):
+        # like csv.DictReader, fields missing at the end of a line are None
+        batch = list(CSVBatchReader(StringIO("a,b,c\r\n1,2\r\n")))[0]
+        self.assertEqual(batch.dicts(), [{"a": u"1", "b": u"2", "c": None}])
+
+if __name__ == "__main__":
+    unittest.main()
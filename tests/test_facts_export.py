@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+import csv
+from StringIO import StringIO
+import json
+import unittest
+
+from cubes import Cell
+from cubes.backends.sql.query import QueryBuilder
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+
+from facts_export import export
+from fixtures import CubesTestCase
+
+class FactsExportTest(CubesTestCase):
+    """
+    Exports have to contain the rows of the facts endpoint, without its fact key column.
+    """
+    @classmethod
+    def setUpClass(cls):
+        super(FactsExportTest, cls).setUpClass()
+        cls.app.register_blueprint(export)
+        cls.client = Client(cls.app.wsgi_app, BaseResponse)
+        cube = cls.app.cubes_workspace.cube("openapc")
+        # the header of the fact key column in CSV and its label in JSON
+        cls.fact_key = cube.key or "id"
+        builder = QueryBuilder(cls.app.cubes_workspace.browser(cube))
+        builder.denormalized_statement(Cell(cube), cube.all_attributes, include_fact_key=True)
+        cls.fact_key_label = builder.labels[0]
+
+    def facts_csv(self, query_string):
+        rows = list(csv.reader(StringIO(self.get(self.app.wsgi_app, "/cube/openapc/facts?format=csv&" + query_string))))
+        # the facts endpoint starts every line with the fact key
+        self.assertEqual(rows[0][0], self.fact_key)
+        return [row[1:] for row in rows]
+
+    def facts_json(self, query_string):
+        facts = json.loads(self.get(self.app.wsgi_app, "/cube/openapc/facts?" + query_string))
+        for fact in facts:
+            del fact[self.fact_key_label]
+        return facts
+
+    def test_csv(self):
+        for query_string in ["cut=period:2015", "cut=period:2015&fields=publisher,period,euro"]:
+            exported = list(csv.reader(StringIO(self.get(self.app.wsgi_app, "/cube/openapc/export?format=csv&" + query_string))))
+            expected = self.facts_csv(query_string)
+            self.assertEqual(exported[0], expected[0])
+            self.assertEqual(sorted(exported[1:]), sorted(expected[1:]))
+
+    def test_ndjson(self):
+        for query_string in ["cut=period:2015", "cut=period:2015&fields=publisher,period,euro"]:
+            exported = [json.loads(line) for line in self.get(self.app.wsgi_app, "/cube/openapc/export?" + query_string).splitlines()]
+            expected = self.facts_json(query_string)
+            self.assertEqual(len(exported), len(expected))
+            key = lambda fact: sorted(fact.items())
+            self.assertEqual(sorted(exported, key=key), sorted(expected, key=key))
+
+    def test_unknown_format(self):
+        self.assertEqual(self.client.get("/cube/openapc/export?format=xml").status_code, 400)
+
+if __name__ == "__main__":
+    unittest.main()
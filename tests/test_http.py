@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+from email.utils import formatdate
+import os
+import unittest
+import zlib
+
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+
+from fixtures import GenerationTestCase
+from olap_middleware import Compression, ConditionalGet
+
+class CountingApp(object):
+    """
+    A WSGI app answering every request with a JSON body of the given size,
+    or with 404 for paths containing "missing".
+    """
+    def __init__(self, size=10):
+        self.calls = 0
+        self.size = size
+
+    def __call__(self, environ, start_response):
+        self.calls += 1
+        if "missing" in environ["PATH_INFO"]:
+            start_response("404 Not Found", [("Content-Type", "application/json")])
+            return ['{"error": "not found"}']
+        body = '"' + "x" * (self.size - 2) + '"'
+        start_response("200 OK", [("Content-Type", "application/json"), ("Content-Length", str(len(body)))])
+        return [body]
+
+class ConditionalGetTest(GenerationTestCase):
+
+    def setUp(self):
+        super(ConditionalGetTest, self).setUp()
+        self.write_stamp("gen1", 1000)
+        self.app = CountingApp()
+        self.client = Client(ConditionalGet(self.app, self.generation_file, max_age=60), BaseResponse)
+
+    def test_validators(self):
+        response = self.client.get("/cube/openapc/aggregate?drilldown=publisher")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers["ETag"].startswith('W/"'))
+        self.assertIn("Last-Modified", response.headers)
+        self.assertEqual(response.headers["Cache-Control"], "public, max-age=60")
+        # equivalent queries share the tag
+        other = self.client.get("/cube/openapc/aggregate/?drilldown=publisher&cut=")
+        same = self.client.get("/cube/openapc/aggregate/?drilldown=publisher")
+        self.assertNotEqual(other.headers["ETag"], response.headers["ETag"])
+        self.assertEqual(same.headers["ETag"], response.headers["ETag"])
+
+    def test_if_none_match(self):
+        url = "/cube/openapc/aggregate?drilldown=publisher"
+        etag = self.client.get(url).headers["ETag"]
+        for header in [etag, etag[2:], '"other", ' + etag, "*"]:
+            response = self.client.get(url, headers=[("If-None-Match", header)])
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.data, "")
+            self.assertEqual(response.headers["ETag"], etag)
+        self.assertEqual(self.app.calls, 1)
+        response = self.client.get(url, headers=[("If-None-Match", '"other"')])
+        self.assertEqual(response.status_code, 200)
+
+    def test_unknown_tag(self):
+        # a tag the process did not issue (like one of another worker) is checked against the response
+        url = "/cube/openapc/aggregate?drilldown=publisher"
+        etag = self.client.get(url).headers["ETag"]
+        other = Client(ConditionalGet(self.app, self.generation_file), BaseResponse)
+        response = other.get(url, headers=[("If-None-Match", etag)])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, "")
+        self.assertEqual(self.app.calls, 2)
+        self.assertEqual(other.get(url, headers=[("If-None-Match", etag)]).status_code, 304)
+        self.assertEqual(self.app.calls, 2)
+
+    def test_error_not_revalidated(self):
+        url = "/cube/missing/aggregate"
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 404)
+        self.assertNotIn("ETag", response.headers)
+        for header in [("If-None-Match", "*"), ("If-Modified-Since", formatdate(usegmt=True))]:
+            response = self.client.get(url, headers=[header])
+            self.assertEqual(response.status_code, 404)
+            self.assertEqual(response.data, '{"error": "not found"}')
+        self.assertEqual(self.app.calls, 3)
+
+    def test_if_modified_since(self):
+        url = "/cube/openapc/aggregate"
+        last_modified = self.client.get(url).headers["Last-Modified"]
+        self.assertEqual(self.client.get(url, headers=[("If-Modified-Since", last_modified)]).status_code, 304)
+        # an ETag takes precedence over the date
+        response = self.client.get(url, headers=[("If-Modified-Since", last_modified), ("If-None-Match", '"other"')])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get(url, headers=[("If-Modified-Since", formatdate(0, usegmt=True))]).status_code,
+                         200)
+
+    def test_new_generation(self):
+        url = "/cube/openapc/aggregate"
+        etag = self.client.get(url).headers["ETag"]
+        self.write_stamp("gen2", 2000)
+        response = self.client.get(url, headers=[("If-None-Match", etag)])
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers["ETag"], etag)
+
+    def test_passed_through(self):
+        for url in ["/cubes", "/cube/openapc/export"]:
+            response = self.client.get(url, headers=[("If-None-Match", "*")])
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn("ETag", response.headers)
+        os.remove(self.generation_file)
+        response = self.client.get("/cube/openapc/aggregate", headers=[("If-None-Match", "*")])
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("ETag", response.headers)
+
+class CompressionTest(unittest.TestCase):
+
+    def get(self, app, url, accept_encoding):
+        client = Client(Compression(app, min_size=100), BaseResponse)
+        return client.get(url, headers=[("Accept-Encoding", accept_encoding)])
+
+    def test_gzip(self):
+        response = self.get(CountingApp(1000), "/cube/openapc/aggregate", "gzip, deflate")
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertEqual(response.headers["Vary"], "Accept-Encoding")
+        self.assertEqual(int(response.headers["Content-Length"]), len(response.data))
+        self.assertEqual(zlib.decompress(response.data, 16 + zlib.MAX_WBITS), '"' + "x" * 998 + '"')
+
+    def test_not_compressed(self):
+        for app, url, accept_encoding in [(CountingApp(10), "/cube/openapc/aggregate", "gzip"),
+                                          (CountingApp(1000), "/cube/openapc/aggregate", "gzip;q=0"),
+                                          (CountingApp(1000), "/cube/openapc/aggregate", "")]:
+            response = self.get(app, url, accept_encoding)
+            self.assertNotIn("Content-Encoding", response.headers)
+            self.assertEqual(len(response.data), app.size)
+        response = self.get(CountingApp(1000), "/cube/openapc/export", "gzip")
+        self.assertNotIn("Content-Encoding", response.headers)
+
+    def test_choose_encoding(self):
+        compression = Compression(CountingApp())
+        self.assertEqual(compression.choose_encoding("*;q=0.5"), compression.choose_encoding("gzip"))
+        self.assertIsNone(compression.choose_encoding("identity"))
+        self.assertIsNone(compression.choose_encoding("gzip;q=0, br;q=0"))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+import urllib2
+
+from coverage_cache import CoverageCache
+from fixtures import StandInServer
+from http_fetcher import HTTPFetcher
+import offsetting_coverage as oc
+
+SEARCH_PAGE = (
+    '<h1 class="number-of-search-results-and-search-terms">\n  <strong>1,234</strong> Result(s)</h1>\n'
+    '<p class="message">You are now only searching within the Journal</p>\n'
+    '<p class="title">\n  <a href="/journal/10100">Journal of Stand-ins &amp; Fixtures</a>'
+)
+
+class HTTPFetcherTest(unittest.TestCase):
+    """
+    Responses recorded from the stand-in server have to be replayed without it.
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store_directory = os.path.join(self.directory, "http_cache")
+        self.server = StandInServer()
+        self.stats_path = oc.SPRINGER_FULL_SEARCH.format("10100", "2016", "2016")
+        self.server.responses[self.stats_path] = (200, {"Content-Type": "text/html"}, SEARCH_PAGE)
+        self.csv_path = "/journal.csv"
+        self.server.responses[self.csv_path] = (200, {"ETag": '"v1"'}, "Item DOI,Publication Year\n10.1007/s1,2016\n")
+        self.base_url = oc.SPRINGER_BASE_URL
+        self.global_fetcher = oc.FETCHER
+        oc.SPRINGER_BASE_URL = self.server.url
+
+    def tearDown(self):
+        oc.SPRINGER_BASE_URL = self.base_url
+        oc.FETCHER = self.global_fetcher
+        self.server.close()
+        shutil.rmtree(self.directory)
+
+    def create_fetcher(self, mode):
+        return HTTPFetcher(mode, self.store_directory, request_delay=0, max_retries=2, retry_backoff=0.01)
+
+    def test_record_and_replay(self):
+        oc.FETCHER = self.create_fetcher("record")
+        recorded = oc._get_springer_journal_stats("10100", "2016")
+        self.assertEqual(recorded, {"count": 1234, "title": u"Journal of Stand-ins & Fixtures"})
+        csv_url = self.server.url + self.csv_path
+        self.assertEqual(oc.FETCHER.open(csv_url, {"If-None-Match": '"v1"'}).code, 200)
+        self.server.close()
+        for mode in ["replay", "offline"]:
+            oc.FETCHER = self.create_fetcher(mode)
+            self.assertEqual(oc._get_springer_journal_stats("10100", "2016"), recorded)
+            response = oc.FETCHER.open(csv_url)
+            self.assertEqual(response.code, 200)
+            self.assertEqual(response.getheader("etag"), '"v1"')
+            self.assertEqual(response.read(), "Item DOI,Publication Year\n10.1007/s1,2016\n")
+            with self.assertRaises(urllib2.HTTPError) as context:
+                oc.FETCHER.open(csv_url, {"If-None-Match": '"v1"'})
+            self.assertEqual(context.exception.code, 304)
+            self.assertEqual(oc.FETCHER.network_requests, 0)
+            self.assertEqual(oc.FETCHER.replayed_requests, 3)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertRaises(urllib2.URLError, oc.FETCHER.open, self.server.url + "/unknown")
+
+    def test_retries(self):
+        fetcher = self.create_fetcher("live")
+        self.server.failures = 2
+        self.assertEqual(fetcher.fetch(self.server.url + self.stats_path), SEARCH_PAGE)
+        self.assertEqual(fetcher.network_requests, 3)
+        # client errors are not retried
+        with self.assertRaises(urllib2.HTTPError) as context:
+            fetcher.fetch(self.server.url + "/unknown")
+        self.assertEqual(context.exception.code, 404)
+        self.assertEqual(fetcher.network_requests, 4)
+        self.server.failures = 3
+        self.assertRaises(urllib2.HTTPError, fetcher.fetch, self.server.url + self.stats_path)
+
+class FakeClock(object):
+    """
+    Stands in for the datetime module, with now() at the given date.
+    """
+    def __init__(self, now):
+        clock = self
+        self.now = now
+        class FakeDatetime(datetime.datetime):
+            @classmethod
+            def now(cls, tz=None):
+                return clock.now
+        self.datetime = FakeDatetime
+
+class JournalCSVTest(unittest.TestCase):
+    """
+    Recorded journal CSV files and their validators have to survive the turn of the year.
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.server = StandInServer()
+        self.saved = (oc.SPRINGER_BASE_URL, oc.FETCHER, oc.CACHE, oc.datetime)
+        oc.SPRINGER_BASE_URL = self.server.url
+        oc.CACHE = CoverageCache(os.path.join(self.directory, "cache.db"), os.path.join(self.directory, "coverage.json"),
+                                 os.path.join(self.directory, "pubdates.json"))
+        self.clock = FakeClock(datetime.datetime(2030, 12, 31, 23, 0))
+        oc.datetime = self.clock
+        self.csv_path = os.path.join(self.directory, "1234-5678.csv")
+
+    def tearDown(self):
+        oc.CACHE.close()
+        oc.SPRINGER_BASE_URL, oc.FETCHER, oc.CACHE, oc.datetime = self.saved
+        self.server.close()
+        shutil.rmtree(self.directory)
+
+    def create_fetcher(self, mode):
+        return HTTPFetcher(mode, os.path.join(self.directory, "http_cache"), request_delay=0)
+
+    def test_new_year(self):
+        content = "Item DOI,Publication Year\n10.1007/s10100-016-1,2016\n"
+        path = oc.SPRINGER_GET_CSV.format("10100", 2030)
+        self.server.responses[path] = (200, {"ETag": '"v1"'}, content)
+        oc.FETCHER = self.create_fetcher("record")
+        result = oc._fetch_springer_journal_csv(self.csv_path, "10100")
+        self.assertEqual(result, (True, '"v1"', None))
+        oc._store_csv_fetch_result("1234-5678", "10100", result)
+        self.server.close()
+        self.clock.now = datetime.datetime(2031, 1, 1, 1, 0)
+        self.assertIn("facet-end-year=2031", oc._journal_csv_url("10100"))
+        self.assertEqual(oc.CACHE.get_csv_validators("1234-5678", oc._journal_csv_key("10100")), ('"v1"', None))
+        oc.FETCHER = self.create_fetcher("replay")
+        os.remove(self.csv_path)
+        self.assertEqual(oc._fetch_springer_journal_csv(self.csv_path, "10100"), (True, '"v1"', None))
+        with open(self.csv_path) as f:
+            self.assertEqual(f.read(), content)
+        # a conditional request with the validators of the last year is answered with 304
+        self.assertEqual(oc._fetch_springer_journal_csv(self.csv_path, "10100", ('"v1"', None)),
+                         (False, '"v1"', None))
+        self.assertEqual(oc.FETCHER.replayed_requests, 2)
+        self.assertEqual(oc.FETCHER.network_requests, 0)
+        self.assertEqual(len(self.server.requests), 1)
+
+if __name__ == "__main__":
+    unittest.main()
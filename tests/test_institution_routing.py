@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+import os
+import unittest
+import urlparse
+
+from fixtures import CubesTestCase, sample_rows
+from olap_middleware import InstitutionRouter
+
+INSTITUTIONS_CSV = (
+    '"institution","institution_cubes_name","institution_full_name","continent","country","state"\n'
+    'Bielefeld U,bielefeld_u,Bielefeld University,EUROPE,DEU,NW\n'
+    'FU Berlin,fu_berlin,Freie Universitaet Berlin,EUROPE,DEU,BE\n'
+    '"Duisburg-Essen U|UDE",duisburg_essen_u,University of Duisburg-Essen,EUROPE,DEU,NW\n'
+    'Openapc,openapc,A cube name of the model,EUROPE,DEU,NW\n'
+)
+
+class InstitutionRouterTest(CubesTestCase):
+
+    @classmethod
+    def fact_rows(cls):
+        rows = sample_rows()
+        # an institution name with characters which have to be escaped in cuts
+        for row in rows[:20]:
+            row["institution"] = u"Duisburg-Essen U|UDE"
+        return rows
+
+    @classmethod
+    def setUpClass(cls):
+        super(InstitutionRouterTest, cls).setUpClass()
+        institutions_file = os.path.join(cls.cubes.directory, "institutions.csv")
+        with open(institutions_file, "w") as f:
+            f.write(INSTITUTIONS_CSV)
+        cls.router = InstitutionRouter(cls.app.wsgi_app, cls.cubes.model_path, institutions_file)
+
+    def test_model_cubes_not_routed(self):
+        self.assertNotIn("openapc", self.router.institutions)
+        self.assertEqual(self.router.institutions["bielefeld_u"], u"Bielefeld U")
+
+    def test_rewrite_query_string(self):
+        query_string = self.router.rewrite_query_string("drilldown=publisher&cut=period:2015", u"FU Berlin")
+        self.assertEqual(urlparse.parse_qsl(query_string),
+                         [("drilldown", "publisher"), ("cut", "period:2015|institution:FU Berlin")])
+        query_string = self.router.rewrite_query_string("drilldown=publisher", u"Duisburg-Essen U|UDE")
+        self.assertEqual(urlparse.parse_qsl(query_string),
+                         [("drilldown", "publisher"), ("cut", "institution:Duisburg\\-Essen U\\|UDE")])
+
+    def test_routed_requests(self):
+        institutions = [("bielefeld_u", u"Bielefeld U"), ("duisburg_essen_u", u"Duisburg-Essen U|UDE")]
+        for cubes_name, institution in institutions:
+            routed = self.get_json(self.router, "/cube/{}/aggregate?drilldown=publisher&cut=period:2015".format(
+                cubes_name))
+            rows = [row for row in self.cubes.rows if row["institution"] == institution and row["period"] == "2015"]
+            self.assertTrue(rows)
+            self.assertEqual(routed["summary"]["apc_num_items"], len(rows))
+            self.assertAlmostEqual(routed["summary"]["apc_amount_sum"], sum([row["euro"] for row in rows]), places=6)
+            publishers = set([row["publisher"] for row in rows])
+            self.assertEqual(set([cell["publisher"] for cell in routed["cells"]]), publishers)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+import unittest
+
+from cubes.errors import ConfigurationError
+
+from fixtures import CubesTestCase
+import memory_store # registers the "memory" store type
+
+def _cell_key(cell, drilldown):
+    return tuple([cell.get(level) for level in drilldown])
+
+@unittest.skipIf(memory_store.numpy is None, "the memory store requires NumPy")
+class MemoryStoreTest(CubesTestCase):
+    """
+    The memory store has to answer aggregate requests like the sql store.
+    """
+    @classmethod
+    def setUpClass(cls):
+        super(MemoryStoreTest, cls).setUpClass()
+        cls.memory_app = cls.cubes.slicer_app("memory")
+
+    def assert_same_result(self, url, drilldown=[]):
+        sql = self.get_json(self.app.wsgi_app, url)
+        memory = self.get_json(self.memory_app.wsgi_app, url)
+        self.assertEqual(sorted(memory["aggregates"]), sorted(sql["aggregates"]))
+        expected_cells = dict([(_cell_key(cell, drilldown), cell) for cell in sql["cells"]])
+        self.assertEqual(len(memory["cells"]), len(sql["cells"]))
+        for cell in memory["cells"] + [memory["summary"]]:
+            expected = expected_cells[_cell_key(cell, drilldown)] if cell is not memory["summary"] else sql["summary"]
+            for aggregate in sql["aggregates"]:
+                if expected[aggregate] is None:
+                    self.assertIsNone(cell[aggregate])
+                else:
+                    self.assertAlmostEqual(cell[aggregate], expected[aggregate], places=6)
+
+    def test_summary(self):
+        self.assert_same_result("/cube/openapc/aggregate")
+
+    def test_drilldown(self):
+        self.assert_same_result("/cube/openapc/aggregate?drilldown=publisher", ["publisher"])
+        self.assert_same_result("/cube/openapc/aggregate?drilldown=period|is_hybrid", ["period", "is_hybrid"])
+
+    def test_cuts(self):
+        self.assert_same_result("/cube/openapc/aggregate?drilldown=publisher&cut=period:2015|is_hybrid:TRUE",
+                                ["publisher"])
+        self.assert_same_result("/cube/openapc/aggregate?drilldown=institution&cut=period:2015-2016",
+                                ["institution"])
+        self.assert_same_result("/cube/openapc/aggregate?cut=publisher:Elsevier;PLOS")
+
+    def test_aggregates_parameter(self):
+        self.assert_same_result("/cube/openapc/aggregate?drilldown=publisher&aggregates=apc_amount_sum|apc_num_items",
+                                ["publisher"])
+
+class MissingNumPyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.numpy = memory_store.numpy
+
+    def tearDown(self):
+        memory_store.numpy = self.numpy
+
+    def test_configuration_error(self):
+        memory_store.numpy = None
+        self.assertRaises(ConfigurationError, memory_store.MemoryStore, url="sqlite://")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+
+import assets_generator
+from olap_middleware import MetricsMiddleware, MetricsRegistry
+from util import compile_model_index
+
+def _ok_app(environ, start_response):
+    start_response("200 OK", [("Content-Type", "application/json")])
+    return ["{}"]
+
+class MetricsLabelTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.model = json.loads(assets_generator.build_model(single_cube=True))
+        cls.model_path = os.path.join(cls.directory, "model.json")
+        with open(cls.model_path, "w") as model_file:
+            json.dump(cls.model, model_file)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        self.metrics = MetricsMiddleware(_ok_app, MetricsRegistry(), self.model_path)
+
+    def labels(self, cube, endpoint, query_string=""):
+        return dict(self.metrics.request_labels(cube, endpoint, query_string))
+
+    def test_known_names(self):
+        labels = self.labels("openapc", "aggregate", "drilldown=publisher@default:journal_full_title|period")
+        self.assertEqual(labels, {"cube": "openapc", "endpoint": "aggregate", "drilldown": "period|publisher"})
+
+    def test_sorted_drilldown(self):
+        self.assertEqual(self.labels("openapc", "aggregate", "drilldown=period|publisher"),
+                         self.labels("openapc", "aggregate", "drilldown=publisher&drilldown=period"))
+
+    def test_unknown_names(self):
+        labels = self.labels("no_such_cube", "aggregate", "drilldown=publisher")
+        self.assertEqual(labels, {"cube": "other", "endpoint": "aggregate", "drilldown": "other"})
+        labels = self.labels("openapc", "anything", "drilldown=x1|x2|period")
+        self.assertEqual(labels, {"cube": "openapc", "endpoint": "other", "drilldown": "other|period"})
+        # dimensions of the model, but not of the rollup cube
+        labels = self.labels("openapc_by_publisher", "aggregate", "drilldown=doi")
+        self.assertEqual(labels["drilldown"], "other")
+
+    def test_model_index(self):
+        index_path = os.path.join(self.directory, "model_index.json")
+        with open(index_path, "w") as index_file:
+            json.dump(compile_model_index(self.model), index_file)
+        metrics = MetricsMiddleware(_ok_app, MetricsRegistry(), index_path)
+        self.assertEqual(metrics.cube_dimensions, self.metrics.cube_dimensions)
+
+    def test_exported_labels(self):
+        client = Client(self.metrics, BaseResponse)
+        urls = ["/cube/cube{}/aggregate?drilldown=dimension{}".format(i, i) for i in range(5)]
+        for url in urls + ["/cube/openapc/aggregate?drilldown=publisher"]:
+            # requests are recorded when their response is closed
+            client.get(url).close()
+        body = client.get("/metrics", environ_base={"REMOTE_ADDR": "127.0.0.1"}).data
+        self.assertNotIn("cube0", body)
+        self.assertNotIn("dimension0", body)
+        self.assertIn('cube="other"', body)
+        self.assertIn('cube="openapc"', body)
+
+    def test_metrics_access(self):
+        client = Client(self.metrics, BaseResponse)
+        self.assertEqual(client.get("/metrics", environ_base={"REMOTE_ADDR": "192.0.2.1"}).status_code, 403)
+        self.assertEqual(client.get("/metrics", environ_base={"REMOTE_ADDR": "::1"}).status_code, 200)
+        metrics = MetricsMiddleware(_ok_app, MetricsRegistry(), self.model_path, allowed_addresses=["192.0.2.1"])
+        client = Client(metrics, BaseResponse)
+        self.assertEqual(client.get("/metrics", environ_base={"REMOTE_ADDR": "192.0.2.1"}).status_code, 200)
+        self.assertEqual(client.get("/metrics", environ_base={"REMOTE_ADDR": "127.0.0.1"}).status_code, 403)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+
+import json
+import math
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from ConfigParser import SafeConfigParser as ConfigParser
+
+import sqlalchemy
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+
+import assets_generator
+from fixtures import FACT_COLUMNS, sample_rows
+from olap_middleware import InstitutionRouter, RollupRouter
+import quantile_sketch
+from quantile_sketch import (QUANTILES, SKETCH_RELATIVE_ACCURACY, bucket, bucket_value, build_sketch,
+                             merge_sketches, sketch_quantile)
+
+# PostgreSQL database used to check the SQL functions, e.g. postgresql://user@localhost/test
+DATABASE_URL = os.environ.get("OPENAPC_TEST_DATABASE_URL")
+
+def percentile_disc(values, fraction):
+    values = sorted(values)
+    return values[max(int(math.ceil(fraction * len(values))), 1) - 1]
+
+def sample_values(rng, num_values):
+    return [round(rng.lognormvariate(7.3, 0.6), 2) for _ in range(num_values)]
+
+class SketchTest(unittest.TestCase):
+
+    def test_bucket_value_error(self):
+        rng = random.Random(2)
+        for _ in range(10000):
+            value = rng.uniform(1.0, 500000.0)
+            self.assertLessEqual(abs(bucket_value(bucket(value)) - value) / value, SKETCH_RELATIVE_ACCURACY + 1e-12)
+        self.assertEqual(bucket(0.0), 1)
+        self.assertEqual(bucket_value(1), 0.0)
+
+    def test_merge_equals_sketch_of_all_values(self):
+        rng = random.Random(3)
+        values = sample_values(rng, 5000)
+        cells = {}
+        for value in values:
+            cells.setdefault(rng.randint(0, 99), []).append(value)
+        merged = merge_sketches([build_sketch(cell_values) for cell_values in cells.values()])
+        self.assertEqual(merged, build_sketch(values))
+        self.assertEqual(sum([count for _, count in merged]), len(values))
+
+    def test_merged_quantile_accuracy(self):
+        rng = random.Random(4)
+        for num_values in [1, 2, 7, 100, 3000]:
+            values = sample_values(rng, num_values)
+            sketches = [build_sketch(values[i:i + 13]) for i in range(0, num_values, 13)]
+            merged = merge_sketches(sketches)
+            for fraction in [0.0, 0.5, 0.9, 1.0]:
+                exact = percentile_disc(values, fraction)
+                estimate = sketch_quantile(merged, fraction)
+                # the quantile is the value of the bucket holding the exact quantile
+                self.assertEqual(estimate, bucket_value(bucket(exact)))
+                self.assertLessEqual(abs(estimate - exact) / exact, SKETCH_RELATIVE_ACCURACY + 1e-12)
+
+    def test_empty_sketches(self):
+        self.assertIsNone(build_sketch([]))
+        self.assertIsNone(build_sketch([None]))
+        self.assertIsNone(merge_sketches([None, None]))
+        self.assertIsNone(sketch_quantile(None, 0.5))
+
+class ModelTest(unittest.TestCase):
+
+    def test_quantiles_only_in_rollup_cubes(self):
+        model = json.loads(assets_generator.build_model(single_cube=True))
+        quantile_names = set(["apc_amount_median", "apc_amount_p90"])
+        cubes = dict([(cube["name"], cube) for cube in model["cubes"]])
+        for name in ["openapc", "combined"]:
+            aggregates = set([aggregate["name"] for aggregate in cubes[name]["aggregates"]])
+            self.assertFalse(aggregates & quantile_names)
+            rollup = cubes[assets_generator._rollup_table_name(name, "publisher")]
+            functions = dict([(aggregate["name"], aggregate.get("function")) for aggregate in rollup["aggregates"]])
+            self.assertEqual(functions["apc_amount_median"], "sketch_median")
+            self.assertEqual(functions["apc_amount_p90"], "sketch_p90")
+
+    def test_aggregate_functions(self):
+        from aggregate_functions import register_aggregate_functions
+        from cubes.backends.sql import functions
+        register_aggregate_functions()
+        for name, fraction in QUANTILES:
+            self.assertIn("sketch_" + name, functions.available_aggregate_functions())
+
+@unittest.skipIf(DATABASE_URL is None, "OPENAPC_TEST_DATABASE_URL is not set")
+class DatabaseSketchTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.engine = sqlalchemy.create_engine(DATABASE_URL)
+        quantile_sketch.create_sketch_functions(cls.engine)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.engine.dispose()
+
+    def test_functions_match_python(self):
+        rng = random.Random(5)
+        values = sample_values(rng, 2000) + [0.0, 0.5, 2000000.0]
+        cells = [values[i:i + 50] for i in range(0, len(values), 50)]
+        with self.engine.connect() as connection:
+            connection.execute("CREATE TEMPORARY TABLE sketch_test (cell integer, euro numeric)")
+            connection.execute("INSERT INTO sketch_test VALUES (%s, %s)",
+                               [(i, value) for i, cell_values in enumerate(cells) for value in cell_values])
+            sketches = connection.execute("SELECT public.apc_sketch(euro) FROM sketch_test GROUP BY cell " +
+                                          "ORDER BY cell").fetchall()
+            self.assertEqual([row[0] for row in sketches], [build_sketch(cell_values) for cell_values in cells])
+            for fraction in [0.0, 0.5, 0.9, 1.0]:
+                query = ("SELECT public.apc_sketch_quantile(public.apc_sketch_merge(sketch), %s) " +
+                         "FROM (SELECT public.apc_sketch(euro) AS sketch FROM sketch_test GROUP BY cell) AS cells")
+                self.assertEqual(connection.execute(query, fraction).scalar(),
+                                 sketch_quantile(build_sketch(values), fraction))
+
+@unittest.skipIf(DATABASE_URL is None, "OPENAPC_TEST_DATABASE_URL is not set")
+class InstitutionQuantileTest(unittest.TestCase):
+    """
+    Institution cubes of the model answer quantiles from the institution_publisher rollup.
+    """
+    schema = "openapc_quantile_test"
+
+    @classmethod
+    def setUpClass(cls):
+        from aggregate_functions import register_aggregate_functions
+        from cubes.server import slicer
+        from flask import Flask
+        register_aggregate_functions()
+        cls.engine = sqlalchemy.create_engine(DATABASE_URL, client_encoding="utf8")
+        cls.engine.execute("DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0}".format(cls.schema))
+        quantile_sketch.create_sketch_functions(cls.engine)
+        cls.rows = sample_rows(2000)
+        metadata = sqlalchemy.MetaData(bind=cls.engine)
+        source_table = sqlalchemy.Table("openapc", metadata, schema=cls.schema)
+        assets_generator.init_table(source_table, [(column, "string") for column in FACT_COLUMNS] + [("euro", "float")])
+        cls.engine.execute(source_table.insert(), cls.rows)
+        grain = dict(assets_generator.ROLLUP_GRAINS)["institution_publisher"]
+        fields, select = assets_generator._rollup_query(source_table, "openapc", grain)
+        name = assets_generator._rollup_table_name("openapc", "institution_publisher")
+        rollup_table = sqlalchemy.Table(name, metadata, schema=cls.schema)
+        assets_generator.init_table(rollup_table, fields)
+        cls.engine.execute(rollup_table.insert().from_select([field[0] for field in fields], select))
+        cls.directory = tempfile.mkdtemp()
+        model_path = os.path.join(cls.directory, "model.json")
+        with open(model_path, "w") as model_file:
+            model_file.write(assets_generator.build_model().encode("utf-8"))
+        config = ConfigParser()
+        config.add_section("model")
+        config.set("model", "path", model_path)
+        config.add_section("workspace")
+        config.add_section("store")
+        config.set("store", "type", "sql")
+        config.set("store", "url", DATABASE_URL)
+        config.set("store", "schema", cls.schema)
+        app = Flask(__name__)
+        app.register_blueprint(slicer, config=config)
+        cls.router = InstitutionRouter(RollupRouter(app.wsgi_app, model_path), model_path, "static/institutions.csv")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.engine.execute("DROP SCHEMA {} CASCADE".format(cls.schema))
+        cls.engine.dispose()
+        shutil.rmtree(cls.directory)
+
+    def test_median_by_publisher(self):
+        url = "/cube/bielefeld_u/aggregate?drilldown=publisher&aggregates=apc_amount_median|apc_num_items"
+        response = Client(self.router, BaseResponse).get(url)
+        self.assertEqual(response.status_code, 200, response.data)
+        cells = json.loads(response.data)["cells"]
+        values = {}
+        for row in self.rows:
+            if row["institution"] == u"Bielefeld U":
+                values.setdefault(row["publisher"], []).append(row["euro"])
+        self.assertEqual(sorted([cell["publisher"] for cell in cells]), sorted(values))
+        for cell in cells:
+            exact = percentile_disc(values[cell["publisher"]], 0.5)
+            self.assertEqual(cell["apc_num_items"], len(values[cell["publisher"]]))
+            self.assertLessEqual(abs(cell["apc_amount_median"] - exact) / exact, SKETCH_RELATIVE_ACCURACY + 1e-12)
+
+if __name__ == "__main__":
+    unittest.main()
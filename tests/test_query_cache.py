@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+import os
+import unittest
+
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+
+from fixtures import GenerationTestCase
+from olap_middleware import DiskCacheStore, MemoryCacheStore, QueryCache, normalize_query
+
+class CountingApp(object):
+    """
+    A WSGI app answering every request with the number of requests it has seen.
+    """
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, environ, start_response):
+        self.calls += 1
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return [str(self.calls)]
+
+class CorsApp(CountingApp):
+    """
+    A WSGI app echoing the Origin of a request in its CORS header, like
+    flask-cors does for allowed origins.
+    """
+    def __call__(self, environ, start_response):
+        def cors_start_response(status, headers, exc_info=None):
+            if "HTTP_ORIGIN" in environ:
+                headers = headers + [("Access-Control-Allow-Origin", environ["HTTP_ORIGIN"])]
+            return start_response(status, headers, exc_info)
+        return super(CorsApp, self).__call__(environ, cors_start_response)
+
+class NormalizeQueryTest(unittest.TestCase):
+
+    def test_parameter_and_cut_order(self):
+        self.assertEqual(normalize_query("/cube/openapc/aggregate", "drilldown=publisher&cut=period:2015|country:DEU"),
+                         normalize_query("/cube/openapc/aggregate/", "cut=country:DEU|period:2015&drilldown=publisher"))
+
+    def test_drilldown_order(self):
+        # the order of drilldowns determines the order of the cells
+        self.assertNotEqual(normalize_query("/cube/openapc/aggregate", "drilldown=publisher|period"),
+                            normalize_query("/cube/openapc/aggregate", "drilldown=period|publisher"))
+
+    def test_escaped_separator(self):
+        self.assertNotEqual(normalize_query("/cube/openapc/aggregate", "cut=publisher:a\\|b"),
+                            normalize_query("/cube/openapc/aggregate", "cut=publisher:b|publisher:a"))
+
+class QueryCacheTest(GenerationTestCase):
+
+    def setUp(self):
+        super(QueryCacheTest, self).setUp()
+        self.cache_directory = os.path.join(self.directory, "response_cache")
+
+    def get(self, cache, url):
+        response = Client(cache, BaseResponse).get(url)
+        return response.headers.get("X-Cache"), response.data
+
+    def test_hits_and_generations(self):
+        self.write_stamp("gen1", 1000)
+        app = CountingApp()
+        cache = QueryCache(app, MemoryCacheStore(10), generation_file=self.generation_file)
+        url = "/cube/openapc/aggregate?drilldown=publisher&cut=period:2015|country:DEU"
+        self.assertEqual(self.get(cache, url), ("MISS", "1"))
+        self.assertEqual(self.get(cache, url), ("HIT", "1"))
+        self.assertEqual(self.get(cache, "/cube/openapc/aggregate?cut=country:DEU|period:2015&drilldown=publisher"),
+                         ("HIT", "1"))
+        self.write_stamp("gen2", 2000)
+        self.assertEqual(self.get(cache, url), ("MISS", "2"))
+        self.assertEqual(cache.stats()["generation"], "gen2")
+        self.assertEqual(len(cache.store), 1)
+
+    def test_memory_store_limit(self):
+        store = MemoryCacheStore(2)
+        for key in ["a", "b", "c"]:
+            store.set(key, {"value": key})
+        self.assertIsNone(store.get("a"))
+        self.assertEqual(store.get("c"), {"value": "c"})
+
+    def test_shared_disk_store(self):
+        self.write_stamp("gen1", 1000)
+        app = CountingApp()
+        cache = QueryCache(app, DiskCacheStore(self.cache_directory, 10), generation_file=self.generation_file)
+        url = "/cube/openapc/aggregate?drilldown=publisher"
+        self.assertEqual(self.get(cache, url), ("MISS", "1"))
+        # a starting worker process with the same generation keeps the shared entries
+        other = QueryCache(app, DiskCacheStore(self.cache_directory, 10), generation_file=self.generation_file)
+        self.assertEqual(self.get(other, url), ("HIT", "1"))
+        self.assertEqual(len(other.store), 1)
+        # a new generation discards them
+        self.write_stamp("gen2", 2000)
+        restarted = QueryCache(app, DiskCacheStore(self.cache_directory, 10), generation_file=self.generation_file)
+        self.assertEqual(len(restarted.store), 0)
+        self.assertEqual(self.get(restarted, url), ("MISS", "2"))
+        self.assertEqual(self.get(cache, url), ("HIT", "2"))
+
+    def test_origins(self):
+        self.write_stamp("gen1", 1000)
+        cache = QueryCache(CorsApp(), MemoryCacheStore(10), generation_file=self.generation_file)
+        client = Client(cache, BaseResponse)
+        url = "/cube/openapc/aggregate?drilldown=publisher"
+        for origin, x_cache in [("https://a.example.org", "MISS"), ("https://b.example.org", "MISS"),
+                                ("https://a.example.org", "HIT"), ("https://b.example.org", "HIT")]:
+            response = client.get(url, headers=[("Origin", origin)])
+            self.assertEqual(response.headers["X-Cache"], x_cache)
+            self.assertEqual(response.headers["Access-Control-Allow-Origin"], origin)
+            self.assertEqual(response.headers["Vary"], "Origin")
+        response = client.get(url)
+        self.assertEqual(response.headers["X-Cache"], "MISS")
+        self.assertNotIn("Access-Control-Allow-Origin", response.headers)
+
+    def test_streaming_endpoints(self):
+        app = CountingApp()
+        cache = QueryCache(app, MemoryCacheStore(10), generation_file=self.generation_file)
+        self.assertEqual(self.get(cache, "/cube/openapc/export"), (None, "1"))
+        self.assertEqual(self.get(cache, "/cube/openapc/export"), (None, "2"))
+
+if __name__ == "__main__":
+    unittest.main()
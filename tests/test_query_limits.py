@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+import json
+import sqlite3
+import threading
+import time
+import unittest
+
+from flask import Flask
+import sqlalchemy
+from sqlalchemy.exc import OperationalError
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+
+from olap_middleware import AdmissionControl, MetricsRegistry, install_statement_timeout, set_statement_timeout
+
+HEAVY_URL = "/cube/openapc/facts"
+LIGHT_URL = "/cube/openapc/aggregate?drilldown=publisher"
+
+def _ok_app(environ, start_response):
+    start_response("200 OK", [("Content-Type", "application/json")])
+    return ["{}"]
+
+class AdmissionControlTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = MetricsRegistry()
+
+    def admission(self, queue_timeout=0.0):
+        return AdmissionControl(_ok_app, ["doi"], 1, queue_timeout=queue_timeout, registry=self.registry)
+
+    def start_request(self, admission, url):
+        """
+        Start a request without closing its response, so it keeps its slot.
+        """
+        path, _, query_string = url.partition("?")
+        environ = {"PATH_INFO": path, "QUERY_STRING": query_string, "REQUEST_METHOD": "GET"}
+        return admission(environ, lambda status, headers, exc_info=None: None)
+
+    def rejected(self):
+        return self.registry.counters.get(("openapc_admission_rejected_total", (("class", "heavy"),)), 0)
+
+    def test_cost_classes(self):
+        admission = self.admission()
+        self.assertEqual(admission.cost_class("facts", None, []), "heavy")
+        self.assertEqual(admission.cost_class("aggregate", None, [("drilldown", "doi")]), "heavy")
+        self.assertEqual(admission.cost_class("aggregate", None, [("drilldown", "doi"), ("cut", "doi:10.1/x")]),
+                         "light")
+        self.assertEqual(admission.cost_class("members", "/doi", []), "heavy")
+        self.assertEqual(admission.cost_class("aggregate", None, [("drilldown", "publisher")]), "light")
+
+    def test_limit_reached(self):
+        admission = self.admission()
+        client = Client(admission, BaseResponse)
+        running = self.start_request(admission, HEAVY_URL)
+        response = client.get(HEAVY_URL)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers["Retry-After"], "1")
+        self.assertEqual(json.loads(response.data)["error"], "overloaded")
+        self.assertEqual(self.rejected(), 1)
+        # light requests have no budget
+        self.assertEqual(client.get(LIGHT_URL).status_code, 200)
+        # the slot is released when the response is closed
+        running.close()
+        self.assertEqual(client.get(HEAVY_URL).status_code, 200)
+
+    def test_queue_timeout(self):
+        admission = self.admission(queue_timeout=0.2)
+        client = Client(admission, BaseResponse)
+        running = self.start_request(admission, HEAVY_URL)
+        start = time.time()
+        self.assertEqual(client.get(HEAVY_URL).status_code, 503)
+        self.assertGreaterEqual(time.time() - start, 0.2)
+        self.assertEqual(self.rejected(), 1)
+        # a request waiting in the queue gets the slot as soon as it is released
+        timer = threading.Timer(0.05, running.close)
+        timer.start()
+        self.assertEqual(client.get(HEAVY_URL).status_code, 200)
+        timer.join()
+        self.assertEqual(self.rejected(), 1)
+
+class RecordingCursor(object):
+    """
+    A DBAPI cursor recording SET statements instead of executing them.
+    """
+    def __init__(self, connection, cursor):
+        self.connection = connection
+        self.cursor = cursor
+
+    def execute(self, statement, *args):
+        if statement.startswith("SET "):
+            self.connection.statements.append(statement)
+        else:
+            return self.cursor.execute(statement, *args)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+class RecordingConnection(object):
+    """
+    A SQLite DBAPI connection recording SET statements and commits.
+    """
+    def __init__(self):
+        self.connection = sqlite3.connect(":memory:")
+        self.statements = []
+        self.commits = 0
+
+    def cursor(self):
+        return RecordingCursor(self, self.connection.cursor())
+
+    def commit(self):
+        self.commits += 1
+        self.connection.commit()
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+class QueryCanceledError(Exception):
+    """
+    Stands in for psycopg2's QueryCanceledError.
+    """
+    pgcode = "57014"
+
+class StatementTimeoutTest(unittest.TestCase):
+
+    def test_set_on_connect(self):
+        connections = []
+        def connect():
+            connections.append(RecordingConnection())
+            return connections[-1]
+        engine = sqlalchemy.create_engine("sqlite://", creator=connect)
+        set_statement_timeout(engine, 2.5)
+        engine.execute("SELECT 1").close()
+        self.assertEqual(len(connections), 1)
+        self.assertEqual(connections[0].statements, ["SET statement_timeout = 2500"])
+        # the setting has to survive the rollback of the pool
+        self.assertGreaterEqual(connections[0].commits, 1)
+
+    def test_timeout_response(self):
+        engine = sqlalchemy.create_engine("postgresql://", creator=RecordingConnection)
+        class Store(object):
+            connectable = engine
+        class Workspace(object):
+            def get_store(self, name):
+                return Store()
+        app = Flask(__name__)
+        @app.route("/cube/openapc/aggregate")
+        def aggregate():
+            raise OperationalError("SELECT 1", {}, QueryCanceledError())
+        @app.route("/cube/openapc/facts")
+        def facts():
+            raise OperationalError("SELECT 1", {}, Exception())
+        registry = MetricsRegistry()
+        install_statement_timeout(app, Workspace(), 10, registry)
+        client = Client(app.wsgi_app, BaseResponse)
+        response = client.get("/cube/openapc/aggregate")
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(json.loads(response.data)["error"], "query_timeout")
+        self.assertEqual(registry.counters[("openapc_sql_statement_timeouts_total", ())], 1)
+        # other database errors are not turned into timeouts
+        self.assertEqual(client.get("/cube/openapc/facts").status_code, 500)
+        self.assertEqual(registry.counters[("openapc_sql_statement_timeouts_total", ())], 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+
+import json
+import unittest
+
+from aggregate_functions import register_aggregate_functions
+from fixtures import CubesTestCase
+from olap_middleware import RollupRouter
+
+class RollupRouterTest(CubesTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        register_aggregate_functions()
+        super(RollupRouterTest, cls).setUpClass()
+        cls.router = RollupRouter(cls.app.wsgi_app, cls.cubes.model_path)
+
+    def test_find_rollup(self):
+        params = [("drilldown", "publisher"), ("cut", "period:2015")]
+        self.assertEqual(self.router.find_rollup("openapc", params), "openapc_by_publisher")
+        # journal_full_title is part of the journal grain
+        params = [("drilldown", "journal_full_title")]
+        self.assertEqual(self.router.find_rollup("openapc", params), "openapc_by_journal")
+        # no rollup has the country dimension
+        self.assertIsNone(self.router.find_rollup("openapc", [("drilldown", "country")]))
+        # quantiles by publisher of an institution
+        params = [("drilldown", "publisher"), ("cut", "institution:Bielefeld U"), ("aggregates", "apc_amount_median")]
+        self.assertEqual(self.router.find_rollup("openapc", params), "openapc_by_institution_publisher")
+        self.assertIsNone(self.router.find_rollup("openapc", [("drilldown", "publisher"), ("split", "period:2015")]))
+        self.assertIsNone(self.router.find_rollup("openapc", [("aggregates", "unknown_aggregate")]))
+
+    def test_rollup_cube_aggregates(self):
+        # only the aggregates of the model, no implicit sums of the stored measures
+        model_cube = [cube for cube in json.load(open(self.cubes.model_path))["cubes"]
+                      if cube["name"] == "openapc_by_publisher"][0]
+        cube = self.app.cubes_workspace.cube("openapc_by_publisher")
+        self.assertEqual([aggregate.name for aggregate in cube.aggregates],
+                         [aggregate["name"] for aggregate in model_cube["aggregates"]])
+
+    def test_default_aggregate_request(self):
+        # without an aggregates parameter, the rollup cube computes all aggregates of the source cube
+        url = "/cube/openapc/aggregate?drilldown=publisher&cut=period:2015"
+        routed = self.get_json(self.router, url)
+        direct = self.get_json(self.app.wsgi_app, url)
+        self.assertEqual(sorted(routed["aggregates"]), sorted(direct["aggregates"]))
+        self.assertEqual(len(routed["cells"]), len(direct["cells"]))
+        cells = dict([(cell["publisher"], cell) for cell in direct["cells"]])
+        for cell in routed["cells"] + [routed["summary"]]:
+            expected = cells[cell["publisher"]] if "publisher" in cell else direct["summary"]
+            self.assertEqual(set(cell), set(expected))
+            for aggregate in direct["aggregates"]:
+                self.assertAlmostEqual(cell[aggregate], expected[aggregate], places=6)
+
+if __name__ == "__main__":
+    unittest.main()
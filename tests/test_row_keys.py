@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+
+import unittest
+
+from assets_generator import _row_key
+
+def _keys(rows):
+    key_counts = {}
+    return [_row_key(values, doi, "openapc", key_counts)[0] for values, doi in rows]
+
+class RowKeyTest(unittest.TestCase):
+    """
+    Row keys must not depend on the position of duplicated rows.
+    """
+    def test_duplicate_dois(self):
+        rows = [((u"A", u"1000"), u"10.1/a"), ((u"B", u"2000"), u"10.1/a"), ((u"C", u"3000"), u"10.1/a")]
+        keys = _keys(rows)
+        self.assertEqual(keys[0], "openapc:10.1/a")
+        self.assertEqual(len(set(keys)), 3)
+        # removing a duplicate does not change the keys of the later ones
+        self.assertEqual(_keys([rows[0], rows[2]]), [keys[0], keys[2]])
+        self.assertEqual(_keys([rows[0], rows[2], rows[1]]), keys[:1] + [keys[2], keys[1]])
+
+    def test_identical_rows(self):
+        rows = [((u"A", u"1000"), u"10.1/a")] * 3 + [((u"A", u"1000"), None)] * 2
+        keys = _keys(rows)
+        self.assertEqual(len(set(keys)), 5)
+        self.assertTrue(keys[3].startswith("openapc:hash:"))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+import math
+import os
+import shutil
+import tempfile
+import unittest
+
+from fixtures import FACT_COLUMNS, CubesTestCase
+import memory_store # registers the "memory" store type
+import snapshot
+from snapshot import NULL_CODE, Snapshot, read_snapshot_generation, write_snapshot
+
+STRINGS = [u"b", None, u"M\xfcnchen", u"a", u"b", u""]
+FLOATS = [1.5, None, -2.0, 1e9, 0.0, 3.25]
+
+def _fact_table_columns(rows):
+    columns = [(column, "string", [row[column] for row in rows]) for column in FACT_COLUMNS]
+    return columns + [("euro", "float", [row["euro"] for row in rows])]
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "data_snapshot.bin")
+        self.numpy = snapshot.numpy
+
+    def tearDown(self):
+        snapshot.numpy = self.numpy
+        shutil.rmtree(self.directory)
+
+    def write(self):
+        columns = [("name", "string", STRINGS), ("euro", "float", FLOATS)]
+        return write_snapshot(self.path, [("facts", len(STRINGS), columns), ("empty", 0, [])], "gen1")
+
+    def assert_round_trip(self):
+        data = Snapshot(self.path)
+        self.assertEqual(data.generation, "gen1")
+        self.assertEqual(sorted(data.table_names()), ["empty", "facts"])
+        self.assertEqual(data.num_rows("facts"), len(STRINGS))
+        dictionary = data.dictionary("facts", "name")
+        self.assertEqual(dictionary, sorted(set([value for value in STRINGS if value is not None])))
+        values = [None if code == NULL_CODE else dictionary[code] for code in data.column("facts", "name")]
+        self.assertEqual(values, STRINGS)
+        floats = [None if math.isnan(value) else value for value in data.column("facts", "euro")]
+        self.assertEqual(floats, FLOATS)
+        self.assertEqual(data.num_rows("empty"), 0)
+
+    def test_round_trip(self):
+        self.write()
+        self.assert_round_trip()
+        self.assertEqual(read_snapshot_generation(self.path), "gen1")
+        self.assertFalse(os.path.exists(self.path + ".tmp"))
+
+    def test_round_trip_without_numpy(self):
+        self.write()
+        snapshot.numpy = None
+        self.assert_round_trip()
+
+    def test_corrupted_snapshot(self):
+        self.write()
+        with open(self.path, "r+b") as f:
+            f.seek(-1, os.SEEK_END)
+            last = f.read(1)
+            f.seek(-1, os.SEEK_END)
+            f.write(chr(ord(last) ^ 1))
+        self.assertRaises(ValueError, Snapshot, self.path)
+        with open(self.path, "r+b") as f:
+            f.truncate(os.path.getsize(self.path) - 1)
+        self.assertRaises(ValueError, Snapshot, self.path)
+
+    def test_invalid_snapshot(self):
+        self.assertIsNone(read_snapshot_generation(self.path))
+        with open(self.path, "wb") as f:
+            f.write("no snapshot")
+        self.assertIsNone(read_snapshot_generation(self.path))
+        self.assertRaises(ValueError, Snapshot, self.path)
+
+    def test_column_length(self):
+        self.assertRaises(ValueError, write_snapshot, self.path, [("facts", 2, [("euro", "float", [1.0])])], "gen1")
+        self.assertEqual(os.listdir(self.directory), [])
+
+@unittest.skipIf(memory_store.numpy is None, "the memory store requires NumPy")
+class MemoryStoreSnapshotTest(CubesTestCase):
+    """
+    The memory store has to answer requests from a snapshot like the sql store
+    answers them from the database.
+    """
+    @classmethod
+    def setUpClass(cls):
+        super(MemoryStoreSnapshotTest, cls).setUpClass()
+        cls.snapshot_path = os.path.join(cls.cubes.directory, "data_snapshot.bin")
+        write_snapshot(cls.snapshot_path, [("openapc", len(cls.cubes.rows), _fact_table_columns(cls.cubes.rows))],
+                       "gen1")
+        cls.memory_app = cls.cubes.slicer_app("memory", snapshot=cls.snapshot_path)
+
+    def test_snapshot_aggregates(self):
+        url = "/cube/openapc/aggregate?drilldown=publisher&cut=period:2015"
+        sql = self.get_json(self.app.wsgi_app, url)
+        memory = self.get_json(self.memory_app.wsgi_app, url)
+        store = self.memory_app.cubes_workspace.get_store("default")
+        self.assertEqual(store.snapshot.generation, "gen1")
+        expected_cells = dict([(cell["publisher"], cell) for cell in sql["cells"]])
+        self.assertEqual(len(memory["cells"]), len(sql["cells"]))
+        for cell in memory["cells"]:
+            for aggregate in sql["aggregates"]:
+                self.assertAlmostEqual(cell[aggregate], expected_cells[cell["publisher"]][aggregate], places=6)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,7 +1,12 @@
 #!/usr/bin/env python
 
+import binascii
+from collections import OrderedDict
 import codecs
 import csv
+import datetime
+import json
+import os
 
 # These two classes were adopted from 
 # https://docs.python.org/2/library/csv.html#examples
@@ -36,6 +41,90 @@ class UnicodeReader(object):
     def __iter__(self):
         return self
 
+DEFAULT_CSV_BATCH_SIZE = 5000
+
+def _decode_column(values):
+    """
+    Decode a column of UTF-8 strings, decoding every distinct value only once.
+    """
+    decoded = {None: None}
+    result = []
+    for value in values:
+        try:
+            result.append(decoded[value])
+        except KeyError:
+            decoded[value] = value.decode("utf-8")
+            result.append(decoded[value])
+    return result
+
+class RowBatch(object):
+    """
+    A batch of CSV rows, stored column-wise.
+
+    columns maps every field name to a list of unicode values (None for
+    fields missing in the file).
+    """
+    def __init__(self, fields, columns, num_rows):
+        self.fields = fields
+        self.columns = columns
+        self.num_rows = num_rows
+
+    def __len__(self):
+        return self.num_rows
+
+    def rows(self, fields=None):
+        """
+        Get the rows as tuples with a fixed field order.
+
+        Args:
+            fields: The field order, defaults to the order of the batch fields
+        """
+        return zip(*[self.columns[field] for field in (fields or self.fields)])
+
+    def dicts(self):
+        """
+        Get the rows as dicts, like UnicodeReader returns them.
+        """
+        return [dict(zip(self.fields, row)) for row in self.rows()]
+
+class CSVBatchReader(object):
+    """
+    A fast reader for UTF-8 encoded CSV files, yielding RowBatch objects.
+
+    In contrast to UnicodeReader, the input is parsed without re-encoding,
+    only the requested fields are decoded, once per distinct value and batch,
+    and no dict is created per row.
+    """
+    def __init__(self, f, fields=None, batch_size=DEFAULT_CSV_BATCH_SIZE, dialect=csv.excel):
+        self.reader = csv.reader(f, dialect=dialect)
+        header = [name.decode("utf-8") for name in self.reader.next()]
+        self.fields = fields or header
+        self.indexes = [header.index(field) if field in header else None for field in self.fields]
+        self.batch_size = batch_size
+
+    def _batch(self, lines):
+        columns = {}
+        for field, index in zip(self.fields, self.indexes):
+            if index is None:
+                columns[field] = [None] * len(lines)
+            else:
+                # like csv.DictReader, fields missing at the end of a line become None
+                columns[field] = _decode_column([line[index] if index < len(line) else None for line in lines])
+        return RowBatch(self.fields, columns, len(lines))
+
+    def __iter__(self):
+        lines = []
+        for line in self.reader:
+            # like csv.DictReader, skip empty lines
+            if not line:
+                continue
+            lines.append(line)
+            if len(lines) >= self.batch_size:
+                yield self._batch(lines)
+                lines = []
+        if lines:
+            yield self._batch(lines)
+
 def colorise(text, color):
     return colorise_text_segment(text, 0, len(text), color)
     
@@ -52,3 +141,119 @@ def colorise_text_segment(text, start, end, color):
     s = ANSI_COLORS[color]
     e = "\033[0m"
     return text[:start] + s + text[start:end] + e + text[end:]
+
+def new_generation_id():
+    """
+    Create a new, unique data generation identifier.
+    """
+    now = datetime.datetime.utcnow()
+    return now.strftime("%Y%m%dT%H%M%S") + "-" + binascii.hexlify(os.urandom(4))
+
+def write_generation_stamp(path, generation=None):
+    """
+    Write a new data generation stamp.
+
+    The stamp identifies the current state of the database tables. It is
+    written by the tables job and used by the server to invalidate cached
+    responses.
+
+    Args:
+        path: The path of the stamp file
+        generation: The generation identifier, a new one is created if None
+
+    Returns:
+        The new generation identifier
+    """
+    now = datetime.datetime.utcnow()
+    if generation is None:
+        generation = new_generation_id()
+    stamp = {"generation": generation, "created": now.strftime("%Y-%m-%dT%H:%M:%SZ")}
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as f:
+        f.write(json.dumps(stamp))
+    # rename is atomic, readers never see a partially written stamp
+    os.rename(temp_path, path)
+    return generation
+
+def escape_cut_value(value):
+    """
+    Escape characters with a special meaning in cubes cut strings.
+    """
+    for char in ["\\", ":", "|", ",", "-", ";"]:
+        value = value.replace(char, "\\" + char)
+    return value
+
+def read_generation_stamp(path):
+    """
+    Read the data generation stamp written by write_generation_stamp().
+
+    Returns:
+        A dict with the keys "generation" and "created" or None if no valid
+        stamp exists.
+    """
+    try:
+        with open(path, "r") as f:
+            return json.loads(f.read())
+    except (IOError, ValueError):
+        return None
+
+def compile_model_index(model):
+    """
+    Create the precompiled index of a cubes model read by the lazy model
+    provider (see lazy_model.py).
+
+    The index holds all top-level entries of the model (like the shared
+    dimensions) and a short entry for every cube: name, label, category,
+    info, the names of its aggregates and its complete definition as a
+    compact JSON string. The definition is only decoded when the server
+    first uses the cube.
+
+    Args:
+        model: The cubes model as dict
+
+    Returns:
+        The index as dict
+    """
+    index = OrderedDict([(key, value) for key, value in model.items() if key != "cubes"])
+    index["provider"] = "lazy"
+    index["cube_index"] = []
+    for cube in model["cubes"]:
+        entry = OrderedDict()
+        entry["name"] = cube["name"]
+        entry["label"] = cube.get("label", cube["name"])
+        entry["category"] = cube.get("category") or cube.get("info", {}).get("category")
+        entry["info"] = cube.get("info", {})
+        entry["aggregates"] = [aggregate["name"] for aggregate in cube.get("aggregates", [])]
+        entry["dimensions"] = _dimension_names(cube)
+        entry["definition"] = json.dumps(cube, separators=(",", ":"))
+        index["cube_index"].append(entry)
+    return index
+
+def _dimension_names(cube):
+    """
+    Get the dimension names of a cube definition, which lists dimensions by
+    name or as dicts.
+    """
+    return [dimension["name"] if isinstance(dimension, dict) else dimension
+            for dimension in cube.get("dimensions", [])]
+
+def read_model_cubes(path):
+    """
+    Read the cube descriptions from a model file or a model index (see
+    compile_model_index()) without decoding the complete cube definitions.
+
+    Returns:
+        A list of dicts with the keys "name", "info", "aggregates" (a list
+        of aggregate names) and "dimensions" (a list of dimension names)
+    """
+    with open(path, "r") as model_file:
+        model = json.loads(model_file.read())
+    if "cube_index" in model:
+        return [{"name": entry["name"], "info": entry["info"], "aggregates": entry["aggregates"],
+                 "dimensions": entry["dimensions"]} for entry in model["cube_index"]]
+    cubes = []
+    for cube in model["cubes"]:
+        aggregates = [aggregate["name"] for aggregate in cube.get("aggregates", [])]
+        cubes.append({"name": cube["name"], "info": cube.get("info", {}), "aggregates": aggregates,
+                      "dimensions": _dimension_names(cube)})
+    return cubes